@@ -9,6 +9,8 @@ setup(
     description='Picterra API client',
     package_dir={'': 'src'},
     packages=find_packages('src'),
+    # Module __getattr__ (lazy imports)
+    python_requires='>=3.7',
     setup_requires=[
         'pytest-runner',
         'flake8',
@@ -16,9 +18,14 @@ setup(
     install_requires=[
         'requests',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'zstd': ['zstandard'],
+    },
     tests_require=[
         'pytest',
         'flake8',
+        'numpy',
         'responses',
         'httpretty'
     ],
@@ -1,4 +1,13 @@
-from .client import APIClient
-from .nongeo import nongeo_result_to_pixel
-
 __all__ = ['APIClient', 'nongeo_result_to_pixel']
+
+
+def __getattr__(name):
+    # Submodules are imported on first access so that importing the package (e.g. to run the
+    # CLI with --help) does not pay for requests/urllib3 until the network is actually needed
+    if name == 'APIClient':
+        from .client import APIClient
+        return APIClient
+    if name == 'nongeo_result_to_pixel':
+        from .nongeo import nongeo_result_to_pixel
+        return nongeo_result_to_pixel
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
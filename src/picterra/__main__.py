@@ -8,17 +8,185 @@ python -m picterra <COMMAND> [<SUBCOMMAND>] INPUT_FILE RASTER DETECTOR OUTPUT_FI
 
 
 import argparse
+import glob
 import logging
 import json
+import os
 import sys
-
-from .client import APIClient, APIError
+from collections import OrderedDict
 
 
 logger = logging.getLogger(__name__)
 
 
-def parse_args(args):
+def __getattr__(name):
+    # The client module (and with it requests/urllib3) is only imported once a command
+    # actually needs the network, which keeps --help and --version fast
+    if name in ('APIClient', 'APIError'):
+        from . import client
+        return getattr(client, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def _expand_paths(patterns):
+    """
+    Expands directories (non recursively) and glob patterns into the sorted list of files they
+    contain; other paths are kept as they are
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths += sorted(
+                os.path.join(pattern, f) for f in os.listdir(pattern)
+                if os.path.isfile(os.path.join(pattern, f)))
+        elif glob.has_magic(pattern):
+            paths += sorted(p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p))
+        else:
+            paths.append(pattern)
+    # Remove duplicates (e.g. overlapping patterns) while keeping the order
+    return list(OrderedDict.fromkeys(paths))
+
+
+def _raster_name(name, paths, index):
+    """The name of the index-th raster: name itself, or a template when there are several"""
+    if name is None or len(paths) == 1:
+        return name
+    filename = os.path.basename(paths[index])
+    return name.format(
+        path=paths[index], filename=filename, stem=os.path.splitext(filename)[0], index=index)
+
+
+def _create_raster(client, path, name, folder_id, detector_ids):
+    """Uploads a raster and associates it to detectors, returns a (raster_id, error) pair"""
+    from .client import APIError
+    try:
+        raster_id = client.upload_raster(path, name, folder_id)
+    except (APIError, OSError) as e:
+        return None, e
+    try:
+        for detector_id in detector_ids:
+            client.add_raster_to_detector(raster_id, detector_id)
+            logger.debug('Added raster %s to %s detector' % (raster_id, detector_id))
+    except APIError as e:
+        return raster_id, e
+    logger.info('Created new raster whose id is %s from %s%s' % (
+        raster_id, path,
+        (', and added to %d detectors' % len(detector_ids)) if detector_ids else ''))
+    return raster_id, None
+
+
+def _read_ids(value):
+    """Returns [value], or the non-empty lines of stdin if value is '-'"""
+    if value != '-':
+        return [value]
+    return [line.strip() for line in sys.stdin if line.strip()]
+
+
+def _print_ndjson(items, out):
+    for item in items:
+        print(json.dumps(item), file=out, flush=True)
+
+
+def _detect(client, detector_id, raster_id, output_file):
+    logger.info('Running %s on %s' % (detector_id, raster_id))
+    logger.debug('Starting detection..')
+    result_id = client.run_detector(detector_id, raster_id)
+    client.download_result_to_file(result_id, output_file)
+    logger.debug('Detection finished, writing result to %s' % output_file)
+
+
+def _print_table(rows, out):
+    """Prints rows of strings as left-aligned columns, the last one not padded"""
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]) - 1)]
+    for row in rows:
+        print('  '.join(
+            [c.ljust(w) for c, w in zip(row, widths)] + [row[-1]]), file=out)
+
+
+def _print_matrix_summary(summaries, out):
+    rows = [('DETECTOR', 'RASTER', 'SECONDS', 'FEATURES', 'STATUS')]
+    for s in summaries:
+        rows.append((
+            str(s['detector_id']), str(s['raster_id']), '%.1f' % s['seconds'],
+            '-' if s['feature_count'] is None else str(s['feature_count']),
+            'ok' if s['error'] is None else 'failed: %s' % s['error']
+        ))
+    _print_table(rows, out)
+
+
+def _read_manifest(filename):
+    """Reads an annotations manifest into set_annotations_many uploads"""
+    with open(filename) as f:
+        entries = json.load(f)
+    directory = os.path.dirname(os.path.abspath(filename))
+    return [{
+        'filename': os.path.join(directory, e['path']), 'raster_id': e['raster'],
+        'detector_id': e['detector'], 'annotation_type': e['type']
+    } for e in entries]
+
+
+def _print_annotations_summary(summaries, out):
+    rows = [('DETECTOR', 'RASTER', 'TYPE', 'STATUS')]
+    for s in summaries:
+        rows.append((
+            str(s['detector_id']), str(s['raster_id']), s['annotation_type'],
+            s['status'] if s['error'] is None else 'failed: %s' % s['error']
+        ))
+    _print_table(rows, out)
+
+
+def _select_ids(client, options):
+    """The IDs of the rasters or detectors to delete, given or matching the filters"""
+    if options.ids:
+        return options.ids
+    if options.delete == 'raster':
+        items = client.iter_rasters(options.folder)
+    else:
+        items = client.iter_detectors()
+    return [
+        item['id'] for item in items
+        if (options.name_prefix is None or item.get('name', '').startswith(options.name_prefix)) and
+        (getattr(options, 'status', None) is None or item.get('status') == options.status)
+    ]
+
+
+def _delete(client, options, out):
+    from .client import APIError
+    resource = options.delete
+    ids = _select_ids(client, options)
+    delete_many = client.delete_rasters if resource == 'raster' else client.delete_detectors
+    summaries = delete_many(ids, options.jobs, options.dry_run)
+    for s in summaries:
+        if s['status'] != 'failed':
+            print(s['id'], file=out, flush=True)
+    failures = sum(1 for s in summaries if s['status'] == 'failed')
+    if failures:
+        raise APIError('%d of %d %s deletions failed' % (failures, len(summaries), resource))
+
+
+def _run_concurrently(func, items, jobs):
+    """
+    Calls func on every item using up to `jobs` threads, yielding (item, result) pairs
+    in completion order
+    """
+    if jobs <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        except BaseException:
+            # Do not start the pending calls if one failed
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def _create_parser():
     # create the top-level parser
     parser = argparse.ArgumentParser(
         prog='picterra', description='Picterra API wrapper CLI tool', epilog='© Picterra 2020')
@@ -26,6 +194,9 @@ def parse_args(args):
     # Parser for version and verbosity
     parser.add_argument('--version', action='version', version='1.0.0')
     parser.add_argument("-v", help="set output verbosity", action="store_true")
+    parser.add_argument(
+        "--no-daemon", help="run the command in this process even if a daemon is running",
+        action="store_true")
 
     # create the parser for the subcommands
     subparsers = parser.add_subparsers(dest='command')
@@ -37,20 +208,42 @@ def parse_args(args):
     list_rasters_parser = list_subparsers.add_parser(
         'rasters', help="List user's rasters")
     list_rasters_parser.add_argument(
-        "--output", help="Type of output", type=str, choices=['json', 'ids_only'], default='json')
+        "--output", help="Type of output; ndjson prints one raster per line as pages arrive",
+        type=str, choices=['json', 'ids_only', 'ndjson'], default='json')
     list_rasters_parser.add_argument(
         "--folder", help="Id of the folder/project whose rasters we want to list",
         type=str, required=False)
     # List detectors
-    list_subparsers.add_parser(
+    list_detectors_parser = list_subparsers.add_parser(
         'detectors', help="List user's detectors")
+    list_detectors_parser.add_argument(
+        "--output", help="Type of output; ndjson prints one detector per line as pages arrive",
+        type=str, choices=['json', 'ids_only', 'ndjson'], default='json')
 
     # create the parser for the "detect" command
     detect_parser = subparsers.add_parser('detect', help="Predict on a raster with a detector")
-    detect_parser.add_argument("raster", help="ID of a raster", type=str)
+    detect_parser.add_argument(
+        "raster", help="ID of a raster, or '-' to read one ID per line from stdin", type=str)
     detect_parser.add_argument("detector", help="ID of a detector", type=str)
     detect_parser.add_argument(
-        "output_file", help="Path of the file were results will be saved", type=str)
+        "output_file", help="Path of the file were results will be saved; when reading raster "
+        "IDs from stdin, directory where <raster>.geojson files are saved", type=str)
+    detect_parser.add_argument(
+        "-j", "--jobs", help="Number of concurrent detections when reading from stdin",
+        type=int, default=1)
+
+    # create the parser for the "detect-matrix" command
+    detect_matrix_parser = subparsers.add_parser(
+        'detect-matrix', help="Predict with every detector on every raster")
+    detect_matrix_parser.add_argument(
+        "output_dir", help="Directory were results are saved as <detector>/<raster>.geojson",
+        type=str)
+    detect_matrix_parser.add_argument(
+        "-r", "--raster", help="IDs of the rasters", type=str, nargs='+', required=True)
+    detect_matrix_parser.add_argument(
+        "-d", "--detector", help="IDs of the detectors", type=str, nargs='+', required=True)
+    detect_matrix_parser.add_argument(
+        "-j", "--jobs", help="Number of concurrent detections", type=int, default=4)
 
     # create the parser for the "train" command
     train_parser = subparsers.add_parser('train', help="Trains a detector")
@@ -79,24 +272,50 @@ def parse_args(args):
     # create raster
     create_raster_parser = create_subparsers.add_parser(
         'raster', help="Creates a raster, optionally adding it to a detector")
-    create_raster_parser.add_argument("path", help="Path to the raster file", type=str)
-    create_raster_parser.add_argument("--name", help="Name of the raster", type=str, required=False)
+    create_raster_parser.add_argument(
+        "path", help="Path(s) to the raster file(s); directories and glob patterns are expanded",
+        type=str, nargs='+')
+    create_raster_parser.add_argument(
+        "--name", help="Name of the raster; when uploading several files this is a template "
+        "that can use the {path}, {filename}, {stem} and {index} fields", type=str, required=False)
     create_raster_parser.add_argument(
         "--folder", help="Id of the folder/project to which the raster will be uploaded",
         type=str, required=False)
     create_raster_parser.add_argument(
         "-d", "--detector", help="ID(s) of the detector(s) to which we'll associate the raster",
         type=str, required=False, nargs='+', default=[])
+    create_raster_parser.add_argument(
+        "-j", "--jobs", help="Number of concurrent uploads", type=int, default=1)
+    create_raster_parser.add_argument(
+        "--output", help="Type of output, printed as each upload completes", type=str,
+        choices=['ids_only', 'ndjson'], default='ids_only')
     # create annotation
     create_annotation_parser = create_subparsers.add_parser(
         'annotation', help="Add an annotation to a raster for a given detector")
     create_annotation_parser.add_argument(
         "path", help="Path  to the geojson file containing the annotation geometries", type=str)
-    create_annotation_parser.add_argument("raster", help="ID of a raster", type=str)
+    create_annotation_parser.add_argument(
+        "raster", help="ID of a raster, or '-' to read one ID per line from stdin", type=str)
     create_annotation_parser.add_argument("detector", help="ID of a detector", type=str)
     create_annotation_parser.add_argument(
         "type", help="Type of the annotation", type=str,
         choices=['outline', 'training_area', 'testing_area', 'validation_area'])
+    create_annotation_parser.add_argument(
+        "-j", "--jobs", help="Number of concurrent uploads when reading from stdin",
+        type=int, default=1)
+    # create annotations
+    create_annotations_parser = create_subparsers.add_parser(
+        'annotations', help="Set the annotations listed in a manifest, skipping the unchanged ones")
+    create_annotations_parser.add_argument(
+        "manifest", help=(
+            "Path to a JSON file with a list of {\"path\", \"raster\", \"detector\", \"type\"} "
+            "objects, paths being relative to the manifest"), type=str)
+    create_annotations_parser.add_argument(
+        "--state", help=(
+            "Path to the file recording the annotations already set "
+            "(default: the manifest path followed by .state)"), type=str, default=None)
+    create_annotations_parser.add_argument(
+        "-j", "--jobs", help="Number of concurrent uploads", type=int, default=4)
     # create detection area
     create_detection_area_parser = create_subparsers.add_parser(
         'detection_area', help="Add a detection area to a raster")
@@ -109,46 +328,202 @@ def parse_args(args):
     delete_parser = subparsers.add_parser('delete', help="Delete resources")
     delete_subparsers = delete_parser.add_subparsers(dest='delete')
     # delete raster
-    delete_raster_parser = delete_subparsers.add_parser('raster', help="Removes a raster")
-    delete_raster_parser.add_argument("raster", help="ID of the raster to delete", type=str)
+    delete_raster_parser = delete_subparsers.add_parser(
+        'raster', help="Removes rasters, given by ID or selected with filters")
+    delete_raster_parser.add_argument(
+        "raster", help="IDs of the rasters to delete, or '-' to read one ID per line from stdin",
+        type=str, nargs='*', default=[])
+    delete_raster_parser.add_argument(
+        "--folder", help="Delete the rasters of this folder", type=str, default=None)
+    delete_raster_parser.add_argument(
+        "--status", help="Delete the rasters with this status", type=str, default=None)
     # delete detector
-    delete_detector_parser = delete_subparsers.add_parser('detector', help="Removes a detector")
-    delete_detector_parser.add_argument("detector", help="ID of the detector to delete", type=str)
+    delete_detector_parser = delete_subparsers.add_parser(
+        'detector', help="Removes detectors, given by ID or selected with filters")
+    delete_detector_parser.add_argument(
+        "detector",
+        help="IDs of the detectors to delete, or '-' to read one ID per line from stdin",
+        type=str, nargs='*', default=[])
+    for p in (delete_raster_parser, delete_detector_parser):
+        p.add_argument(
+            "--name-prefix", help="Delete the ones whose name starts with this prefix",
+            type=str, default=None)
+        p.add_argument(
+            "--dry-run", help="Print the IDs that would be deleted, without deleting them",
+            action="store_true")
+        p.add_argument(
+            "-j", "--jobs", help="Number of concurrent deletions", type=int, default=8)
     # delete detection areas
     delete_detectionarea_parser = delete_subparsers.add_parser(
         "detection_area", help="Removes the detection areas of raster, if any")
     delete_detectionarea_parser.add_argument(
         "raster", help="ID of the raster whose detection areas will be deleted", type=str)
 
+    # create the parser for the "stats" command
+    stats_parser = subparsers.add_parser(
+        'stats', help="Print the count, area, perimeter and bounding box of a result")
+    stats_parser.add_argument(
+        "result", help="Path of a result file, or ID of a detection operation whose result "
+        "is streamed without being saved", type=str)
+    stats_parser.add_argument(
+        "--pixel", help="Compute in pixels, for results on non-georeferenced rasters",
+        action="store_true")
+    stats_parser.add_argument(
+        "--bins", help="Edges of the bins of the area histogram (default: powers of 10)",
+        type=float, nargs='+', required=False)
+
+    # create the parser for the "daemon" command
+    daemon_parser = subparsers.add_parser(
+        'daemon', help="Keep a warm API client running in the background; other commands "
+        "are forwarded to it while it runs (note they then use the daemon's API key)")
+    daemon_parser.add_argument(
+        "--socket", help="Path of the Unix socket to listen on (default: "
+        "$PICTERRA_DAEMON_SOCKET, or picterra-<uid>.sock in $XDG_RUNTIME_DIR or /tmp)",
+        type=str, required=False)
+    return parser
+
+
+def _resolve_inputs(options):
+    """
+    Reads the IDs passed via stdin and expands the paths patterns, so that the
+    command no longer depends on the stdin and working directory of this process
+    """
+    if options.command == 'create' and options.create == 'raster':
+        options.path = _expand_paths(options.path)
+    if (
+        options.command == 'detect' or
+        (options.command == 'create' and options.create == 'annotation')
+    ):
+        options.raster_ids = _read_ids(options.raster)
+    if options.command == 'delete' and options.delete in ('raster', 'detector'):
+        options.ids = [i for value in getattr(options, options.delete) for i in _read_ids(value)]
+
+
+def _check_raster_name(parser, options):
+    """Fails early if the name template of several rasters cannot be formatted"""
+    if len(options.path) < 2:
+        return
+    try:
+        _raster_name(options.name, options.path, 0)
+    except (KeyError, IndexError, ValueError) as e:
+        parser.error('invalid --name template "%s": %s %s' % (
+            options.name, type(e).__name__, e))
+
+
+def _check_delete_options(parser, options):
+    """IDs and filters select what to delete, one way or the other"""
+    resource = options.delete
+    filters = [
+        '--%s' % name.replace('_', '-') for name in ('folder', 'status', 'name_prefix')
+        if getattr(options, name, None) is not None
+    ]
+    if filters and getattr(options, resource):
+        parser.error('%s IDs cannot be combined with %s' % (resource, ', '.join(filters)))
+    if not filters and not getattr(options, resource):
+        parser.error('the following arguments are required: %s (or a filter)' % resource)
+
+
+def _absolutize_paths(options):
+    """Makes the paths options absolute, for them to be used by a process in another directory"""
+    for attr in ('path', 'output_file', 'output_dir', 'manifest', 'state'):
+        value = getattr(options, attr, None)
+        if isinstance(value, list):
+            setattr(options, attr, [os.path.abspath(v) for v in value])
+        elif value is not None:
+            setattr(options, attr, os.path.abspath(value))
+    # Results are either files or operation IDs
+    if getattr(options, 'result', None) is not None and os.path.exists(options.result):
+        options.result = os.path.abspath(options.result)
+
+
+def _serve(options):
+    from . import daemon
+    from .client import APIClient, APIError
+    socket_path = options.socket or daemon.default_socket_path()
+    if daemon.is_running(socket_path):
+        raise APIError('A daemon is already listening on %s' % socket_path)
+    client = APIClient()
+    logger.info('Daemon listening on %s' % socket_path)
+    daemon.serve(
+        socket_path, lambda opts, out: _run_command(client, opts, out), daemon.fingerprint())
+
+
+def parse_args(args):
     # parse input
+    parser = _create_parser()
     options = parser.parse_args(args)
+    if options.command == 'delete' and options.delete in ('raster', 'detector'):
+        _check_delete_options(parser, options)
 
     # Verbosity increase (optional)
     if options.v:
         logging.basicConfig(level=logging.DEBUG)
 
-    # Create client and branch depending on command
-    if options.command:
-        client = APIClient()
+    if options.command == 'daemon':
+        _serve(options)
+    elif options.command:
+        _resolve_inputs(options)
+        if options.command == 'create' and options.create == 'raster':
+            _check_raster_name(parser, options)
+        status = None
+        if not options.no_daemon:
+            from . import daemon
+            forwarded = argparse.Namespace(**vars(options))
+            _absolutize_paths(forwarded)
+            status = daemon.forward(daemon.default_socket_path(), forwarded, sys.stdout)
+        if status is None:
+            # No daemon running: create client and branch depending on command
+            from .client import APIClient
+            _run_command(APIClient(), options, sys.stdout)
+        elif status[0] != 0:
+            sys.exit("\033[91m%s\033[00m" % status[1])
+    return options
+
+
+def _run_command(client, options, out):
+    """Runs a parsed command with the given client, printing its output to out"""
+    from .client import APIError
     if options.command == 'list':
         if options.list == 'rasters':
-            rasters = client.list_rasters(options.folder)
-            if options.output == 'ids_only':
-                for r in rasters:
-                    print(r['id'])
-            else:  # default json
-                print(json.dumps(rasters))
+            if options.output == 'ndjson':
+                _print_ndjson(client.iter_rasters(options.folder), out)
+            else:
+                rasters = client.list_rasters(options.folder)
+                if options.output == 'ids_only':
+                    for r in rasters:
+                        print(r['id'], file=out)
+                else:  # default json
+                    print(json.dumps(rasters), file=out)
         elif options.list == 'detectors':
-            print(json.dumps(client.list_detectors()))
+            if options.output == 'ndjson':
+                _print_ndjson(client.iter_detectors(), out)
+            elif options.output == 'ids_only':
+                for d in client.iter_detectors():
+                    print(d['id'], file=out, flush=True)
+            else:  # default json
+                print(json.dumps(client.list_detectors()), file=out)
     elif options.command == 'train':
         logger.info('Training %s ..' % options.detector)
         client.train_detector(options.detector)
     elif options.command == 'detect':
-        logger.info('Running %s on %s' % (options.detector, options.raster))
-        logger.debug('Starting detection..')
-        result_id = client.run_detector(options.detector, options.raster)
-        client.download_result_to_file(result_id, options.output_file)
-        logger.debug('Detection finished, writing result to %s' % options.output_file)
+        if options.raster == '-':
+            os.makedirs(options.output_file, exist_ok=True)
+
+            def detect(raster_id):
+                output_file = os.path.join(options.output_file, '%s.geojson' % raster_id)
+                _detect(client, options.detector, raster_id, output_file)
+                return output_file
+            for _, output_file in _run_concurrently(detect, options.raster_ids, options.jobs):
+                print(output_file, file=out, flush=True)
+        else:
+            _detect(client, options.detector, options.raster, options.output_file)
+    elif options.command == 'detect-matrix':
+        summaries = client.run_detector_matrix(
+            options.detector, options.raster, options.output_dir, options.jobs)
+        _print_matrix_summary(summaries, out)
+        failures = sum(1 for s in summaries if s['error'] is not None)
+        if failures:
+            raise APIError('%d of %d detections failed' % (failures, len(summaries)))
     elif options.command == 'create':
         if options.create == 'detector':
             if not (500 <= options.training_steps <= 40000):
@@ -171,53 +546,82 @@ def parse_args(args):
                 logger.debug('Added raster %s to %s detector' % (r, detector_id))
             tmp = (', and added %d rasters to it' % i) if i else ''
             logger.info('Created new detector whose id is %s%s' % (detector_id, tmp))
-            print(detector_id)  # return value
+            print(detector_id, file=out)  # return value
         elif options.create == 'raster':
-            logger.debug('Starting creation %sraster from %s and uploading to %s..' % (
-                ('\"%s\" ' % options.name) if options.name else '',
-                options.path,
-                options.folder)
-            )
-            raster_id = client.upload_raster(options.path, options.name, options.folder)
-            i = 0
-            for i, detector_id in enumerate(options.detector, 1):
-                client.add_raster_to_detector(raster_id, detector_id)
-                logger.debug('Added raster %s to %s detector' % (raster_id, detector_id))
-            tmp = (', and added to %d detectors' % i) if i else ''
-            logger.info('Created new raster whose id is %s%s' % (raster_id, tmp))
-            print(raster_id)  # return value
+            paths = options.path
+            logger.debug('Starting creation of %d raster(s) and uploading to %s..' % (
+                len(paths), options.folder))
+
+            def create(item):
+                index, path = item
+                return _create_raster(
+                    client, path, _raster_name(options.name, paths, index),
+                    options.folder, options.detector)
+            failures = 0
+            for (index, path), (raster_id, error) in _run_concurrently(
+                    create, list(enumerate(paths)), options.jobs):
+                if error is not None:
+                    failures += 1
+                    logger.error('Could not create raster from %s: %s' % (path, error))
+                if options.output == 'ndjson':
+                    report = {'path': path, 'raster_id': raster_id}
+                    if error is not None:
+                        report['error'] = str(error)
+                    print(json.dumps(report), file=out, flush=True)
+                elif raster_id is not None:
+                    print(raster_id, file=out, flush=True)  # return value
+            if failures:
+                raise APIError('%d of %d raster uploads failed' % (failures, len(paths)))
         elif options.create == 'annotation':
             logger.debug('Set new %s annotation on %s raster for %s detector from %s' % (
                 options.type, options.raster, options.detector, options.path))
-            with open(options.path) as json_file:
-                data = json.load(json_file)
-            client.set_annotations(options.detector, options.raster, options.type, data)
-            logger.info('Set new %s annotation on %s raster for %s detector' % (
-                options.type, options.raster, options.detector))
+
+            def set_annotations(raster_id):
+                # The file is streamed to the blobstore, never loaded
+                client.set_annotations_from_file(
+                    options.detector, raster_id, options.type, options.path)
+                logger.info('Set new %s annotation on %s raster for %s detector' % (
+                    options.type, raster_id, options.detector))
+            for _ in _run_concurrently(set_annotations, options.raster_ids, options.jobs):
+                pass
+        elif options.create == 'annotations':
+            uploads = _read_manifest(options.manifest)
+            state_file = options.state or '%s.state' % options.manifest
+            summaries = client.set_annotations_many(uploads, state_file, options.jobs)
+            _print_annotations_summary(summaries, out)
+            failures = sum(1 for s in summaries if s['status'] == 'failed')
+            if failures:
+                raise APIError('%d of %d annotation uploads failed' % (failures, len(summaries)))
         elif options.create == 'detection_area':
             logger.debug('Setting detection area on raster %s from %s..' % (
                 options.raster, options.path))
             client.set_raster_detection_areas_from_file(options.raster, options.path)
             logger.info('Created new detection area for raster whose id is %s' % options.raster)
+    elif options.command == 'stats':
+        from .results import result_stats
+        stats = result_stats(options.result, client, options.pixel, options.bins)
+        print(json.dumps(stats), file=out)
     elif options.command == 'delete':
-        if options.delete == 'raster':
-            client.delete_raster(options.raster)
-            logger.info('Deleted raster whose id was %s' % options.raster)
-        elif options.delete == 'detector':
-            client.delete_detector(options.detector)
-            logger.info('Deleted detector whose id was %s' % options.detector)
+        if options.delete in ('raster', 'detector'):
+            _delete(client, options, out)
         elif options.delete == 'detection_area':
             logger.debug('Removing detection area from raster %s..' % options.raster)
             client.remove_raster_detection_areas(options.raster)
             logger.info('Removed detection area for raster whose id is %s' % options.raster)
-    return options
+
+
+def _api_error_type():
+    # An APIError can only have been raised if the client module was imported
+    client = sys.modules.get('picterra.client')
+    return client.APIError if client is not None else ()
 
 
 def main():
     try:
         parse_args(sys.argv[1:])
-    except APIError as e:
+    except _api_error_type() as e:
         exit("\033[91m%s\033[00m" % e)
 
 
-main()
+if __name__ == '__main__':
+    main()
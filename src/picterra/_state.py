@@ -0,0 +1,23 @@
+"""
+JSON state files recording the progress of long-running jobs (e.g.
+`APIClient.set_annotations_many` and `picterra.sweep.run_sweep`), so that they resume
+where they stopped when run again
+"""
+import json
+import os
+
+
+def load_state(filename):
+    """The state saved in filename, empty if there is none"""
+    if filename is None or not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_state(filename, state):
+    # Written aside then renamed, not to leave a truncated state if interrupted
+    tmp_filename = '%s.tmp' % filename
+    with open(tmp_filename, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
@@ -1,11 +1,30 @@
+import base64
+import io
 import os
+import json
+import hashlib
+import math
+import tempfile
+import threading
 import time
+import uuid
+import zlib
 import requests
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from urllib.parse import urljoin, urlencode
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+from ._state import load_state, save_state
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
 
 logger = logging.getLogger()
 
@@ -15,17 +34,221 @@ class APIError(Exception):
     pass
 
 
+class CircuitOpenError(APIError):
+    """
+    The API failed repeatedly and is considered down: requests fail right away,
+    without being sent, until it is tried again after a cool-down
+    """
+    pass
+
+
+# Methods changing the server state, sent with an idempotency key so that they can be retried
+_MUTATING_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# Responses telling that the server is overloaded (throttling or gateway problems)
+_OVERLOAD_STATUSES = (429, 502, 503, 504)
+
+# Exceptions telling that the server could not be reached or did not answer in time, as
+# opposed to the client side ones (e.g. an invalid URL) which say nothing of its health
+_SERVER_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.RetryError)
+
+
+class _ConcurrencyLimiter():
+    """
+    Limits the number of requests in flight with an AIMD (additive increase,
+    multiplicative decrease) algorithm: the limit is halved when a request is throttled,
+    fails with a server error, had to be retried or is much slower than usual, and is
+    increased by one once a limit's worth of requests succeeded in a row
+    """
+    def __init__(self, max_limit=16, min_limit=1, slow_factor=4, min_slow_latency=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        # A request is slow if it takes slow_factor times the average latency, and at
+        # least min_slow_latency seconds (so that fast requests jitter is not a signal)
+        self.slow_factor = slow_factor
+        self.min_slow_latency = min_slow_latency
+        self.limit = max_limit
+        self.in_flight = 0
+        self.latency = None
+        self._condition = threading.Condition()
+        self._successes = 0
+        # Requests are numbered to only decrease the limit once per congestion event: the
+        # requests started before a decrease do not decrease it again
+        self._started = 0
+        self._last_decrease = 0
+
+    def acquire(self):
+        """Waits for a slot and returns the request number"""
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+            self._started += 1
+            return self._started
+
+    def release(self, number, latency, overloaded):
+        with self._condition:
+            self.in_flight -= 1
+            slow = self.latency is not None and latency > max(
+                self.min_slow_latency, self.slow_factor * self.latency)
+            if not overloaded:
+                # Exponentially weighted moving average of the normal latencies
+                self.latency = latency if self.latency is None else (
+                    0.9 * self.latency + 0.1 * latency)
+            if overloaded or slow:
+                self._successes = 0
+                if number > self._last_decrease and self.limit > self.min_limit:
+                    self._last_decrease = self._started
+                    self.limit = max(self.min_limit, self.limit // 2)
+                    logger.warning('API %s, lowering the concurrency limit to %d' % (
+                        'overloaded' if overloaded else 'slowing down', self.limit))
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_limit:
+                    self._successes = 0
+                    self.limit += 1
+                    logger.debug('Raising the API concurrency limit to %d' % self.limit)
+            self._condition.notify_all()
+
+    def cancel(self):
+        """Frees the slot of a request which failed on the client side, before reaching the API"""
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+
+class _CircuitBreaker():
+    """
+    Opens after failure_threshold consecutive failures (server errors, throttling or
+    connection problems), failing the requests right away; after reset_timeout seconds a
+    single request is let through to probe the API, closing the circuit if it succeeds
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        with self._lock:
+            if self.state == 'closed':
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if self.state == 'open' and remaining <= 0:
+                # Let this request probe the API, the others keep failing fast
+                self.state = 'half-open'
+                return
+            if self.state == 'half-open':
+                raise CircuitOpenError(
+                    'The API failed %d times in a row, not sending requests until it '
+                    'answers the one probing it' % self.failures)
+            raise CircuitOpenError(
+                'The API failed %d times in a row, not sending requests for %d seconds' % (
+                    self.failures, math.ceil(remaining)))
+
+    def cancel(self):
+        """Forgets a request which failed on the client side, before reaching the API"""
+        with self._lock:
+            if self.state == 'half-open':
+                # The probe told nothing: let the next request probe the API again
+                self.state = 'open'
+
+    def after_request(self, failed):
+        with self._lock:
+            if not failed:
+                if self.state != 'closed':
+                    logger.info('API is back, closing the circuit breaker')
+                self.state = 'closed'
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.warning('API failed %d times in a row, opening the circuit breaker '
+                                   'for %d seconds' % (self.failures, self.reset_timeout))
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+
 class _RequestsSession(requests.Session):
     """
-    Override requests session to to implement a global session timeout
+    Override requests session to to implement a global session timeout, and to send a
+    new Idempotency-Key header with each mutating request: the retries of a request
+    reuse its headers, so the server can tell them from new requests and answer them
+    with the outcome of the first one instead of repeating it.
+
+    The requests also go through an adaptive concurrency limiter and a circuit breaker,
+    so that concurrent jobs back off when the server degrades instead of piling up
+    retries, and fail fast while it is down.
     """
     def __init__(self, *args, **kwargs):
         self.timeout = kwargs.pop('timeout')
+        max_concurrency = kwargs.pop('max_concurrency', 16)
         super().__init__(*args, **kwargs)
+        self.limiter = _ConcurrencyLimiter(max_concurrency)
+        self.breaker = _CircuitBreaker()
+        self.counts = {'requests': 0, 'overloaded': 0, 'failed': 0, 'rejected': 0}
+        self._counts_lock = threading.Lock()
+
+    def _count(self, name):
+        with self._counts_lock:
+            self.counts[name] += 1
 
-    def request(self, *args, **kwargs):
+    def request(self, method, url, *args, **kwargs):
         kwargs.setdefault('timeout', self.timeout)
-        return super().request(*args, **kwargs)
+        if method.upper() in _MUTATING_METHODS:
+            headers = dict(kwargs.get('headers') or {})
+            headers.setdefault('Idempotency-Key', str(uuid.uuid4()))
+            kwargs['headers'] = headers
+        try:
+            self.breaker.before_request()
+        except CircuitOpenError:
+            self._count('rejected')
+            raise
+        number = self.limiter.acquire()
+        self._count('requests')
+        start = time.monotonic()
+        try:
+            resp = super().request(method, url, *args, **kwargs)
+        except _SERVER_ERRORS:
+            self._record(number, start, None)
+            raise
+        except BaseException:
+            # Not the API's fault (e.g. a missing schema or an invalid URL), so it neither
+            # lowers the concurrency limit nor counts toward opening the circuit
+            self.limiter.cancel()
+            self.breaker.cancel()
+            raise
+        self._record(number, start, resp)
+        return resp
+
+    def _record(self, number, start, resp):
+        """Reports the outcome of a request, None if the API could not be reached"""
+        failed = resp is None or resp.status_code >= 500 or resp.status_code == 429
+        # The retries urllib3 made before getting the response are a congestion signal
+        retries = getattr(getattr(resp, 'raw', None), 'retries', None)
+        overloaded = failed or resp.status_code in _OVERLOAD_STATUSES or bool(
+            retries is not None and retries.history)
+        self.limiter.release(number, time.monotonic() - start, overloaded)
+        self.breaker.after_request(failed)
+        if overloaded:
+            self._count('overloaded')
+        if failed:
+            self._count('failed')
+
+    def stats(self):
+        with self._counts_lock:
+            stats = dict(self.counts)
+        stats.update({
+            'concurrency_limit': self.limiter.limit,
+            'max_concurrency': self.limiter.max_limit,
+            'in_flight': self.limiter.in_flight,
+            'latency': self.limiter.latency,
+            'circuit': self.breaker.state,
+        })
+        return stats
 
 
 def validate_detector_args(detection_type: str, output_type: str, training_steps: int):
@@ -52,11 +275,236 @@ def validate_detector_args(detection_type: str, output_type: str, training_steps
             )
 
 
+def _count_features(filename):
+    """Number of features (or polygons of a MultiPolygon) of a GeoJSON result file"""
+    with open(filename) as f:
+        data = json.load(f)
+    if data.get('type') == 'FeatureCollection':
+        return len(data['features'])
+    if data.get('type', '').startswith('Multi'):
+        return len(data['coordinates'])
+    return 1
+
+
+# Annotations are serialized in memory up to this size, then in a temporary file
+_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+_CHUNK_SIZE = 1024 * 1024
+
+_ACCEPT_ENCODING = 'gzip, deflate' + (', zstd' if zstandard is not None else '')
+
+
+def validate_annotation_type(annotation_type: str):
+    """Returns the lower-cased annotation type, raising ValueError if it is invalid"""
+    annotation_type = annotation_type.lower()
+    valid_annotations = ('outline', 'training_area', 'testing_area', 'validation_area')
+    if annotation_type not in valid_annotations:
+        raise ValueError('Invalid annotation type "%s"; allowed values are: %s.' % (
+            annotation_type, ', '.join(valid_annotations)))
+    return annotation_type
+
+
+def _compressor(compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compressobj()
+    # wbits=31 for the gzip container
+    return zlib.compressobj(wbits=31)
+
+
+def _iter_chunks(data):
+    """The content of a byte memoryview or of a binary file, chunk by chunk"""
+    if isinstance(data, memoryview):
+        for start in range(0, len(data), _CHUNK_SIZE):
+            yield data[start:start + _CHUNK_SIZE]
+    else:
+        yield from iter(lambda: data.read(_CHUNK_SIZE), b'')
+
+
+def _compress(data, out, compression):
+    """Compresses a byte memoryview or a binary file to out, chunk by chunk; returns its size"""
+    compressor = _compressor(compression)
+    size = 0
+    for chunk in _iter_chunks(data):
+        size += len(chunk)
+        out.write(compressor.compress(chunk))
+    out.write(compressor.flush())
+    return size
+
+
+def _is_seekable(f):
+    """Whether the binary file f can be rewound"""
+    # SpooledTemporaryFile has no seekable method before Python 3.11
+    if isinstance(f, tempfile.SpooledTemporaryFile):
+        return True
+    return getattr(f, 'seekable', lambda: False)()
+
+
+@contextmanager
+def _open_upload(source):
+    """
+    Yields the data to upload from a filename (str or path-like), a bytes-like object
+    or a binary file: bytes-like objects, including bytes (and the rest of io.BytesIO
+    files), are given as flat byte memoryviews, so that they are sent to the socket
+    without being copied
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            logger.debug('Opening file %s' % source)
+            yield f
+        return
+    start = 0
+    if isinstance(source, io.BytesIO):
+        buffer, start = source.getbuffer(), source.tell()
+    else:
+        try:
+            buffer = memoryview(source)
+        except TypeError:  # a binary file
+            yield source
+            return
+    with buffer:
+        if not buffer.c_contiguous:
+            raise ValueError('Cannot upload a non-contiguous buffer, make a contiguous copy first')
+        with buffer.cast('B') as flat, flat[start:] as view:
+            yield view
+
+
+def _md5(data):
+    """
+    Base64 MD5 digest of a byte memoryview or of the rest of a seekable binary file,
+    which is then rewound; None for the other files as they can only be read once
+    """
+    h = hashlib.md5()
+    if isinstance(data, memoryview):
+        h.update(data)
+    elif _is_seekable(data):
+        start = data.tell()
+        for chunk in _iter_chunks(data):
+            h.update(chunk)
+        data.seek(start)
+    else:
+        return None
+    return base64.b64encode(h.digest()).decode('ascii')
+
+
+class _SizedReader():
+    """
+    A binary file with a known length to upload: requests sends it with a Content-Length
+    instead of chunked, and does not look for its length by itself (which would call
+    its fileno, writing a spooled temporary file to disk)
+    """
+    def __init__(self, f, length):
+        self.f = f
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+
+def _put(upload_url, data, length=None, checksum=False, headers=None):
+    """
+    PUTs a byte memoryview or a binary file to the blobstore, with its length if it is
+    known (given, or computed from a seekable file) and optionally a Content-MD5 header
+    """
+    headers = dict(headers or {})
+    if checksum:
+        md5 = _md5(data)
+        if md5 is None:
+            logger.warning('Cannot compute the checksum of a stream which is not seekable')
+        else:
+            headers['Content-MD5'] = md5
+    if not isinstance(data, memoryview):
+        if length is None and _is_seekable(data):
+            start = data.tell()
+            length = data.seek(0, io.SEEK_END) - start
+            data.seek(start)
+        if length is not None:
+            data = _SizedReader(data, length)
+    # Given we do not use self.sess the timeout is disabled (requests default), and this
+    # is good as file upload can take a long time
+    return requests.put(upload_url, data=data, headers=headers)
+
+
+def _iter_decoded_content(r):
+    """
+    The decompressed content of a streamed response: requests decodes gzip and deflate,
+    zstd is decoded here
+    """
+    if r.headers.get('Content-Encoding', '').strip().lower() != 'zstd':
+        for chunk in r.iter_content(chunk_size=_CHUNK_SIZE):
+            if chunk:  # filter out keep-alive new chunks
+                yield chunk
+        return
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    for chunk in r.raw.stream(_CHUNK_SIZE, decode_content=False):
+        chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+
+
+class _ChunksReader(io.RawIOBase):
+    """Binary file reading an iterator of bytes chunks, e.g. `_iter_decoded_content`"""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._chunk:
+            self._chunk = memoryview(next(self._chunks, b''))
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+def _dump_annotations(annotations, f):
+    """Serializes annotations to a binary file, one feature at a time"""
+    from .geojson import dump_features
+
+    def write(text):
+        f.write(text.encode('utf-8'))
+    if not isinstance(annotations, dict):
+        dump_features(annotations, write)
+    elif annotations.get('type') == 'FeatureCollection':
+        members = {k: v for k, v in annotations.items() if k not in ('type', 'features')}
+        dump_features(annotations['features'], write, members=members)
+    else:
+        write(json.dumps(annotations))
+
+
+@contextmanager
+def _open_annotations(upload):
+    """Yields a binary file with the serialized annotations of a set_annotations_many upload"""
+    if 'filename' in upload:
+        with open(upload['filename'], 'rb') as f:
+            yield f
+    else:
+        with tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE) as f:
+            _dump_annotations(upload['annotations'], f)
+            f.seek(0)
+            yield f
+
+
+def _sha256(f):
+    """SHA-256 hex digest of the content of the binary file f, which is then rewound"""
+    h = hashlib.sha256()
+    for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+        h.update(chunk)
+    f.seek(0)
+    return h.hexdigest()
+
+
 class APIClient():
     """Main client class for the Picterra API"""
     def __init__(
         self, api_key: str = '', base_url: str = '',
-        timeout: int = 30, max_retries: int = 3, backoff_factor: int = 10
+        timeout: int = 30, max_retries: int = 3, backoff_factor: int = 10,
+        compression: str = None, max_concurrency: int = 16, status_cache: str = None
     ):
         """
         Args:
@@ -67,7 +515,24 @@ class APIClient():
             max_retries: max attempts when ecountering gateway issues or throttles; see
                          retry_strategy comment below
             backoff_factor: factor used nin the backoff algorithm; see retry_strategy comment below
+            compression: 'gzip' or 'zstd' (requires the zstandard package) to compress the
+                         GeoJSON uploads (annotations and detection areas); uploads are sent
+                         uncompressed if the storage rejects the compressed ones with a 4xx
+                         response (other errors, e.g. a 5xx for an unsupported
+                         Content-Encoding, are returned as they are)
+            max_concurrency: max number of API requests in flight at once, across threads;
+                             the actual limit adapts to the server load, see `session_stats`
+            status_cache: path of a SQLite database where the operations statuses are shared
+                          with the other processes using it, so that a single one polls each
+                          operation (see `picterra.status_cache`)
         """
+        if compression not in (None, 'gzip', 'zstd'):
+            raise ValueError('Invalid compression "%s", choose one of gzip, zstd' % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        self.compression = compression
+        # Guards the switch to uncompressed uploads, which concurrent uploads may all ask for
+        self._compression_lock = threading.Lock()
         if base_url is None:
             base_url = os.environ.get('PICTERRA_BASE_URL', 'https://app.picterra.ch/public/api/v2/')
         if api_key is None:
@@ -82,23 +547,133 @@ class APIClient():
         self.base_url = base_url
         # Create the session with a default timeout (30 sec), that we can then
         # override on a per-endpoint basis (will be disabled for file uploads and downloads)
-        self.sess = _RequestsSession(timeout=timeout)
+        self.sess = _RequestsSession(timeout=timeout, max_concurrency=max_concurrency)
         # Retry: we set the HTTP codes for our throttle ($29) plus possible gateway problems (50*),
-        # and for polling methods (GET), as non-idempotent ones should be addressed via idempotency
-        # key mechanism; given the algorithm is {<backoff_factor> * (2 **<retries-1>}, and we
-        # default to 30s for polling and max 30 req/min, the default 5-10-20 sequence should
-        # provide enough room for recovery
+        # for polling methods (GET) as well as for the non-idempotent ones, which the session
+        # sends with an idempotency key; given the algorithm is
+        # {<backoff_factor> * (2 **<retries-1>}, and we default to 30s for polling and max
+        # 30 req/min, the default 5-10-20 sequence should provide enough room for recovery
         retry_strategy = Retry(
             total=max_retries,
             status_forcelist=[429, 502, 503, 504],
             backoff_factor=backoff_factor,
-            method_whitelist=["GET"]
+            method_whitelist=["GET"] + list(_MUTATING_METHODS)
         )
         adapter = HTTPAdapter(max_retries=retry_strategy)
         self.sess.mount("https://", adapter)
         self.sess.mount("http://", adapter)
         # Authentication
         self.sess.headers.update({'X-Api-Key': api_key})
+        self._webhook = None
+        self._webhook_deadline = None
+        self._webhook_missed = False
+        self._status_cache = None
+        if status_cache is not None:
+            from .status_cache import OperationStatusCache
+            self._status_cache = OperationStatusCache(status_cache)
+            # Identifies the polls of this client among the users of the cache
+            self._cache_owner = '%d-%s' % (os.getpid(), uuid.uuid4().hex)
+
+    def start_webhook_receiver(
+        self, host: str = '127.0.0.1', port: int = 0, public_url: str = None,
+        deadline: float = 60
+    ):
+        """
+        Starts a local HTTP receiver for the operations completion callbacks: its URL is
+        sent in the X-Callback-Url header of the requests submitting operations, and the
+        callers waiting for an operation (e.g. `run_detector`) return as soon as the
+        server notifies its completion, without polling its status.
+
+        An operation without a callback within the deadline is polled at its usual
+        interval, and so are the next operations, right away, until a callback is
+        received again: a server ignoring the callbacks only delays the first operation.
+
+        Args:
+            host (str): Address to listen on
+            port (int): Port to listen on, 0 for any free port
+            public_url (str): URL under which the server reaches the receiver, if not the
+                local address (e.g. through a tunnel)
+            deadline (float): Number of seconds to wait for the callback of an operation
+                before polling its status
+
+        Returns:
+            The URL of the receiver
+        """
+        from .webhook import WebhookReceiver
+        self.stop_webhook_receiver()
+        self._webhook = WebhookReceiver(host, port, public_url)
+        self._webhook_deadline = deadline
+        self._webhook_missed = False
+        return self._webhook.url
+
+    def stop_webhook_receiver(self):
+        """Stops the receiver started by `start_webhook_receiver`, polling operations again"""
+        if self._webhook is None:
+            return
+        self._webhook.close()
+        self._webhook = None
+
+    def session_stats(self):
+        """
+        Returns the state of the API session, for instrumentation
+
+        Returns:
+            A dictionary, for example:
+
+            ::
+
+                {
+                    'requests': 120,  # requests sent
+                    'overloaded': 3,  # requests throttled, retried or failed with a 5xx
+                    'failed': 1,  # requests failed with a 5xx or a connection error
+                    'rejected': 0,  # requests not sent as the circuit breaker was open
+                    'concurrency_limit': 8,  # requests allowed in flight at the moment
+                    'max_concurrency': 16,
+                    'in_flight': 2,
+                    'latency': 0.31,  # moving average of the latency, in seconds
+                    'circuit': 'closed'  # or 'open' or 'half-open'
+                }
+        """
+        return self.sess.stats()
+
+    def _upload_to_blobstore(self, upload_url, f, length=None, checksum=False):
+        """
+        PUTs a byte memoryview or the content of the binary file f to upload_url (see
+        `_put`), compressed if enabled; if the storage rejects the compressed upload with a
+        4xx response, it is sent again uncompressed if f can be rewound, and so are the
+        next ones (a 5xx response is returned as it is, whatever its cause)
+        """
+        # Read once, as a concurrent upload may disable compression in the meantime
+        compression = self.compression
+        if compression is not None:
+            seekable = isinstance(f, memoryview) or _is_seekable(f)
+            start = f.tell() if not isinstance(f, memoryview) and seekable else None
+            with tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE) as compressed:
+                size = _compress(f, compressed, compression)
+                compressed_size = compressed.tell()
+                compressed.seek(0)
+                resp = _put(
+                    upload_url, compressed, compressed_size, checksum=checksum,
+                    headers={'Content-Encoding': compression})
+            if resp.ok:
+                logger.info('Uploaded %d bytes compressed to %d with %s (%d bytes saved)' % (
+                    size, compressed_size, compression, size - compressed_size))
+                return resp
+            if not 400 <= resp.status_code < 500:
+                return resp
+            with self._compression_lock:
+                # Only the first of the uploads rejected concurrently disables it
+                if self.compression == compression:
+                    logger.warning(
+                        'The storage rejected a %s compressed upload (%d: %s), '
+                        'disabling compression' % (compression, resp.status_code, resp.text))
+                    self.compression = None
+            if not seekable:
+                # The stream was consumed, it cannot be uploaded again
+                return resp
+            if start is not None:
+                f.seek(start)
+        return _put(upload_url, f, length, checksum)
 
     def _api_url(self, path, params=None):
         base_url = urljoin(self.base_url, path)
@@ -111,28 +686,88 @@ class APIClient():
     def _wait_until_operation_completes(self, operation_response):
         operation_id = operation_response['operation_id']
         poll_interval = operation_response['poll_interval']
+        webhook = self._webhook
+        if webhook is not None and not self._webhook_missed:
+            status = webhook.wait(operation_id, self._webhook_deadline)
+            if status is not None:
+                return self._webhook_completed(operation_id, status)
+            logger.warning(
+                'No callback for operation %s after %s seconds, polling it and the next '
+                'operations until a callback is received' % (
+                    operation_id, self._webhook_deadline))
+            self._webhook_missed = True
         # Just sleep for a short while the first time
-        time.sleep(poll_interval * 0.1)
+        delay = poll_interval * 0.1
         while True:
-            logger.info('Polling operation id %s' % operation_id)
-            resp = self.sess.get(
-                self._api_url('operations/%s/' % operation_id),
-            )
-            if not resp.ok:
-                raise APIError(resp.text)
-            status = resp.json()['status']
-            logger.info('status=%s' % status)
-            if status == 'success':
+            if webhook is None:
+                time.sleep(delay)
+            else:
+                # A late callback still ends the sleep early
+                status = webhook.wait(operation_id, delay)
+                if status is not None:
+                    return self._webhook_completed(operation_id, status)
+            if self._operation_completed(operation_id):
                 break
-            if status == 'failed':
-                raise APIError('Operation %s failed' % operation_id)
-            time.sleep(poll_interval)
+            delay = poll_interval
+        if webhook is not None:
+            # Drop the callback the server may still send
+            webhook.wait(operation_id, 0)
+
+    def _webhook_completed(self, operation_id, status):
+        # The server sends callbacks (again), the next operations wait for theirs
+        self._webhook_missed = False
+        if status == 'failed':
+            raise APIError('Operation %s failed' % operation_id)
+
+    def _post_operation(self, url, **kwargs):
+        """
+        POSTs a request submitting an operation, with the URL of the webhook receiver
+        (if started) for the server to notify its completion
+        """
+        if self._webhook is not None:
+            kwargs['headers'] = dict(kwargs.get('headers') or {})
+            kwargs['headers']['X-Callback-Url'] = self._webhook.url
+        return self.sess.post(url, **kwargs)
 
-    def _paginate_through_list(self, resource_endpoint: str, params=None):
+    def _operation_completed(self, operation_id):
+        """
+        Polls an operation once: False if it is still running, raises if it failed; with
+        a status cache, the operation is only polled if no other process is polling it
+        """
+        cache = self._status_cache
+        if cache is None:
+            status = self._poll_operation(operation_id)
+        else:
+            leased, status = cache.acquire(operation_id, self._cache_owner)
+            if leased:
+                try:
+                    status = self._poll_operation(operation_id)
+                except BaseException:
+                    cache.release(operation_id, self._cache_owner)
+                    raise
+                cache.update(operation_id, status, self._cache_owner)
+            else:
+                logger.info('Operation id %s cached status=%s' % (operation_id, status))
+        if status == 'failed':
+            raise APIError('Operation %s failed' % operation_id)
+        return status == 'success'
+
+    def _poll_operation(self, operation_id):
+        logger.info('Polling operation id %s' % operation_id)
+        resp = self.sess.get(
+            self._api_url('operations/%s/' % operation_id),
+        )
+        if not resp.ok:
+            raise APIError(resp.text)
+        status = resp.json()['status']
+        logger.info('status=%s' % status)
+        return status
+
+    def _iterate_through_list(self, resource_endpoint: str, params=None):
+        """Yields the items of a paginated resource list, one page at a time"""
         if params is None:
             params = {}
         params['page_number'] = 1
-        data = []
         url = self._api_url('%s/' % resource_endpoint, params=params)
         while url:
             logger.debug('Fetching page url=%s', url)
@@ -141,21 +776,35 @@ class APIClient():
                 raise APIError(resp.text)
             r = resp.json()
             url = r['next']
-            data += r['results']
-        return data
+            yield from r['results']
+
+    def _paginate_through_list(self, resource_endpoint: str, params=None):
+        return list(self._iterate_through_list(resource_endpoint, params))
 
-    def upload_raster(self, filename: str, name: str, folder_id=None, captured_at=None):
+    def upload_raster(
+        self, filename, name: str, folder_id=None, captured_at=None, length=None,
+        checksum=False
+    ):
         """
         Upload a raster to picterra.
 
         Args:
-            filename (str): Local filename of raster to upload
+            filename: Local filename of raster to upload (str or path-like, a bytes
+                filename must be decoded with os.fsdecode), or its content as a
+                bytes-like object (e.g. bytes, a numpy array or a mmap, sent without
+                being copied) or a binary file object (e.g. io.BytesIO or a pipe), read
+                from its current position
             name (str): A human-readable name for this raster
             folder_id (optional, str): Id of the folder this raster
                 belongs to.
             captured_at (optional, str): ISO-8601 date and time at which this
                 raster was captured, YYYY-MM-DDThh:mm[:ss[.uuuuuu]][+HH:MM|-HH:MM|Z];
                 e.g. "2020-01-01T12:34:56.789Z"
+            length (optional, int): Number of bytes of a file object which is not seekable,
+                for it to be sent with a Content-Length rather than chunked
+            checksum (optional, bool): Whether to send the MD5 of the content in a
+                Content-MD5 header, for the storage to check its integrity (not possible
+                for file objects which are not seekable)
 
         Returns:
             raster_id (str): The id of the uploaded raster
@@ -181,16 +830,13 @@ class APIClient():
         upload_url = data["upload_url"]
         raster_id = data["raster_id"]
 
-        with open(filename, 'rb') as f:
-            logger.debug('Opening raster file %s' % filename)
-            # Given we do not use self.sess the timeout is disabled (requests default), and this
-            # is good as file upload can take a long time
-            resp = requests.put(upload_url, data=f)
+        with _open_upload(filename) as data:
+            resp = _put(upload_url, data, length, checksum)
         if not resp.ok:
             logger.error('Error when uploading to blobstore %s' % upload_url)
             raise APIError(resp.text)
 
-        resp = self.sess.post(self._api_url('rasters/%s/commit/' % raster_id))
+        resp = self._post_operation(self._api_url('rasters/%s/commit/' % raster_id))
         if not resp.ok:
             raise APIError(resp.text)
         self._wait_until_operation_completes(resp.json())
@@ -227,6 +873,20 @@ class APIClient():
         params = {'folder': folder_id} if folder_id else {}
         return self._paginate_through_list('rasters', params)
 
+    def iter_rasters(self, folder_id=None):
+        """
+        Same as `list_rasters`, but yields the rasters metadata as each page of
+        the list is fetched instead of waiting for the whole list
+
+        Args:
+            folder_id (str, optional): The id of the folder to search rasters in
+
+        Returns:
+            An iterator over rasters dictionaries
+        """
+        params = {'folder': folder_id} if folder_id else {}
+        return self._iterate_through_list('rasters', params)
+
     def delete_raster(self, raster_id):
         """
         Deletes a given raster by its identifier
@@ -242,7 +902,55 @@ class APIClient():
         if not resp.ok:
             raise APIError(resp.text)
 
-    def set_raster_detection_areas_from_file(self, raster_id, filename):
+    def delete_rasters(self, raster_ids, max_workers: int = 8, dry_run: bool = False):
+        """
+        Deletes many rasters concurrently, see `delete_raster`
+
+        Duplicated ids are only deleted once. A failing deletion does not interrupt
+        the others: its error is reported in the summary.
+
+        Args:
+            raster_ids (list of str): The ids of the rasters to delete
+            max_workers (int): Maximum number of deletions running at once
+            dry_run (bool): If True, nothing is deleted and the summary only lists the
+                rasters that would be
+
+        Returns:
+            A list with a summary dictionary per raster, in the same order, where
+            status is one of 'deleted', 'dry_run' or 'failed', for example:
+
+            ::
+
+                {'id': '42', 'status': 'deleted', 'error': None}
+        """
+        return self._delete_many('raster', self.delete_raster, raster_ids, max_workers, dry_run)
+
+    def _delete_many(self, resource, delete, ids, max_workers, dry_run):
+        def run(resource_id):
+            summary = {'id': resource_id, 'status': 'dry_run', 'error': None}
+            if dry_run:
+                return summary
+            try:
+                delete(resource_id)
+                summary['status'] = 'deleted'
+            except (APIError, requests.RequestException) as e:
+                logger.error('Deleting %s %s failed: %s' % (resource, resource_id, e))
+                summary['status'] = 'failed'
+                summary['error'] = str(e)
+            return summary
+
+        ids = list(OrderedDict.fromkeys(ids))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            summaries = list(executor.map(run, ids))
+        logger.info('%s %d %ss, %d failed' % (
+            'Would delete' if dry_run else 'Deleted',
+            sum(1 for s in summaries if s['status'] != 'failed'), resource,
+            sum(1 for s in summaries if s['status'] == 'failed')))
+        return summaries
+
+    def set_raster_detection_areas_from_file(
+        self, raster_id, filename, length=None, checksum=False
+    ):
         """
         This is an experimental feature
 
@@ -250,8 +958,11 @@ class APIClient():
 
         Args:
             raster_id (str): The id of the raster to which to assign the detection areas
-            filename (str): The filename of a GeoJSON file. This should contain a FeatureCollection
-                            of Polygon/MultiPolygon
+            filename: The filename of a GeoJSON file. This should contain a FeatureCollection
+                      of Polygon/MultiPolygon. Its content can also be given as a bytes-like
+                      or a binary file object, see `upload_raster`
+            length (int): Number of bytes of a file object which is not seekable
+            checksum (bool): Whether to send the MD5 of the content in a Content-MD5 header
 
         Raises:
             APIError: There was an error uploading the file to cloud storage
@@ -264,13 +975,13 @@ class APIClient():
         upload_url = data['upload_url']
         upload_id = data['upload_id']
         # Upload to blobstore
-        with open(filename, 'rb') as f:
-            resp = requests.put(upload_url, data=f)
+        with _open_upload(filename) as data:
+            resp = self._upload_to_blobstore(upload_url, data, length, checksum)
         if not resp.ok:
             raise APIError(resp.text)
 
         # Commit upload
-        resp = self.sess.post(
+        resp = self._post_operation(
             self._api_url('rasters/%s/detection_areas/upload/%s/commit/' % (raster_id, upload_id))
         )
         if not resp.ok:
@@ -384,6 +1095,16 @@ class APIClient():
         """
         return self._paginate_through_list('detectors')
 
+    def iter_detectors(self):
+        """
+        Same as `list_detectors`, but yields the detectors as each page of
+        the list is fetched instead of waiting for the whole list
+
+        Returns:
+            An iterator over detectors dictionaries
+        """
+        return self._iterate_through_list('detectors')
+
     def edit_detector(
         self, detector_id: str,
         name: str = '', detection_type: str = '', output_type: str = '', training_steps: int = 0
@@ -437,6 +1158,22 @@ class APIClient():
         if not resp.ok:
             raise APIError(resp.text)
 
+    def delete_detectors(self, detector_ids, max_workers: int = 8, dry_run: bool = False):
+        """
+        Deletes many detectors concurrently, see `delete_detector` and `delete_rasters`
+
+        Args:
+            detector_ids (list of str): The ids of the detectors to delete
+            max_workers (int): Maximum number of deletions running at once
+            dry_run (bool): If True, nothing is deleted and the summary only lists the
+                detectors that would be
+
+        Returns:
+            A list with a summary dictionary per detector, as for `delete_rasters`
+        """
+        return self._delete_many(
+            'detector', self.delete_detector, detector_ids, max_workers, dry_run)
+
     def run_detector(self, detector_id: str, raster_id: str) -> str:
         """
         Runs a detector on a raster
@@ -449,15 +1186,80 @@ class APIClient():
             result_id (str): The id of the result. You typically want to pass this
                 to `download_results_to_file`
         """
-        resp = self.sess.post(
+        resp = self._post_operation(
             self._api_url('detectors/%s/run/' % detector_id),
             json={'raster_id': raster_id}
         )
-        assert resp.status_code == 201, resp.status_code
+        if not resp.ok:
+            raise APIError(resp.text)
         operation_response = resp.json()
         self._wait_until_operation_completes(operation_response)
         return operation_response['operation_id']
 
+    def run_detector_matrix(
+        self, detector_ids, raster_ids, output_dir: str, max_workers: int = 4
+    ):
+        """
+        Runs every detector on every raster, downloading each result to
+        `<output_dir>/<detector_id>/<raster_id>.geojson`
+
+        Duplicated detector or raster ids are only run once. A failing pair
+        does not interrupt the others: its error is reported in the summary.
+
+        Args:
+            detector_ids (list of str): The ids of the detectors
+            raster_ids (list of str): The ids of the rasters
+            output_dir (str): Directory where the results are saved
+            max_workers (int): Maximum number of detections running at once
+
+        Returns:
+            A list with a summary dictionary per (detector, raster) pair, ordered
+            by detector then raster, for example:
+
+            ::
+
+                {
+                    'detector_id': '42',
+                    'raster_id': '43',
+                    'filename': 'results/42/43.geojson',
+                    'seconds': 61.7,
+                    'feature_count': 120,
+                    'error': None
+                }
+        """
+        pairs = [
+            (d, r) for d in OrderedDict.fromkeys(detector_ids)
+            for r in OrderedDict.fromkeys(raster_ids)
+        ]
+
+        def run(pair):
+            detector_id, raster_id = pair
+            filename = os.path.join(output_dir, str(detector_id), '%s.geojson' % raster_id)
+            summary = {
+                'detector_id': detector_id, 'raster_id': raster_id, 'filename': filename,
+                'seconds': None, 'feature_count': None, 'error': None
+            }
+            start = time.time()
+            try:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                operation_id = self.run_detector(detector_id, raster_id)
+                self.download_result_to_file(operation_id, filename)
+                summary['feature_count'] = _count_features(filename)
+            except (APIError, OSError, ValueError, requests.RequestException) as e:
+                logger.error('Running %s on %s failed: %s' % (detector_id, raster_id, e))
+                summary['error'] = str(e)
+            summary['seconds'] = time.time() - start
+            return summary
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(run, pairs))
+
+    def _result_url(self, operation_id):
+        resp = self.sess.get(
+            self._api_url('operations/%s/' % operation_id),
+        )
+        return resp.json()['results']['url']
+
     def download_result_to_file(self, operation_id, filename):
         """
         Downloads a set of results to a local GeoJSON file
@@ -466,37 +1268,220 @@ class APIClient():
             result_id (str): The id of the result to download
             filename (str): The local filename where to save the results
         """
-        resp = self.sess.get(
-            self._api_url('operations/%s/' % operation_id),
-        )
-        result_url = resp.json()['results']['url']
+        result_url = self._result_url(operation_id)
         logger.debug('Trying to download result %s..' % result_url)
         # Given we do not use self.sess the timeout is disabled (requests default), and this
         # is good as file download can take a long time
-        with requests.get(result_url, stream=True) as r:
+        with requests.get(
+            result_url, stream=True, headers={'Accept-Encoding': _ACCEPT_ENCODING}
+        ) as r:
             r.raise_for_status()
             with open(filename, 'wb') as f:
                 logger.debug('Trying to save result to file %s..' % filename)
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
+                size = 0
+                for chunk in _iter_decoded_content(r):
+                    f.write(chunk)
+                    size += len(chunk)
+            # Number of bytes received, before decompression
+            received = r.raw.tell()
+        if received < size:
+            logger.info('Downloaded %d bytes for a %d bytes result (%d bytes saved)' % (
+                received, size, size - received))
+
+    def iter_result_features(self, operation_id):
+        """
+        Streams the features of a set of results as they are downloaded, without
+        saving them to a file or holding them all in memory
+
+        Args:
+            operation_id (str): The id of the result to download
+
+        Returns:
+            An iterator over GeoJSON features (see `picterra.geojson.iter_features`)
+        """
+        from .geojson import iter_features
+        result_url = self._result_url(operation_id)
+        logger.debug('Streaming result %s..' % result_url)
+        # Same as download_result_to_file, no timeout and the same compression support
+        with requests.get(
+            result_url, stream=True, headers={'Accept-Encoding': _ACCEPT_ENCODING}
+        ) as r:
+            r.raise_for_status()
+            content = io.BufferedReader(_ChunksReader(_iter_decoded_content(r)), _CHUNK_SIZE)
+            yield from iter_features(io.TextIOWrapper(content, encoding='utf-8'))
 
     def set_annotations(self, detector_id, raster_id, annotation_type, annotations):
         """
         Replaces the annotations of type 'annotation_type' with 'annotations', for the
         given raster-detector pair.
 
+        The annotations are serialized incrementally, one feature at a time, to a
+        temporary file (in memory while it is small) which is then streamed to the
+        blobstore, so that no big JSON string is built. To upload large annotation sets
+        with a flat memory use, pass an iterable (e.g. a generator) of features instead
+        of a dict, or use `set_annotations_from_file` if they already are in a file.
+
+        Args:
+            detector_id (str): The id of the detector
+            raster_id (str): The id of the raster
+            annotation_type (str): One of (outline, training_area, testing_area, validation_area)
+            annotations (dict): GeoJSON representation of the features to upload, or an
+                iterable of GeoJSON features
+        """
+        annotation_type = validate_annotation_type(annotation_type)
+        with tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE) as f:
+            _dump_annotations(annotations, f)
+            # Given explicitly, as requests would get it from the file descriptor,
+            # writing the temporary file to disk
+            length = f.tell()
+            f.seek(0)
+            self._upload_annotations(detector_id, raster_id, annotation_type, f, length)
+
+    def set_annotations_from_file(self, detector_id, raster_id, annotation_type, filename):
+        """
+        Replaces the annotations of type 'annotation_type' with the ones of a GeoJSON
+        file, for the given raster-detector pair. The file is streamed as it is to the
+        blobstore, without being loaded.
+
         Args:
             detector_id (str): The id of the detector
             raster_id (str): The id of the raster
             annotation_type (str): One of (outline, training_area, testing_area, validation_area)
-            annotations (dict): GeoJSON representation of the features to upload
+            filename (str): The path of the GeoJSON file containing the annotations
         """
-        annotation_type = annotation_type.lower()
-        valid_annotations = ('outline', 'training_area', 'testing_area', 'validation_area')
-        if annotation_type not in valid_annotations:
-            raise ValueError('Invalid annotation type "%s"; allowed values are: %s.' % (
-                annotation_type, ', '.join(valid_annotations)))
+        annotation_type = validate_annotation_type(annotation_type)
+        with open(filename, 'rb') as f:
+            self._upload_annotations(detector_id, raster_id, annotation_type, f)
+
+    def set_annotations_many(self, uploads, state_file=None, max_workers: int = 4):
+        """
+        Replaces the annotations of many raster-detector pairs, uploading and committing
+        them concurrently while a single loop polls all the resulting operations
+
+        A failing upload does not interrupt the others: its error is reported in the
+        summary. With a state file, the SHA-256 of the annotations of each pair that was
+        set successfully is recorded, and the pairs whose annotations did not change
+        since are skipped, so that only what changed is uploaded again.
+
+        Args:
+            uploads (list of dict): The annotations to set, as dictionaries with the
+                'detector_id', 'raster_id' and 'annotation_type' keys, and either an
+                'annotations' key (see `set_annotations`) or a 'filename' one (see
+                `set_annotations_from_file`)
+            state_file (str): Path of the JSON file holding the hashes of the last
+                annotations set, created if missing
+            max_workers (int): Maximum number of uploads running at once
+
+        Returns:
+            A list with a summary dictionary per upload, in the same order, where
+            status is one of 'uploaded', 'unchanged' or 'failed', for example:
+
+            ::
+
+                {
+                    'detector_id': '42',
+                    'raster_id': '43',
+                    'annotation_type': 'outline',
+                    'status': 'uploaded',
+                    'error': None
+                }
+        """
+        uploads = list(uploads)
+        summaries, keys = [], []
+        for upload in uploads:
+            annotation_type = validate_annotation_type(upload['annotation_type'])
+            summaries.append({
+                'detector_id': upload['detector_id'], 'raster_id': upload['raster_id'],
+                'annotation_type': annotation_type, 'status': None, 'error': None
+            })
+            keys.append('%s/%s/%s' % (upload['detector_id'], upload['raster_id'], annotation_type))
+        if len(set(keys)) < len(keys):
+            raise ValueError('The same annotations are set more than once')
+        state = load_state(state_file)
+
+        def start(i):
+            """Returns the hash of the annotations and the commit operation, if any"""
+            s = summaries[i]
+            with _open_annotations(uploads[i]) as f:
+                digest = _sha256(f)
+                if state.get(keys[i]) == digest:
+                    return digest, None
+                length = f.seek(0, io.SEEK_END)
+                f.seek(0)
+                return digest, self._start_annotations_upload(
+                    s['detector_id'], s['raster_id'], s['annotation_type'], f, length)
+
+        def fail(i, e):
+            logger.error('Setting the %s annotations of %s for %s failed: %s' % (
+                summaries[i]['annotation_type'], summaries[i]['raster_id'],
+                summaries[i]['detector_id'], e))
+            summaries[i]['status'] = 'failed'
+            summaries[i]['error'] = str(e)
+            # The annotations on the server are now unknown
+            state.pop(keys[i], None)
+
+        errors = (APIError, OSError, ValueError, requests.RequestException)
+        # upload index -> (operation response, hash, time of the next poll)
+        operations = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(start, i): i for i in range(len(uploads))}
+            while futures or operations:
+                timeout = None
+                if operations:
+                    timeout = max(0, min(o[2] for o in operations.values()) - time.time())
+                if futures:
+                    done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(timeout)
+                    done = []
+                changed = False
+                for future in done:
+                    i = futures.pop(future)
+                    try:
+                        digest, operation = future.result()
+                    except errors as e:
+                        fail(i, e)
+                        changed = True
+                        continue
+                    if operation is None:
+                        summaries[i]['status'] = 'unchanged'
+                    else:
+                        # Just wait for a short while before the first poll
+                        next_poll = time.time() + operation['poll_interval'] * 0.1
+                        operations[i] = (operation, digest, next_poll)
+                for i, (operation, digest, next_poll) in list(operations.items()):
+                    if next_poll > time.time():
+                        continue
+                    try:
+                        if not self._operation_completed(operation['operation_id']):
+                            operations[i] = (
+                                operation, digest, time.time() + operation['poll_interval'])
+                            continue
+                        summaries[i]['status'] = 'uploaded'
+                        state[keys[i]] = digest
+                    except errors as e:
+                        fail(i, e)
+                    del operations[i]
+                    changed = True
+                if changed and state_file is not None:
+                    save_state(state_file, state)
+        logger.info('Set %d annotations: %d uploaded, %d unchanged, %d failed' % tuple(
+            [len(summaries)] + [
+                sum(1 for s in summaries if s['status'] == status)
+                for status in ('uploaded', 'unchanged', 'failed')
+            ]))
+        return summaries
+
+    def _upload_annotations(self, detector_id, raster_id, annotation_type, data, length=None):
+        operation = self._start_annotations_upload(
+            detector_id, raster_id, annotation_type, data, length)
+        # Poll for operation completion
+        self._wait_until_operation_completes(operation)
+
+    def _start_annotations_upload(
+        self, detector_id, raster_id, annotation_type, data, length=None
+    ):
+        """Uploads and commits annotations, returning the commit operation"""
         # Get an upload url
         create_upload_resp = self.sess.post(
             self._api_url(
@@ -511,17 +1496,14 @@ class APIClient():
         upload_url = upload['upload_url']
         upload_id = upload['upload_id']
 
-        # Given we do not use self.sess the timeout is disabled (requests default), and this
-        # is good as file upload can take a long time
-        upload_resp = requests.put(
-            upload_url, json=annotations)
+        upload_resp = self._upload_to_blobstore(upload_url, data, length)
         if not upload_resp.ok:
             logger.error('Error when sending annotation upload %s to blobstore at url %s' % (
                 upload_id, upload_url))
             raise APIError(upload_resp.text)
 
         # Commit upload
-        commit_upload_resp = self.sess.post(
+        commit_upload_resp = self._post_operation(
             self._api_url(
                 'detectors/%s/training_rasters/%s/%s/upload/bulk/%s/commit/'
                 % (detector_id, raster_id, annotation_type, upload_id)
@@ -529,9 +1511,7 @@ class APIClient():
         )
         if not commit_upload_resp.ok:
             raise APIError(commit_upload_resp.text)
-
-        # Poll for operation completion
-        self._wait_until_operation_completes(commit_upload_resp.json())
+        return commit_upload_resp.json()
 
     def train_detector(self, detector_id):
         """
@@ -540,6 +1520,7 @@ class APIClient():
         Args:
             detector_id (str): The id of the detector
         """
-        resp = self.sess.post(self._api_url('detectors/%s/train/' % detector_id))
-        assert resp.status_code == 201, resp.status_code
+        resp = self._post_operation(self._api_url('detectors/%s/train/' % detector_id))
+        if not resp.ok:
+            raise APIError(resp.text)
         self._wait_until_operation_completes(resp.json())
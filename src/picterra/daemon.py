@@ -0,0 +1,235 @@
+"""
+Local daemon keeping a warm API client (and thus its pooled, already handshaked
+connections) alive behind a Unix socket, so that short CLI invocations do not pay
+for the client set up on every call.
+
+The protocol is made of JSON lines: the CLI sends a single {"options": {...}} line
+with its parsed arguments, and the daemon answers with a {"stdout": "..."} line per
+write of the command, followed by a final {"status": 0|1, "error": "..."} line.
+
+As commands run with the daemon's API key, only the current user may talk to it: the
+socket lives in a private directory and the CLI checks that it belongs to the current
+user before forwarding anything. The options line also carries a fingerprint of the
+API key and base URL of the CLI, and the daemon refuses commands of a CLI configured
+for another account or server.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import sys
+
+
+logger = logging.getLogger(__name__)
+
+
+def default_socket_path():
+    """
+    Path of the daemon socket, overridable via the PICTERRA_DAEMON_SOCKET env variable
+
+    The socket is created in $XDG_RUNTIME_DIR, which is private to the user, or else
+    in a /tmp/picterra-<uid> directory only the user may access (see `serve`).
+    """
+    if 'PICTERRA_DAEMON_SOCKET' in os.environ:
+        return os.environ['PICTERRA_DAEMON_SOCKET']
+    if 'XDG_RUNTIME_DIR' in os.environ:
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'picterra-%d.sock' % os.getuid())
+    return os.path.join(_private_tmp_dir(), 'daemon.sock')
+
+
+def _private_tmp_dir():
+    return os.path.join('/tmp', 'picterra-%d' % os.getuid())
+
+
+def fingerprint(environ=os.environ):
+    """
+    Fingerprint of the API key and base URL a client gets from the environment
+
+    It is sent instead of the key itself, so that the CLI and the daemon can tell
+    whether they target the same account and server.
+    """
+    config = '%s\n%s' % (
+        environ.get('PICTERRA_API_KEY', ''), environ.get('PICTERRA_BASE_URL', ''))
+    return hashlib.sha256(config.encode()).hexdigest()
+
+
+def _is_private(st):
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def _make_private_dir(path):
+    """Creates the directory only the current user may access, checking an existing one"""
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    # Another user may have created it first, to listen on the socket in our stead
+    if not stat.S_ISDIR(st.st_mode) or not _is_private(st):
+        raise PermissionError(
+            '%s is not a directory private to the current user, refusing to use it' % path)
+
+
+def _peer_uid(sock):
+    """User ID of the process listening on a connected Unix socket, None if unknown"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def _connect(socket_path):
+    """Returns a socket connected to the daemon, or None if no daemon listens on socket_path"""
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    try:
+        st = os.stat(socket_path)
+    except OSError:
+        return None
+    if not _is_private(st):
+        # Whoever listens on it would receive our commands and could fake their output
+        logger.warning(
+            'Ignoring the daemon socket %s, which other users may access' % socket_path)
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        # Stale socket file left by a daemon which was killed
+        sock.close()
+        return None
+    # The socket file may have been replaced since it was checked
+    peer_uid = _peer_uid(sock)
+    if peer_uid is not None and peer_uid != os.getuid():
+        logger.warning('Ignoring the daemon on %s, run by user %d' % (socket_path, peer_uid))
+        sock.close()
+        return None
+    return sock
+
+
+def is_running(socket_path):
+    sock = _connect(socket_path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+def forward(socket_path, options, out):
+    """
+    Runs a command on the daemon, writing its output to out
+
+    Args:
+        socket_path (str): Path of the daemon socket
+        options (argparse.Namespace): The parsed command, which must be JSON-serializable
+        out: text stream where the command output is written
+
+    Returns:
+        None if no daemon of the current user is running, otherwise a (status, error
+        message) pair
+    """
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+    with sock, sock.makefile('w') as wfile, sock.makefile('r') as rfile:
+        request = {'options': vars(options), 'fingerprint': fingerprint()}
+        wfile.write(json.dumps(request) + '\n')
+        wfile.flush()
+        for line in rfile:
+            reply = json.loads(line)
+            if 'stdout' in reply:
+                out.write(reply['stdout'])
+                out.flush()
+            else:
+                return reply['status'], reply.get('error')
+    return 1, 'Connection to the daemon at %s was lost' % socket_path
+
+
+class _ReplyWriter():
+    """Text stream sending each write to the CLI as a stdout reply line"""
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, s):
+        if s:
+            self.wfile.write((json.dumps({'stdout': s}) + '\n').encode())
+        return len(s)
+
+    def flush(self):
+        pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line.decode())
+        if not hmac.compare_digest(request.get('fingerprint', ''), self.server.fingerprint):
+            reply = {
+                'status': 1,
+                'error': 'The daemon uses another API key or base URL: restart it with '
+                         'the current ones, or run the command with --no-daemon'}
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+            return
+        options = argparse.Namespace(**request['options'])
+        try:
+            self.server.run_command(options, _ReplyWriter(self.wfile))
+            reply = {'status': 0}
+        except Exception as e:
+            # Report the failure to the CLI rather than bringing the daemon down
+            logger.exception('Command %s failed' % options.command)
+            reply = {'status': 1, 'error': str(e)}
+        self.wfile.write((json.dumps(reply) + '\n').encode())
+
+
+# Unix sockets are not available on every platform (e.g. Windows), in which case no
+# daemon can be started and the CLI always runs commands by itself
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, socket_path, run_command, fingerprint):
+            self.run_command = run_command
+            self.fingerprint = fingerprint
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            # Only the current user may connect, as commands run with the daemon's API key
+            umask = os.umask(0o177)
+            try:
+                super().__init__(socket_path, _Handler)
+            finally:
+                os.umask(umask)
+
+
+def serve(socket_path, run_command, fingerprint):
+    """
+    Listens on socket_path until interrupted, running the received commands concurrently
+
+    Args:
+        socket_path (str): Path of the Unix socket to create; the default directory in
+            /tmp is created private to the current user
+        run_command (callable): called with the options of each command and a text stream
+            where the command output must be written
+        fingerprint (str): The `fingerprint` of the API key and base URL of the daemon;
+            commands from a CLI with another one are refused
+    """
+    if os.path.dirname(socket_path) == _private_tmp_dir():
+        _make_private_dir(_private_tmp_dir())
+    server = _Server(socket_path, run_command, fingerprint)
+    # Make SIGTERM go through the same clean up as Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
@@ -0,0 +1,227 @@
+"""
+Helpers to read and write large GeoJSON files incrementally, one feature at a time,
+so that the whole file never has to be held in memory
+"""
+import json
+from contextlib import contextmanager
+
+
+_DEFAULT_CHUNK_SIZE = 1 << 16
+
+_WHITESPACE = ' \t\n\r'
+
+
+class _StreamReader():
+    """
+    Minimal incremental JSON reader: it walks through objects and arrays and decodes
+    the values it is asked for with `json.JSONDecoder.raw_decode`, refilling its
+    buffer from the file when a value is incomplete
+    """
+    def __init__(self, f, chunk_size=_DEFAULT_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size):
+        if self.eof:
+            return False
+        data = self.f.read(size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it, '' at EOF"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill(self.chunk_size):
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('Invalid JSON: expected %s but got %r at offset %d' % (
+                ' or '.join(repr(c) for c in chars), c, self.pos))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decodes the next JSON value"""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number ending with the buffer may have been truncated
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # Grow the reads so that large values are not decoded over and over
+            self._fill(size)
+            size *= 2
+
+    def iter_array(self, item=None):
+        """Yields the elements of the array starting at the current position"""
+        item = item or self.value
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield item()
+            if self.expect(',]') == ']':
+                return
+
+    def iter_object(self):
+        """
+        Yields the keys of the object starting at the current position; the caller
+        must consume the value of each key before asking for the next one
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+
+def _feature(geometry, properties=None):
+    return {'type': 'Feature', 'geometry': geometry, 'properties': properties or {}}
+
+
+@contextmanager
+def _open(filename_or_file):
+    if hasattr(filename_or_file, 'read'):
+        yield filename_or_file
+    else:
+        with open(filename_or_file, encoding='utf-8') as f:
+            yield f
+
+
+def iter_features(filename_or_file, chunk_size=_DEFAULT_CHUNK_SIZE, members=None):
+    """
+    Reads a GeoJSON file incrementally, yielding its features one at a time
+
+    A FeatureCollection yields each of its features, a MultiPolygon each of its
+    polygons (as a Feature with a Polygon geometry and no properties) and any other
+    geometry or a single Feature yields one Feature.
+
+    Args:
+        filename_or_file: The path to the GeoJSON file, or a text file object
+        chunk_size (int): Number of characters read from the file at once
+        members (dict): If given, filled with the members of the top-level object other
+            than its features (e.g. its "type" and "bbox"), once it has been read
+            completely
+
+    Returns:
+        An iterator over GeoJSON Feature dictionaries
+    """
+    if members is None:
+        members = {}
+    with _open(filename_or_file) as f:
+        reader = _StreamReader(f, chunk_size)
+        for key in reader.iter_object():
+            if key == 'features':
+                yield from reader.iter_array()
+            elif key == 'coordinates' and members.get('type', 'MultiPolygon') == 'MultiPolygon':
+                # Stream the polygons of a MultiPolygon, unless "type" told us otherwise;
+                # if "type" comes after "coordinates" we tell polygons from rings by depth
+                polygons = []
+                for element in reader.iter_array():
+                    if 'type' in members or _depth(element) == 3:
+                        yield _feature({'type': 'Polygon', 'coordinates': element})
+                    else:
+                        polygons.append(element)
+                members['coordinates'] = polygons
+            else:
+                members[key] = reader.value()
+        geojson_type = members.get('type')
+        if geojson_type == 'Feature':
+            yield members
+        elif geojson_type not in ('FeatureCollection', 'MultiPolygon', None):
+            yield _feature(members)
+        elif geojson_type is None and members.get('coordinates'):
+            # "type" came after "coordinates" and turned out not to be a MultiPolygon
+            raise ValueError('Invalid GeoJSON: missing type')
+
+
+def _depth(coordinates):
+    """Nesting depth of a coordinates array, e.g. 2 for a ring and 3 for a polygon"""
+    depth = 0
+    while isinstance(coordinates, list) and coordinates:
+        coordinates = coordinates[0]
+        depth += 1
+    return depth
+
+
+def _check_output_format(output_format):
+    if output_format not in ('geojson', 'ndjson'):
+        raise ValueError('Invalid output format "%s", choose one of geojson, ndjson' % (
+            output_format))
+
+
+def write_features(features, filename, output_format='geojson', members=None):
+    """
+    Writes features to a file as they come, without building a list
+
+    Args:
+        features: An iterable of GeoJSON Feature dictionaries
+        filename (str): The path of the file to write
+        output_format (str): 'geojson' to write a FeatureCollection, or 'ndjson' to
+            write one feature per line
+        members (dict): Additional members of the FeatureCollection, e.g. its "bbox"
+
+    Returns:
+        The number of features written
+    """
+    _check_output_format(output_format)
+    with open(filename, 'w', encoding='utf-8') as f:
+        return dump_features(features, f.write, output_format, members)
+
+
+def dump_features(features, write, output_format='geojson', members=None):
+    """
+    Serializes features incrementally, one feature at a time, passing the text to
+    the write function (e.g. the write method of a file) as it is produced
+
+    Args:
+        features: An iterable of GeoJSON Feature dictionaries
+        write: A function called with each piece of the serialized text
+        output_format (str): 'geojson' to write a FeatureCollection, or 'ndjson' to
+            write one feature per line
+        members (dict): Additional members of the FeatureCollection, e.g. its "bbox"
+
+    Returns:
+        The number of features written
+    """
+    _check_output_format(output_format)
+    count = 0
+    if output_format == 'geojson':
+        header = dict(members or {}, type='FeatureCollection')
+        write(json.dumps(header)[:-1] + ', "features": [\n')
+    for feature in features:
+        if count and output_format == 'geojson':
+            write(',\n')
+        write(json.dumps(feature))
+        if output_format == 'ndjson':
+            write('\n')
+        count += 1
+    if output_format == 'geojson':
+        write('\n]}\n')
+    return count
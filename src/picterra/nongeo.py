@@ -1,5 +1,19 @@
 import math
 import json
+import logging
+import mmap
+import os
+import re
+from itertools import chain
+
+from .geojson import iter_features, write_features
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, conversions fall back to pure Python without it
+    np = None
+
+logger = logging.getLogger(__name__)
 
 # The projected bounds for EPSG 3857 are computed based on the earth radius
 # defined in the spheroid https://epsg.io/3857
@@ -19,28 +33,618 @@ _EPSG_3857_Y_EXTENT = (_EPSG_3857_Y_MAX - _EPSG_3857_Y_MIN)
 
 _DEG_TO_RAD = math.pi / 180.0
 
+# The arbitrary 3857 geotransform that Picterra sets on non-georeferenced rasters
+_GEOT = (0, 0.1, 0, 0, 0, -0.1)
+
+# The projection and the geotransform fused into a scale and an offset per axis:
+#   x = lng_deg * _X_SCALE + _X_OFFSET
+#   y = log(tan(pi / 4 + lat_deg * _DEG_TO_RAD / 2)) * _Y_SCALE + _Y_OFFSET
+_X_SCALE = _EPSG_3857_X_EXTENT / (2.0 * math.pi) * _DEG_TO_RAD / _GEOT[1]
+_X_OFFSET = -_GEOT[0] / _GEOT[1]
+_Y_SCALE = _EPSG_3857_Y_EXTENT / (2.0 * math.pi) / _GEOT[5]
+_Y_OFFSET = -_GEOT[3] / _GEOT[5]
+
 
 def _nongeo_latlng2xy(lat_deg, lng_deg):
     """
+    Converts a single (lat, lng) coordinate of a non-georeferenced result to (x, y) pixels
     """
-    lat = _DEG_TO_RAD * lat_deg
-    lng = _DEG_TO_RAD * lng_deg
-
     # First, project to pseudo-mercator
     # https://en.wikipedia.org/wiki/Web_Mercator_projection#Formulas
-    x_proj = _EPSG_3857_X_EXTENT / (2.0 * math.pi) * lng
-    y_proj = _EPSG_3857_Y_EXTENT / (2.0 * math.pi) *\
-        math.log(math.tan(math.pi / 4.0 + lat / 2.0))
-
     # Then, apply the raster geotransform to get pixel coordinates
-    # The arbitrary 3857 geotransform that Picterra sets on non-georeferenced rasters
-    geot = [0, 0.1, 0, 0, 0, -0.1]
-    x = (x_proj - geot[0]) / geot[1]
-    y = (y_proj - geot[3]) / geot[5]
+    x = lng_deg * _X_SCALE + _X_OFFSET
+    y = math.log(math.tan(math.pi / 4.0 + lat_deg * _DEG_TO_RAD / 2.0)) * _Y_SCALE + _Y_OFFSET
     return x, y
 
 
-def nongeo_result_to_pixel(result_filename):
+def _nongeo_lnglat2xy_array(coords):
+    """
+    Vectorized version of `_nongeo_latlng2xy`, requires numpy
+
+    Args:
+        - coords: array-like of shape (N, 2) of (lng, lat) coordinates, in GeoJSON order
+    Returns:
+        - A float64 array of shape (N, 2) of (x, y) coordinates
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    xy = np.empty_like(coords)
+    np.multiply(coords[:, 0], _X_SCALE, out=xy[:, 0])
+    xy[:, 0] += _X_OFFSET
+    y = xy[:, 1]
+    np.multiply(coords[:, 1], _DEG_TO_RAD / 2.0, out=y)
+    y += math.pi / 4.0
+    np.tan(y, out=y)
+    np.log(y, out=y)
+    y *= _Y_SCALE
+    y += _Y_OFFSET
+    return xy
+
+
+def _nongeo_xy2latlng(x, y):
+    """
+    Inverse of `_nongeo_latlng2xy`: converts (x, y) pixels to a (lat, lng) coordinate
+    """
+    lng_deg = (x - _X_OFFSET) / _X_SCALE
+    lat = 2.0 * math.atan(math.exp((y - _Y_OFFSET) / _Y_SCALE)) - math.pi / 2.0
+    return lat / _DEG_TO_RAD, lng_deg
+
+
+def _nongeo_xy2lnglat_array(xy):
+    """
+    Vectorized version of `_nongeo_xy2latlng`, requires numpy
+
+    Args:
+        - xy: array-like of shape (N, 2) of (x, y) pixel coordinates
+    Returns:
+        - A float64 array of shape (N, 2) of (lng, lat) coordinates, in GeoJSON order
+    """
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    lnglat = np.empty_like(xy)
+    np.subtract(xy[:, 0], _X_OFFSET, out=lnglat[:, 0])
+    lnglat[:, 0] /= _X_SCALE
+    lat = lnglat[:, 1]
+    np.subtract(xy[:, 1], _Y_OFFSET, out=lat)
+    lat /= _Y_SCALE
+    np.exp(lat, out=lat)
+    np.arctan(lat, out=lat)
+    lat *= 2.0 / _DEG_TO_RAD
+    lat -= 90.0
+    return lnglat
+
+
+def _polygon_features(polygons_coordinates):
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'Polygon', 'coordinates': coordinates}}
+            for coordinates in polygons_coordinates
+        ]
+    }
+
+
+def pixel_polygons_to_nongeo_geojson(polygons):
+    """
+    Converts polygons in pixel coordinates of a non-georeferenced image to a
+    GeoJSON FeatureCollection that can be passed to `APIClient.set_annotations`
+
+    This is the inverse of `nongeo_result_to_pixel`. If numpy is installed, all
+    the vertices are converted in a single vectorized operation.
+
+    Args:
+        - polygons: A list of polygons, each polygon being a list of rings and each
+            ring a list of (x, y) pixels, or a `PixelPolygons`
+    Returns:
+        - A GeoJSON FeatureCollection dict with a Polygon feature per polygon
+    """
+    if np is None:
+        return _polygon_features(
+            [[[list(_nongeo_xy2latlng(x, y))[::-1] for x, y in ring] for ring in polygon]
+             for polygon in polygons]
+        )
+    if not isinstance(polygons, PixelPolygons):
+        polygons = PixelPolygons.from_list(polygons)
+    lnglat = _nongeo_xy2lnglat_array(polygons.coords).tolist()
+    offsets = polygons.ring_offsets.tolist()
+    rings = [lnglat[start:end] for start, end in zip(offsets, offsets[1:])]
+    polygon_offsets = polygons.polygon_offsets.tolist()
+    return _polygon_features(
+        rings[start:end] for start, end in zip(polygon_offsets, polygon_offsets[1:])
+    )
+
+
+def pixel_boxes_to_nongeo_geojson(boxes, box_format='xywh'):
+    """
+    Converts bounding boxes in pixel coordinates of a non-georeferenced image,
+    e.g. COCO annotations, to a GeoJSON FeatureCollection that can be passed to
+    `APIClient.set_annotations`
+
+    If numpy is installed, all the boxes are converted in a single vectorized
+    operation, without any per-vertex Python loop.
+
+    Args:
+        - boxes: A sequence or (N, 4) array of boxes
+        - box_format (str): 'xywh' for COCO-style [x, y, width, height] boxes, or
+            'xyxy' for [x_min, y_min, x_max, y_max] ones
+    Returns:
+        - A GeoJSON FeatureCollection dict with a rectangular Polygon feature per box
+    """
+    if box_format not in ('xywh', 'xyxy'):
+        raise ValueError('Invalid box format "%s", choose one of xywh, xyxy' % box_format)
+    if np is None:
+        rings = []
+        for x0, y0, x1, y1 in boxes:
+            if box_format == 'xywh':
+                x1, y1 = x0 + x1, y0 + y1
+            # Counter-clockwise once the y axis points north, as recommended by GeoJSON
+            corners = [(x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)]
+            rings.append([list(_nongeo_xy2latlng(x, y))[::-1] for x, y in corners])
+        return _polygon_features([ring] for ring in rings)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    x0, y0 = boxes[:, 0], boxes[:, 1]
+    x1, y1 = boxes[:, 2], boxes[:, 3]
+    if box_format == 'xywh':
+        x1, y1 = x0 + x1, y0 + y1
+    # Counter-clockwise once the y axis points north, as recommended by GeoJSON
+    corners = np.empty((len(boxes), 5, 2))
+    corners[:, (0, 1, 4), 0] = x0[:, None]
+    corners[:, (2, 3), 0] = x1[:, None]
+    corners[:, (0, 3, 4), 1] = y0[:, None]
+    corners[:, (1, 2), 1] = y1[:, None]
+    rings = _nongeo_xy2lnglat_array(corners).reshape(-1, 5, 2).tolist()
+    return _polygon_features([ring] for ring in rings)
+
+
+class PixelPolygons():
+    """
+    Compact, array-backed collection of polygons in pixel coordinates, following
+    the GeoArrow layout: all the vertices are stored in a single coordinates buffer
+    and rings and polygons are delimited by offsets arrays. Requires numpy.
+
+    Attributes:
+        - coords: float64 array of shape (N, 2) holding the (x, y) vertices of all the rings
+        - ring_offsets: int64 array, ring i is coords[ring_offsets[i]:ring_offsets[i + 1]]
+        - polygon_offsets: int64 array, polygon j is made of the rings
+            polygon_offsets[j] to polygon_offsets[j + 1] (excluded)
+        - original_num_vertices: number of vertices before `simplify`, the same as
+            `num_vertices` if the polygons were not simplified
+
+    Indexing returns a polygon as a list of rings, each ring being a (n, 2) view
+    on `coords`, so no data is copied.
+    """
+    def __init__(self, coords, ring_offsets, polygon_offsets):
+        if np is None:
+            raise ImportError('PixelPolygons requires numpy')
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+        self.polygon_offsets = np.asarray(polygon_offsets, dtype=np.int64)
+        self.original_num_vertices = len(self.coords)
+
+    def __len__(self):
+        return len(self.polygon_offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('polygon index out of range')
+        return [
+            self.ring(r) for r in range(self.polygon_offsets[i], self.polygon_offsets[i + 1])
+        ]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return '<PixelPolygons: %d polygons, %d rings, %d vertices>' % (
+            len(self), self.num_rings, self.num_vertices)
+
+    @property
+    def num_rings(self):
+        return len(self.ring_offsets) - 1
+
+    @property
+    def num_vertices(self):
+        return len(self.coords)
+
+    def ring(self, i):
+        """The i-th ring (across all polygons), as a view on `coords`"""
+        return self.coords[self.ring_offsets[i]:self.ring_offsets[i + 1]]
+
+    def to_list(self):
+        """Converts to the nested lists returned by `nongeo_result_to_pixel`"""
+        # Going through flat lists of floats is much cheaper than coords.tolist() which
+        # creates a list object per vertex
+        x, y = self.coords[:, 0].tolist(), self.coords[:, 1].tolist()
+        offsets = self.ring_offsets.tolist()
+        rings = [
+            list(zip(x[start:end], y[start:end])) for start, end in zip(offsets, offsets[1:])
+        ]
+        polygon_offsets = self.polygon_offsets.tolist()
+        return [rings[start:end] for start, end in zip(polygon_offsets, polygon_offsets[1:])]
+
+    def simplify(self, tolerance=0.0, remove_collinear=False, precision=None):
+        """
+        Reduces the number of vertices of the polygons, keeping the rings valid:
+        rings stay closed, keep their orientation and at least 3 distinct vertices
+        (rings that would not are left as they were)
+
+        Args:
+            - tolerance (float): Douglas-Peucker tolerance, in pixels; 0 disables it
+            - remove_collinear (bool): Whether to remove duplicated vertices and the
+                ones lying on a straight line between their neighbours (e.g. along the
+                edges of staircase-like segmentation outlines); this does not change
+                the shape of the polygons
+            - precision (int): If set, round the coordinates to this number of
+                decimals (0 for integer pixels)
+        Returns:
+            - A new `PixelPolygons`, whose original_num_vertices is the number of
+                vertices before this (and any previous) simplification
+        """
+        coords, ring_offsets = self.coords, self.ring_offsets
+        if remove_collinear:
+            coords, ring_offsets = _filter_rings(
+                coords, ring_offsets, _distinct_mask(coords, ring_offsets))
+            coords, ring_offsets = _filter_rings(
+                coords, ring_offsets, _collinear_mask(coords, ring_offsets))
+        if tolerance > 0:
+            coords, ring_offsets = _filter_rings(
+                coords, ring_offsets, _douglas_peucker_mask(coords, ring_offsets, tolerance))
+        if precision is not None:
+            rounded = np.round(coords, precision)
+            # Rounding may flatten or flip tiny rings, those keep their exact coordinates
+            areas, rounded_areas = (_signed_areas(c, ring_offsets) for c in (coords, rounded))
+            flipped = np.sign(areas) != np.sign(rounded_areas)
+            coords = np.where(
+                np.repeat(flipped, np.diff(ring_offsets))[:, None], coords, rounded)
+            coords, ring_offsets = _filter_rings(
+                coords, ring_offsets, _distinct_mask(coords, ring_offsets))
+        logger.debug('Simplified %d polygons from %d to %d vertices' % (
+            len(self), self.num_vertices, len(coords)))
+        simplified = PixelPolygons(coords, ring_offsets, self.polygon_offsets)
+        simplified.original_num_vertices = self.original_num_vertices
+        return simplified
+
+    @classmethod
+    def from_list(cls, polygons):
+        """Builds from nested lists as returned by `nongeo_result_to_pixel`"""
+        return cls._from_coordinates(polygons)
+
+    @classmethod
+    def _from_coordinates(cls, polygons):
+        # Builds the buffers from nested lists of polygons/rings/vertices
+        rings = [ring for polygon in polygons for ring in polygon]
+        ring_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, rings), dtype=np.int64, count=len(rings)),
+                  out=ring_offsets[1:])
+        num_vertices = int(ring_offsets[-1])
+        widths = np.fromiter(
+            map(len, chain.from_iterable(rings)), dtype=np.int64, count=num_vertices)
+        if (widths == 2).all():
+            coords = np.fromiter(
+                chain.from_iterable(chain.from_iterable(rings)), dtype=np.float64)
+        elif (widths >= 2).all():
+            # Positions with an altitude (or more), which is dropped as by the other paths
+            coords = np.fromiter(
+                chain.from_iterable(xy[:2] for xy in chain.from_iterable(rings)),
+                dtype=np.float64, count=2 * num_vertices)
+        else:
+            raise ValueError('Positions must have at least 2 coordinates')
+        polygon_offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, polygons), dtype=np.int64, count=len(polygons)),
+                  out=polygon_offsets[1:])
+        return cls(coords, ring_offsets, polygon_offsets)
+
+
+# Target size, in bytes of GeoJSON, of the chunks converted by each worker process
+_PARALLEL_CHUNK_SIZE = 16 * 1024 * 1024
+
+_WHITESPACE_RE = re.compile(rb'\s*')
+_KEY_RE = re.compile(rb'"((?:[^"\\]|\\.)*)"\s*:\s*')
+# Within MultiPolygon coordinates, three closing brackets in a row only ever end a polygon,
+# and four the whole coordinates array
+_POLYGON_END_RE = re.compile(rb'\]\s*\]\s*\]')
+_COORDINATES_END_RE = re.compile(rb'(\]\s*\]\s*\])\s*\]')
+# Largest top-level member other than the coordinates decoded to read the header
+_MAX_MEMBER_SIZE = 1 << 20
+
+
+def _decode_member(mm, start):
+    """Decodes the (small) JSON value starting at byte start, returning it and its end"""
+    size = 4096
+    while True:
+        # Trailing bytes of a truncated UTF-8 character are dropped, the value ends before
+        text = mm[start:start + size].decode('utf-8', errors='ignore')
+        try:
+            value, end = json.JSONDecoder().raw_decode(text)
+            return value, start + len(text[:end].encode('utf-8'))
+        except ValueError:
+            if size >= _MAX_MEMBER_SIZE or start + size >= len(mm):
+                raise
+            size *= 2
+
+
+def _multipolygon_coordinates(mm):
+    """
+    Reads the top-level object of a GeoJSON (as bytes-like) without parsing its
+    coordinates, returning the (start, end) byte range of the polygons in its
+    coordinates array if it is a bare MultiPolygon geometry, None otherwise
+    """
+    pos = _WHITESPACE_RE.match(mm).end()
+    if mm[pos:pos + 1] != b'{':
+        return None
+    pos += 1
+    members = {}
+    span = None
+    while True:
+        pos = _WHITESPACE_RE.match(mm, pos).end()
+        match = _KEY_RE.match(mm, pos)
+        if match is None:
+            return None
+        key = match.group(1)
+        pos = match.end()
+        if key in (b'features', b'geometry', b'geometries'):
+            # A FeatureCollection, a Feature or a GeometryCollection
+            return None
+        if key == b'coordinates':
+            if mm[pos:pos + 1] != b'[':
+                return None
+            start = _WHITESPACE_RE.match(mm, pos + 1).end()
+            if mm[start:start + 1] == b']':
+                # Empty coordinates
+                span, pos = (start, start), start + 1
+            else:
+                # Only valid if this is a MultiPolygon, which "type" tells, maybe later
+                end_match = _COORDINATES_END_RE.search(mm, start)
+                if end_match is None:
+                    return None
+                span, pos = (start, end_match.end(1)), end_match.end()
+        else:
+            try:
+                members[key], pos = _decode_member(mm, pos)
+            except ValueError:
+                return None
+        pos = _WHITESPACE_RE.match(mm, pos).end()
+        separator = mm[pos:pos + 1]
+        pos += 1
+        if separator == b'}':
+            break
+        if separator != b',':
+            return None
+    if members.get(b'type') != 'MultiPolygon' or span is None:
+        return None
+    return span
+
+
+def _multipolygon_chunks(mm, chunk_size):
+    """
+    Splits the coordinates array of a bare MultiPolygon GeoJSON geometry (as bytes-like)
+    into (start, end) byte ranges each made of whole polygons, without parsing it;
+    returns None for any other GeoJSON
+    """
+    span = _multipolygon_coordinates(mm)
+    if span is None:
+        return None
+    start, end = span
+    chunks = []
+    while start < end:
+        match = _POLYGON_END_RE.search(mm, min(start + chunk_size, end - 1), end)
+        chunk_end = match.end() if match else end
+        chunks.append((start, chunk_end))
+        start = chunk_end
+    return chunks
+
+
+def _convert_chunk(result_filename, start, end, simplify_kwargs):
+    """
+    Worker of the parallel conversion: parses the polygons in the [start, end) byte
+    range of the result and converts them, returning the pixel coordinates through
+    a shared memory block
+    """
+    from multiprocessing import shared_memory
+    with open(result_filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start).strip(b' \t\r\n,')
+    polygons = PixelPolygons._from_coordinates(json.loads(b'[' + data + b']'))
+    polygons.coords = _nongeo_lnglat2xy_array(polygons.coords)
+    num_vertices = polygons.num_vertices
+    if simplify_kwargs:
+        polygons = polygons.simplify(**simplify_kwargs)
+    shm = shared_memory.SharedMemory(create=True, size=max(polygons.coords.nbytes, 1))
+    xy = np.ndarray(polygons.coords.shape, dtype=np.float64, buffer=shm.buf)
+    xy[:] = polygons.coords
+    del xy
+    shm.close()
+    return (
+        shm.name, len(polygons.coords), polygons.ring_offsets, polygons.polygon_offsets,
+        num_vertices
+    )
+
+
+def _has_shared_memory():
+    # multiprocessing.shared_memory is only available since Python 3.8
+    try:
+        from multiprocessing import shared_memory  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _nongeo_result_to_pixel_parallel(result_filename, processes, simplify_kwargs):
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import resource_tracker, shared_memory
+    # The workers must share our resource tracker: one of their own would destroy the
+    # shared memory blocks they created as soon as they exit, before we read them
+    resource_tracker.ensure_running()
+    with open(result_filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            chunk_size = min(_PARALLEL_CHUNK_SIZE, max(len(mm) // (4 * processes), 1))
+            chunks = _multipolygon_chunks(mm, chunk_size)
+    if chunks is None:
+        logger.debug('%s is not a MultiPolygon, converting it in a single process' % (
+            result_filename))
+        return None
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(_convert_chunk, result_filename, *c, simplify_kwargs)
+            for c in chunks
+        ]
+        results = [future.result() for future in futures]
+    # Stitch the chunks together, in order
+    coords = np.empty((sum(r[1] for r in results), 2))
+    ring_offsets = [np.zeros(1, dtype=np.int64)]
+    polygon_offsets = [np.zeros(1, dtype=np.int64)]
+    num_vertices = num_rings = 0
+    for name, n, chunk_ring_offsets, chunk_polygon_offsets, _ in results:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            coords[num_vertices:num_vertices + n] = np.ndarray(
+                (n, 2), dtype=np.float64, buffer=shm.buf)
+        finally:
+            shm.close()
+            shm.unlink()
+        ring_offsets.append(chunk_ring_offsets[1:] + num_vertices)
+        polygon_offsets.append(chunk_polygon_offsets[1:] + num_rings)
+        num_vertices += n
+        num_rings += len(chunk_ring_offsets) - 1
+    polygons = PixelPolygons(
+        coords, np.concatenate(ring_offsets), np.concatenate(polygon_offsets))
+    return polygons, sum(r[4] for r in results)
+
+
+def _closed_rings(coords, ring_offsets):
+    """Mask of the rings that can be simplified: closed and with at least 4 vertices"""
+    starts, ends = ring_offsets[:-1], ring_offsets[1:]
+    closed = (ends - starts) >= 4
+    closed[closed] = np.all(coords[starts[closed]] == coords[ends[closed] - 1], axis=1)
+    return closed
+
+
+def _ring_ids(ring_offsets):
+    return np.repeat(np.arange(len(ring_offsets) - 1), np.diff(ring_offsets))
+
+
+def _filter_rings(coords, ring_offsets, keep):
+    """
+    Keeps the vertices selected by the keep mask in each closed ring, and closes the
+    rings again (the mask of their closing vertex is ignored). Rings left with less
+    than 3 vertices, and rings which are not closed, are kept unchanged.
+    """
+    lengths = np.diff(ring_offsets)
+    ring_ids = _ring_ids(ring_offsets)
+    closing = np.zeros(len(coords), dtype=bool)
+    closing[ring_offsets[1:][lengths > 0] - 1] = True
+    keep = keep & ~closing
+    counts = np.bincount(ring_ids[keep], minlength=len(lengths))
+    simplified = _closed_rings(coords, ring_offsets) & (counts >= 3)
+    # Untouched rings keep all their vertices, including the closing one
+    keep = np.where(simplified[ring_ids], keep, True)
+    kept = np.flatnonzero(keep)
+    counts = np.bincount(ring_ids[kept], minlength=len(lengths))
+    new_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(counts + simplified, out=new_offsets[1:])
+    new_coords = np.empty((new_offsets[-1], 2))
+    kept_ring_ids = ring_ids[kept]
+    first_kept = np.cumsum(counts) - counts
+    rank = np.arange(len(kept)) - first_kept[kept_ring_ids]
+    new_coords[new_offsets[kept_ring_ids] + rank] = coords[kept]
+    # Close the simplified rings with their first kept vertex
+    new_coords[new_offsets[1:][simplified] - 1] = coords[kept[first_kept[simplified]]]
+    return new_coords, new_offsets
+
+
+def _distinct_mask(coords, ring_offsets):
+    """Mask of the vertices which differ from the previous vertex of their ring"""
+    keep = np.ones(len(coords), dtype=bool)
+    keep[1:] = np.any(coords[1:] != coords[:-1], axis=1)
+    keep[ring_offsets[:-1][np.diff(ring_offsets) > 0]] = True
+    return keep
+
+
+def _collinear_mask(coords, ring_offsets):
+    """
+    Mask of the vertices of closed rings (without duplicated consecutive vertices)
+    which are not aligned with their previous and next vertices
+    """
+    ring_ids = _ring_ids(ring_offsets)
+    starts = ring_offsets[:-1][ring_ids]
+    # Number of distinct vertices, i.e. without the closing one
+    n = np.maximum(np.diff(ring_offsets)[ring_ids] - 1, 1)
+    local = np.arange(len(coords)) - starts
+    prev = coords[starts + (local - 1) % n]
+    next_ = coords[starts + (local + 1) % n]
+    a, b = coords - prev, next_ - coords
+    cross = a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+    scale = np.hypot(a[:, 0], a[:, 1]) * np.hypot(b[:, 0], b[:, 1])
+    return np.abs(cross) > 1e-12 * scale
+
+
+def _signed_areas(coords, ring_offsets):
+    """Shoelace signed area of each ring, positive when counter-clockwise (y up)"""
+    if len(coords) == 0:
+        return np.zeros(len(ring_offsets) - 1)
+    terms = np.zeros(len(coords))
+    terms[:-1] = coords[:-1, 0] * coords[1:, 1] - coords[1:, 0] * coords[:-1, 1]
+    # Do not pair the last vertex of a ring with the first one of the next
+    terms[ring_offsets[1:][np.diff(ring_offsets) > 0] - 1] = 0
+    sums = np.add.reduceat(terms, np.minimum(ring_offsets[:-1], len(terms) - 1))
+    return np.where(np.diff(ring_offsets) > 0, sums / 2.0, 0.0)
+
+
+def _douglas_peucker_polyline(points, tolerance, keep):
+    """Sets the keep mask of the vertices of the polyline kept by Douglas-Peucker"""
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a, b = points[start], points[end]
+        d = points[start + 1:end] - a
+        ab = b - a
+        norm = math.hypot(ab[0], ab[1])
+        if norm == 0:
+            distances = np.hypot(d[:, 0], d[:, 1])
+        else:
+            distances = np.abs(ab[0] * d[:, 1] - ab[1] * d[:, 0]) / norm
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            i += start + 1
+            keep[i] = True
+            stack += [(start, i), (i, end)]
+
+
+def _douglas_peucker_mask(coords, ring_offsets, tolerance):
+    """
+    Mask of the vertices kept by Douglas-Peucker on each closed ring, which is split in
+    two polylines at its vertex furthest from the first one. Rings whose orientation
+    would change keep all their vertices.
+    """
+    keep = np.ones(len(coords), dtype=bool)
+    closed = _closed_rings(coords, ring_offsets)
+    areas = _signed_areas(coords, ring_offsets)
+    # Rings with 3 distinct vertices cannot be simplified further
+    candidates = np.flatnonzero(closed & (np.diff(ring_offsets) > 4))
+    for r in candidates.tolist():
+        start, end = ring_offsets[r], ring_offsets[r + 1]
+        ring = coords[start:end]
+        d = ring - ring[0]
+        split = int(np.argmax(np.hypot(d[:, 0], d[:, 1])))
+        ring_keep = np.zeros(len(ring), dtype=bool)
+        _douglas_peucker_polyline(ring[:split + 1], tolerance, ring_keep[:split + 1])
+        _douglas_peucker_polyline(ring[split:], tolerance, ring_keep[split:])
+        simplified = ring[ring_keep]
+        if len(simplified) >= 4 and np.sign(
+                _signed_areas(simplified, np.array([0, len(simplified)]))[0]) == np.sign(areas[r]):
+            keep[start:end] = ring_keep
+    return keep
+
+
+def nongeo_result_to_pixel(
+    result_filename, compact=False, processes=1,
+    tolerance=0.0, remove_collinear=False, precision=None, return_vertex_counts=False
+):
     """
     This is a helper function to convert result obtained on non-georeferenced
     images in pixel.
@@ -50,9 +654,33 @@ def nongeo_result_to_pixel(result_filename):
 
     This is currently in **beta** so let us know if you find any issues
 
+    If numpy is installed, all the vertices are converted in a single vectorized
+    operation, which is much faster on large results.
+
     Args:
         - result_filename (str): The file path to the GeoJSON file obtained by
-            `APIClient.download_result_to_file`
+            `APIClient.download_result_to_file`, or to the binary file it was
+            converted to with `picterra.results.convert_result`, which is read
+            without any parsing (requires numpy, processes is then ignored). A
+            GeoJSON Feature or FeatureCollection yields the polygons of its Polygon
+            and MultiPolygon geometries
+        - compact (bool): If True, return a `PixelPolygons` instead of nested lists,
+            which uses about 10 times less memory on large results; requires numpy
+        - processes (int): Number of processes parsing and converting the result in
+            parallel, None meaning one per CPU; requires numpy, and Python 3.8 for shared
+            memory (it is converted in a single process before). The result is split in
+            chunks of whole polygons, each converted by a worker which returns the pixel
+            coordinates through shared memory. The output is the same as with one process.
+            Only MultiPolygon results can be split this way, the others are converted in
+            a single process.
+        - tolerance (float): If > 0, simplify the polygons with Douglas-Peucker using
+            this tolerance in pixels; requires numpy (see `PixelPolygons.simplify`)
+        - remove_collinear (bool): Remove duplicated and collinear vertices, which
+            does not change the shapes; requires numpy
+        - precision (int): Round the pixel coordinates to this number of decimals
+            (0 for integers); requires numpy
+        - return_vertex_counts (bool): If True, also return the number of vertices
+            before and after the simplification, e.g. to report the reduction
     Returns:
         - polygons: A list of polygons. Each polygon is a list of rings and
             each ring is a list of (x, y) tuples. For example:
@@ -63,17 +691,182 @@ def nongeo_result_to_pixel(result_filename):
                 # A triangle
                 [[(0, 0), (1, 0), (1, 1), (0, 0)]]
               ]
+            With return_vertex_counts, a (polygons, (vertices before, vertices after))
+            pair. A compact result also has them as its original_num_vertices and
+            num_vertices attributes.
     """
-    with open(result_filename) as f:
-        multipolygon = json.load(f)
+    simplify_kwargs = {}
+    if tolerance > 0 or remove_collinear or precision is not None:
+        simplify_kwargs = {
+            'tolerance': tolerance, 'remove_collinear': remove_collinear,
+            'precision': precision
+        }
+    if (compact or simplify_kwargs) and np is None:
+        raise ImportError('compact mode and simplification require numpy')
+    if processes is None:
+        processes = os.cpu_count() or 1
+    binary = _is_result_file(result_filename)
+    converted = None
+    if processes > 1 and not binary:
+        if np is None:
+            raise ImportError('Parallel conversion requires numpy')
+        if not _has_shared_memory():
+            logger.warning('Parallel conversion requires multiprocessing.shared_memory '
+                           '(Python 3.8), converting in a single process')
+        else:
+            # None if the result is not a MultiPolygon, which cannot be split without parsing
+            converted = _nongeo_result_to_pixel_parallel(
+                result_filename, processes, simplify_kwargs)
+    if converted is not None:
+        polygons, num_vertices = converted
+    else:
+        if binary:
+            polygons = _result_file_to_pixel(result_filename)
+        else:
+            with open(result_filename) as f:
+                coordinates = _polygons_coordinates(json.load(f))
 
-    polygons = []
-    for polygon in multipolygon['coordinates']:
-        xy_polygon = []
-        for ring in polygon:
-            xy_polygon.append([
-                _nongeo_latlng2xy(lat, lng) for lng, lat in ring
-            ])
-        polygons.append(xy_polygon)
+            if np is None:
+                polygons = [
+                    [[_nongeo_latlng2xy(lat, lng) for lng, lat, *_ in ring] for ring in polygon]
+                    for polygon in coordinates
+                ]
+                if return_vertex_counts:
+                    num_vertices = sum(len(ring) for polygon in polygons for ring in polygon)
+                    return polygons, (num_vertices, num_vertices)
+                return polygons
+            # Convert all the vertices at once
+            polygons = PixelPolygons._from_coordinates(coordinates)
+            polygons.coords = _nongeo_lnglat2xy_array(polygons.coords)
+        num_vertices = polygons.num_vertices
+        if simplify_kwargs:
+            polygons = polygons.simplify(**simplify_kwargs)
+    polygons.original_num_vertices = num_vertices
+    if simplify_kwargs:
+        logger.info('Simplified %d polygons from %d to %d vertices' % (
+            len(polygons), num_vertices, polygons.num_vertices))
+    result = polygons if compact else polygons.to_list()
+    if return_vertex_counts:
+        return result, (num_vertices, polygons.num_vertices)
+    return result
 
-    return polygons
+
+def _polygons_coordinates(geojson):
+    """
+    The coordinates of the polygons of a GeoJSON: those of a MultiPolygon, or those of
+    the Polygon and MultiPolygon geometries of a Feature or FeatureCollection
+    """
+    if geojson.get('type') == 'MultiPolygon':
+        return geojson['coordinates']
+    if geojson.get('type') == 'FeatureCollection':
+        geometries = [feature['geometry'] for feature in geojson['features']]
+    elif geojson.get('type') == 'Feature':
+        geometries = [geojson['geometry']]
+    else:
+        geometries = [geojson]
+    coordinates = []
+    for geometry in geometries:
+        geometry_type = geometry.get('type') if geometry else None
+        if geometry_type == 'Polygon':
+            coordinates.append(geometry['coordinates'])
+        elif geometry_type == 'MultiPolygon':
+            coordinates.extend(geometry['coordinates'])
+        else:
+            raise ValueError('Only polygons can be converted, got a %s geometry, use '
+                             'iter_nongeo_result_to_pixel for other types' % geometry_type)
+    return coordinates
+
+
+def _is_result_file(filename):
+    from .results import is_result_file
+    return is_result_file(filename)
+
+
+def _result_file_to_pixel(result_filename):
+    from .results import ResultFile, _POLYGONAL
+    if np is None:
+        raise ImportError('Reading binary result files requires numpy')
+    result = ResultFile(result_filename)
+    if not np.isin(result.geometry_types, _POLYGONAL).all():
+        raise ValueError('Only polygons can be converted, use ResultFile for other types')
+    # The parts of the features are the polygons, whether they come from a MultiPolygon
+    # or from features with Polygon or MultiPolygon geometries
+    return PixelPolygons(
+        _nongeo_lnglat2xy_array(result.coords), result.ring_offsets, result.part_offsets)
+
+
+# Nesting depth of the vertices in the coordinates of each geometry type
+_GEOMETRY_DEPTHS = {
+    'Point': 0, 'MultiPoint': 1, 'LineString': 1,
+    'MultiLineString': 2, 'Polygon': 2, 'MultiPolygon': 3,
+}
+
+
+def _coordinates_to_pixel(coordinates, depth):
+    if depth == 0:
+        return list(_nongeo_latlng2xy(coordinates[1], coordinates[0]))
+    if depth == 1:
+        if np is None:
+            return [list(_nongeo_latlng2xy(lat, lng)) for lng, lat, *_ in coordinates]
+        return _nongeo_lnglat2xy_array([c[:2] for c in coordinates]).tolist()
+    return [_coordinates_to_pixel(c, depth - 1) for c in coordinates]
+
+
+def _geometry_to_pixel(geometry):
+    if geometry is None:
+        return None
+    if geometry['type'] == 'GeometryCollection':
+        return dict(geometry, geometries=[
+            _geometry_to_pixel(g) for g in geometry['geometries']])
+    return dict(geometry, coordinates=_coordinates_to_pixel(
+        geometry['coordinates'], _GEOMETRY_DEPTHS[geometry['type']]))
+
+
+def _bbox_to_pixel(bbox):
+    # The y axis is flipped in pixel space, hence the min/max
+    x0, y0 = _nongeo_latlng2xy(bbox[1], bbox[0])
+    x1, y1 = _nongeo_latlng2xy(bbox[3], bbox[2])
+    return [min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)]
+
+
+def iter_nongeo_result_to_pixel(result_filename):
+    """
+    Streaming version of `nongeo_result_to_pixel`: reads the result file
+    incrementally and yields its features converted to pixel coordinates one at
+    a time, so memory use does not depend on the size of the result.
+
+    Unlike `nongeo_result_to_pixel`, this accepts any GeoJSON result: a FeatureCollection
+    (e.g. of bounding boxes), a MultiPolygon (each polygon being yielded as a feature) or
+    a single geometry. Feature properties and bounding boxes are preserved.
+
+    Note that this will NOT work if the image was georeferenced.
+
+    Args:
+        - result_filename (str): The file path to the GeoJSON file obtained by
+            `APIClient.download_result_to_file`
+    Returns:
+        - An iterator over GeoJSON features whose coordinates are [x, y] pixels
+    """
+    for feature in iter_features(result_filename):
+        feature['geometry'] = _geometry_to_pixel(feature.get('geometry'))
+        if 'bbox' in feature:
+            feature['bbox'] = _bbox_to_pixel(feature['bbox'])
+        yield feature
+
+
+def nongeo_result_to_pixel_file(result_filename, output_filename, output_format='geojson'):
+    """
+    Converts a result file obtained on a non-georeferenced image to pixel
+    coordinates, writing the features to output_filename as they are converted
+
+    Args:
+        - result_filename (str): The file path to the GeoJSON file obtained by
+            `APIClient.download_result_to_file`
+        - output_filename (str): The file path where to write the converted features
+        - output_format (str): 'geojson' for a FeatureCollection, 'ndjson' for
+            one feature per line
+    Returns:
+        - The number of features written
+    """
+    return write_features(
+        iter_nongeo_result_to_pixel(result_filename), output_filename, output_format)
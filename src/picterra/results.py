@@ -0,0 +1,1223 @@
+"""
+Spatial queries over detection results downloaded with
+`APIClient.download_result_to_file`, e.g. "which detections fall inside this parcel".
+
+The features of a result are loaded into flat NumPy arrays (one coordinates buffer
+delimited by offsets, as in `picterra.nongeo.PixelPolygons`, and one bounding box per
+feature) and indexed with a packed STR-tree, so that queries only look at the few
+features whose bounding box is close to the query.
+
+The same arrays can be saved to a binary result file with `convert_result`, which
+`ResultFile` memory maps, so that large results are reopened without parsing any
+JSON. Requires numpy.
+"""
+import heapq
+import json
+import logging
+import math
+import os
+
+from .geojson import iter_features, write_features
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Default number of children of the nodes of the tree
+_NODE_CAPACITY = 16
+
+# Bumped whenever the layout of saved indexes changes
+_INDEX_VERSION = 1
+
+# Geometry types, as stored in the geometry_types array; -1 stands for a null geometry.
+# All the geometries are stored as lists of parts made of rings (or linestrings, or
+# a single point), see _parts
+_GEOMETRY_TYPES = (
+    'Point', 'MultiPoint', 'LineString', 'MultiLineString', 'Polygon', 'MultiPolygon'
+)
+_POLYGONAL = (_GEOMETRY_TYPES.index('Polygon'), _GEOMETRY_TYPES.index('MultiPolygon'))
+
+
+def _parts(geometry_type, coordinates):
+    """Normalizes the coordinates of a geometry to a list of parts, of rings, of vertices"""
+    if geometry_type == 'Point':
+        return [[[coordinates]]]
+    if geometry_type == 'MultiPoint':
+        return [[[point]] for point in coordinates]
+    if geometry_type == 'LineString':
+        return [[coordinates]]
+    if geometry_type == 'MultiLineString':
+        return [[line] for line in coordinates]
+    if geometry_type == 'Polygon':
+        return [coordinates]
+    if geometry_type == 'MultiPolygon':
+        return coordinates
+    raise ValueError('Unsupported geometry type "%s"' % geometry_type)
+
+
+def _coordinates(geometry_type, parts):
+    """Inverse of `_parts`"""
+    if geometry_type == 'Point':
+        return parts[0][0][0]
+    if geometry_type == 'MultiPoint':
+        return [part[0][0] for part in parts]
+    if geometry_type == 'LineString':
+        return parts[0][0]
+    if geometry_type == 'MultiLineString':
+        return [part[0] for part in parts]
+    if geometry_type == 'Polygon':
+        return parts[0]
+    return parts
+
+
+class _ColumnsBuilder():
+    """
+    Accumulates features into flat arrays. In lossless mode, it also keeps the
+    coordinates beyond x and y (e.g. z) and all the members of the features (as JSON)
+    so that they can be rebuilt exactly, otherwise only their properties.
+    """
+    def __init__(self, lossless=False):
+        self.lossless = lossless
+        self.coords = []
+        self.ring_offsets = [0]
+        self.part_offsets = [0]
+        self.feature_offsets = [0]
+        self.geometry_types = []
+        self.properties = []
+        self.extra = []
+        self.extra_offsets = [0]
+        self.members = []
+        self.member_offsets = [0]
+
+    def __len__(self):
+        return len(self.geometry_types)
+
+    def append(self, feature):
+        geometry = feature.get('geometry')
+        if geometry is None:
+            self.geometry_types.append(-1)
+        else:
+            geometry_type = geometry['type']
+            for part in _parts(geometry_type, geometry['coordinates']):
+                for ring in part:
+                    self.coords.extend(xy[:2] for xy in ring)
+                    self.ring_offsets.append(len(self.coords))
+                    if self.lossless:
+                        for xy in ring:
+                            self.extra.extend(xy[2:])
+                            self.extra_offsets.append(len(self.extra))
+                self.part_offsets.append(len(self.ring_offsets) - 1)
+            self.geometry_types.append(_GEOMETRY_TYPES.index(geometry_type))
+        self.feature_offsets.append(len(self.part_offsets) - 1)
+        if self.lossless:
+            # Everything but the coordinates, which are stored in the arrays
+            members = dict(feature)
+            if geometry is not None:
+                members['geometry'] = {
+                    k: v for k, v in geometry.items() if k != 'coordinates'}
+            self.members.append(json.dumps(members).encode('utf-8'))
+            self.member_offsets.append(self.member_offsets[-1] + len(self.members[-1]))
+        else:
+            self.properties.append(feature.get('properties'))
+
+    def arrays(self):
+        coords = np.array(self.coords, dtype=np.float64).reshape(-1, 2)
+        ring_offsets = np.array(self.ring_offsets, dtype=np.int64)
+        part_offsets = np.array(self.part_offsets, dtype=np.int64)
+        feature_offsets = np.array(self.feature_offsets, dtype=np.int64)
+        arrays = {
+            'coords': coords,
+            'ring_offsets': ring_offsets,
+            'part_offsets': part_offsets,
+            'feature_offsets': feature_offsets,
+            'geometry_types': np.array(self.geometry_types, dtype=np.int8),
+            'bboxes': _bboxes(coords, ring_offsets[part_offsets[feature_offsets]]),
+        }
+        if self.lossless:
+            arrays.update({
+                'extra': np.array(self.extra, dtype=np.float64),
+                'extra_offsets': np.array(self.extra_offsets, dtype=np.int64),
+                'members': np.frombuffer(b''.join(self.members), dtype=np.uint8),
+                'member_offsets': np.array(self.member_offsets, dtype=np.int64),
+            })
+        return arrays
+
+
+def _bboxes(coords, offsets):
+    """
+    The (minx, miny, maxx, maxy) bounding boxes of the vertices ranges delimited by
+    offsets, NaN for empty ranges
+    """
+    bboxes = np.full((len(offsets) - 1, 4), np.nan)
+    counts = np.diff(offsets)
+    nonempty = counts > 0
+    if len(coords):
+        # reduceat does not handle empty ranges, those are masked out above
+        starts = offsets[:-1][nonempty]
+        bboxes[nonempty, :2] = np.minimum.reduceat(coords, starts)
+        bboxes[nonempty, 2:] = np.maximum.reduceat(coords, starts)
+    return bboxes
+
+
+def _str_order(bboxes, node_capacity):
+    """
+    Sort-Tile-Recursive ordering of boxes: sorted by x center into vertical slices of
+    about sqrt(number of nodes) nodes each, then by y center within each slice
+    """
+    n = len(bboxes)
+    centers = (bboxes[:, :2] + bboxes[:, 2:]) / 2
+    num_nodes = -(-n // node_capacity)
+    slice_size = node_capacity * int(np.ceil(np.sqrt(num_nodes)))
+    slices = np.empty(n, dtype=np.int64)
+    slices[np.argsort(centers[:, 0], kind='stable')] = np.arange(n) // slice_size
+    return np.lexsort((centers[:, 1], slices))
+
+
+def _pack(bboxes, node_capacity):
+    """
+    Bounding boxes of consecutive groups of node_capacity boxes; fmin/fmax skip the NaN
+    boxes of null geometries
+    """
+    starts = np.arange(0, len(bboxes), node_capacity)
+    return np.concatenate([
+        np.fmin.reduceat(bboxes[:, :2], starts), np.fmax.reduceat(bboxes[:, 2:], starts)
+    ], axis=1)
+
+
+def _intersects(bboxes, bbox):
+    return ((bboxes[:, 0] <= bbox[2]) & (bboxes[:, 2] >= bbox[0]) &
+            (bboxes[:, 1] <= bbox[3]) & (bboxes[:, 3] >= bbox[1]))
+
+
+def _bbox_distances(bboxes, x, y):
+    dx = np.fmax(np.fmax(bboxes[:, 0] - x, x - bboxes[:, 2]), 0)
+    dy = np.fmax(np.fmax(bboxes[:, 1] - y, y - bboxes[:, 3]), 0)
+    # NaN (null geometry) boxes are infinitely far
+    return np.where(np.isnan(bboxes[:, 0]), np.inf, np.hypot(dx, dy))
+
+
+def _segments(coords, ring_offsets):
+    """
+    The segments of the given rings as (start, end) vertex indices arrays, wrapping
+    around unclosed rings, and the ring each segment belongs to
+    """
+    counts = np.diff(ring_offsets)
+    start = np.arange(ring_offsets[0], ring_offsets[-1])
+    end = start + 1
+    # The last vertex of each ring connects back to its first
+    last = ring_offsets[1:][counts > 0] - 1
+    end[last - ring_offsets[0]] = ring_offsets[:-1][counts > 0]
+    rings = np.repeat(np.arange(len(counts)), counts)
+    return start, end, rings
+
+
+def _contains(coords, ring_offsets, part_offsets, x, y):
+    """Whether (x, y) lies in one of the polygons (even-odd rule)"""
+    start, end, rings = _segments(coords, ring_offsets[part_offsets[0]:part_offsets[-1] + 1])
+    x0, y0 = coords[start, 0], coords[start, 1]
+    x1, y1 = coords[end, 0], coords[end, 1]
+    straddles = (y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = straddles & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+    parts = np.searchsorted(part_offsets - part_offsets[0], rings, side='right') - 1
+    counts = np.bincount(parts[crossings], minlength=len(part_offsets) - 1)
+    return bool(np.any(counts % 2 == 1))
+
+
+def _distance(coords, ring_offsets, x, y):
+    """Distance from (x, y) to the closest vertex or segment of the given rings"""
+    start, end, _ = _segments(coords, ring_offsets)
+    a, b = coords[start], coords[end]
+    ab = b - a
+    ap = np.array([x, y]) - a
+    length2 = np.einsum('ij,ij->i', ab, ab)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(length2 > 0, np.einsum('ij,ij->i', ap, ab) / length2, 0)
+    closest = a + np.clip(t, 0, 1)[:, None] * ab
+    return float(np.min(np.hypot(closest[:, 0] - x, closest[:, 1] - y)))
+
+
+def _encode_json(value):
+    return np.frombuffer(json.dumps(value).encode('utf-8'), dtype=np.uint8)
+
+
+def _decode_json(array):
+    return json.loads(array.tobytes().decode('utf-8'))
+
+
+class _Columns():
+    """Features stored as flat arrays, see `ResultFile`"""
+    extra = extra_offsets = None
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def _rings(self, i):
+        """The ring offsets of feature i"""
+        parts = self.part_offsets[self.feature_offsets[i]:self.feature_offsets[i + 1] + 1]
+        return self.ring_offsets[parts[0]:parts[-1] + 1]
+
+    def _coordinates(self, i):
+        """The GeoJSON coordinates of feature i"""
+        return next(self._iter_coordinates(i, i + 1))
+
+    def _iter_coordinates(self, start, end):
+        """
+        The GeoJSON coordinates of features start to end (excluded), None for features
+        without geometry; the vertices of all these features are converted at once
+        """
+        features = self.feature_offsets[start:end + 1].tolist()
+        parts = self.part_offsets[features[0]:features[-1] + 1]
+        rings = self.ring_offsets[parts[0]:parts[-1] + 1]
+        coords = self.coords[rings[0]:rings[-1]].tolist()
+        if self.extra_offsets is not None:
+            offsets = self.extra_offsets[rings[0]:rings[-1] + 1].tolist()
+            extra = self.extra[offsets[0]:offsets[-1]].tolist()
+            if extra:
+                for xy, first, last in zip(coords, offsets, offsets[1:]):
+                    xy.extend(extra[first - offsets[0]:last - offsets[0]])
+        rings = (rings - rings[0]).tolist()
+        parts = (parts - parts[0]).tolist()
+        geometry_types = self.geometry_types[start:end].tolist()
+        for geometry_type, first, last in zip(geometry_types, features, features[1:]):
+            if geometry_type == -1:
+                yield None
+                continue
+            first, last = first - features[0], last - features[0]
+            yield _coordinates(_GEOMETRY_TYPES[geometry_type], [
+                [coords[rings[r]:rings[r + 1]] for r in range(parts[p], parts[p + 1])]
+                for p in range(first, last)
+            ])
+
+    def _slice(self, start, end):
+        """The arrays of features start to end (excluded), with offsets starting at 0"""
+        features = self.feature_offsets[start:end + 1]
+        parts = self.part_offsets[features[0]:features[-1] + 1]
+        rings = self.ring_offsets[parts[0]:parts[-1] + 1]
+        return {
+            'coords': self.coords[rings[0]:rings[-1]],
+            'ring_offsets': rings - rings[0],
+            'part_offsets': parts - parts[0],
+            'feature_offsets': features - features[0],
+            'geometry_types': self.geometry_types[start:end],
+            'bboxes': self.bboxes[start:end],
+        }
+
+    def _iter_all_coordinates(self):
+        for start in range(0, len(self), _BATCH_SIZE):
+            yield from self._iter_coordinates(start, min(start + _BATCH_SIZE, len(self)))
+
+    def geometry(self, i):
+        """The GeoJSON geometry of feature i"""
+        geometry_type = int(self.geometry_types[i])
+        if geometry_type == -1:
+            return None
+        return {'type': _GEOMETRY_TYPES[geometry_type], 'coordinates': self._coordinates(i)}
+
+
+class ResultIndex(_Columns):
+    """
+    Spatial index over the features of a detection result, supporting bounding box,
+    point and nearest neighbour queries. Queries return indices of features, in the
+    order of the result file; use `feature` to get the features themselves.
+
+    Coordinates are those of the result file (longitude/latitude), or pixels when
+    built with `pixel=True` for a result on a non-georeferenced raster. Distances are
+    expressed in the same units.
+
+    Build with `from_file`, save with `save` and reopen with `load`, or use
+    `load_result_index` which takes care of caching the index next to the result.
+
+    The features are stored in the arrays described in `ResultFile`, and their
+    properties in the `properties` list.
+    """
+    def __init__(self, coords, ring_offsets, part_offsets, feature_offsets, geometry_types,
+                 bboxes, properties, node_capacity=_NODE_CAPACITY, tree=None):
+        if np is None:
+            raise ImportError('ResultIndex requires numpy')
+        self.coords = coords
+        self.ring_offsets = ring_offsets
+        self.part_offsets = part_offsets
+        self.feature_offsets = feature_offsets
+        self.geometry_types = geometry_types
+        self.bboxes = bboxes
+        self.properties = properties
+        self.node_capacity = node_capacity
+        if tree is None:
+            tree = self._build_tree()
+        # The tree is the STR order of the features and the boxes of the nodes of each
+        # level, from the leaves (the features, in STR order) up to the root: node i
+        # of a level has nodes [i * node_capacity, (i + 1) * node_capacity) of the level
+        # below as children
+        self._order, self._levels = tree
+
+    def _build_tree(self):
+        order = _str_order(self.bboxes, self.node_capacity)
+        levels = [self.bboxes[order]]
+        while len(levels[-1]) > self.node_capacity:
+            levels.append(_pack(levels[-1], self.node_capacity))
+        return order, levels
+
+    @classmethod
+    def from_file(cls, result_filename, pixel=False, node_capacity=_NODE_CAPACITY):
+        """
+        Builds the index of a result, streaming through the file
+
+        Args:
+            - result_filename (str): The path to a GeoJSON result, or to a result
+                converted with `convert_result`
+            - pixel (bool): Whether to convert the coordinates to pixels first, for a
+                result on a non-georeferenced raster (see `picterra.nongeo`)
+            - node_capacity (int): Number of children of the nodes of the tree
+        """
+        if is_result_file(result_filename):
+            return ResultFile(result_filename).index(pixel, node_capacity)
+        if pixel:
+            from .nongeo import iter_nongeo_result_to_pixel
+            features = iter_nongeo_result_to_pixel(result_filename)
+        else:
+            features = iter_features(result_filename)
+        return cls.from_features(features, node_capacity)
+
+    @classmethod
+    def from_features(cls, features, node_capacity=_NODE_CAPACITY):
+        """Builds the index of an iterable of GeoJSON features"""
+        if np is None:
+            raise ImportError('ResultIndex requires numpy')
+        builder = _ColumnsBuilder()
+        for feature in features:
+            builder.append(feature)
+        return cls(properties=builder.properties, node_capacity=node_capacity,
+                   **builder.arrays())
+
+    def save(self, filename, source=None):
+        """
+        Saves the index and the features to a .npz file, so that it can be reopened
+        with `load` without rebuilding it
+
+        Args:
+            - filename (str): The path of the file to write
+            - source (dict): Optional metadata stored along, used by `load_result_index`
+                to tell whether the index is up to date
+        """
+        meta = {
+            'version': _INDEX_VERSION, 'node_capacity': self.node_capacity,
+            'num_levels': len(self._levels), 'source': source,
+        }
+        levels = {'level%d' % i: level for i, level in enumerate(self._levels[1:], 1)}
+        with open(filename, 'wb') as f:
+            np.savez(
+                f, coords=self.coords, ring_offsets=self.ring_offsets,
+                part_offsets=self.part_offsets, feature_offsets=self.feature_offsets,
+                geometry_types=self.geometry_types, bboxes=self.bboxes, order=self._order,
+                properties=_encode_json(list(self.properties)),
+                meta=_encode_json(meta), **levels)
+
+    @classmethod
+    def load(cls, filename):
+        """Opens an index saved with `save`"""
+        if np is None:
+            raise ImportError('ResultIndex requires numpy')
+        index, _ = cls._load(filename)
+        return index
+
+    @classmethod
+    def _load(cls, filename):
+        with np.load(filename, allow_pickle=False) as data:
+            meta = _decode_json(data['meta'])
+            if meta['version'] != _INDEX_VERSION:
+                raise ValueError('Unsupported index version %s' % meta['version'])
+            order = data['order']
+            levels = [data['bboxes'][order]] + [
+                data['level%d' % i] for i in range(1, meta['num_levels'])]
+            index = cls(
+                data['coords'], data['ring_offsets'], data['part_offsets'],
+                data['feature_offsets'], data['geometry_types'], data['bboxes'],
+                _decode_json(data['properties']), meta['node_capacity'],
+                tree=(order, levels))
+        return index, meta['source']
+
+    def __repr__(self):
+        return '<ResultIndex: %d features>' % len(self)
+
+    @property
+    def bounds(self):
+        """The (minx, miny, maxx, maxy) bounding box of all the features"""
+        top = self._levels[-1]
+        if np.isnan(top[:, 0]).all():
+            return None
+        return tuple(
+            np.nanmin(top[:, :2], axis=0).tolist() + np.nanmax(top[:, 2:], axis=0).tolist())
+
+    def feature(self, i):
+        """Feature i, as a GeoJSON dictionary"""
+        return {'type': 'Feature', 'geometry': self.geometry(i),
+                'properties': self.properties[i]}
+
+    def query_bbox(self, bbox):
+        """
+        Features whose bounding box intersects bbox
+
+        Args:
+            - bbox: The (minx, miny, maxx, maxy) query box
+        Returns:
+            - A sorted int64 array of feature indices
+        """
+        if not len(self):
+            return np.empty(0, dtype=np.int64)
+        levels = self._levels
+        candidates = np.flatnonzero(_intersects(levels[-1], bbox))
+        for level in levels[-2::-1]:
+            children = (
+                candidates[:, None] * self.node_capacity + np.arange(self.node_capacity)
+            ).ravel()
+            children = children[children < len(level)]
+            candidates = children[_intersects(level[children], bbox)]
+        return np.sort(self._order[candidates])
+
+    def query_point(self, x, y):
+        """
+        Polygonal features containing the point (x, y)
+
+        Returns:
+            - A sorted int64 array of feature indices
+        """
+        candidates = self.query_bbox((x, y, x, y))
+        return np.array([
+            i for i in candidates.tolist()
+            if self.geometry_types[i] in _POLYGONAL and self._contains(i, x, y)
+        ], dtype=np.int64)
+
+    def _contains(self, i, x, y):
+        parts = self.part_offsets[self.feature_offsets[i]:self.feature_offsets[i + 1] + 1]
+        return _contains(self.coords, self.ring_offsets, parts, x, y)
+
+    def distance(self, i, x, y):
+        """Distance from (x, y) to feature i, 0 if the point lies inside a polygon"""
+        if self.geometry_types[i] == -1:
+            return np.inf
+        if self.geometry_types[i] in _POLYGONAL and self._contains(i, x, y):
+            return 0.0
+        return _distance(self.coords, self._rings(i), x, y)
+
+    def nearest(self, x, y, k=1, max_distance=None):
+        """
+        The k features closest to (x, y), using a best-first traversal of the tree
+
+        Args:
+            - x, y (float): The query point
+            - k (int): The number of features to return
+            - max_distance (float): If set, ignore features further than this
+        Returns:
+            - A list of (feature index, distance) tuples, closest first
+        """
+        if max_distance is None:
+            max_distance = np.inf
+        top = len(self._levels) - 1
+        # The heap holds (distance, level, node) with level -1 for features whose exact
+        # distance is known: box distances are lower bounds of the distances of the
+        # features in the boxes, so anything popped before them cannot be beaten
+        heap = []
+
+        def push(level, nodes):
+            if level == 0:
+                nodes = nodes[nodes < len(self._levels[0])]
+            distances = _bbox_distances(self._levels[level][nodes], x, y)
+            for d, node in zip(distances.tolist(), nodes.tolist()):
+                if d <= max_distance:
+                    heapq.heappush(heap, (d, level, node))
+
+        if len(self):
+            push(top, np.arange(len(self._levels[top])))
+        found = []
+        while heap and len(found) < k:
+            d, level, node = heapq.heappop(heap)
+            if level == -1:
+                found.append((node, d))
+            elif level == 0:
+                i = int(self._order[node])
+                d = self.distance(i, x, y)
+                if d <= max_distance:
+                    heapq.heappush(heap, (d, -1, i))
+            else:
+                children = node * self.node_capacity + np.arange(self.node_capacity)
+                push(level - 1, children[children < len(self._levels[level - 1])])
+        return found
+
+
+def load_result_index(result_filename, pixel=False, index_filename=None):
+    """
+    Opens the spatial index of a result, building it on the first call and saving it
+    next to the result so that later calls just reload it. The index is rebuilt when
+    the result file changes.
+
+    Args:
+        - result_filename (str): The path to a GeoJSON result, as obtained by
+            `APIClient.download_result_to_file`
+        - pixel (bool): Whether to index pixel coordinates, for a result on a
+            non-georeferenced raster
+        - index_filename (str): Where to save the index, defaults to the result path
+            with a `.index.npz` (or `.pixel-index.npz` with pixel=True) suffix
+    Returns:
+        - A `ResultIndex`
+    """
+    if index_filename is None:
+        index_filename = result_filename + ('.pixel-index.npz' if pixel else '.index.npz')
+    stat = os.stat(result_filename)
+    source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'pixel': pixel}
+    if os.path.exists(index_filename):
+        try:
+            index, saved_source = ResultIndex._load(index_filename)
+            if saved_source == source:
+                return index
+        except (OSError, ValueError, KeyError):
+            pass  # Corrupt or outdated, rebuild it
+    index = ResultIndex.from_file(result_filename, pixel=pixel)
+    index.save(index_filename, source)
+    return index
+
+
+# Binary result files start with this magic, followed by the length of the JSON
+# header (little-endian uint64), the header, and the columns, each aligned on
+# _ALIGNMENT bytes. The header tells the dtype, shape and offset of each column.
+_MAGIC = b'PICTRES\x00'
+_FILE_VERSION = 1
+_ALIGNMENT = 64
+
+# Offsets columns, and the column they index into
+_OFFSETS = {
+    'ring_offsets': 'coords', 'part_offsets': 'ring_offsets',
+    'feature_offsets': 'part_offsets', 'extra_offsets': 'extra',
+    'member_offsets': 'members',
+}
+
+_BATCH_SIZE = 10000
+
+
+def _padding(size):
+    return -size % _ALIGNMENT
+
+
+def _num_rows(name, array):
+    return len(array) - 1 if name in _OFFSETS else len(array)
+
+
+class _ResultWriter():
+    """
+    Writes features to a binary result file as they come: the columns of each batch
+    of features go to temporary files, which are assembled when closing
+    """
+    def __init__(self, filename, batch_size=_BATCH_SIZE):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.builder = _ColumnsBuilder(lossless=True)
+        self.columns = {}
+        self.rows = {}
+        self.count = 0
+
+    def append(self, feature):
+        self.builder.append(feature)
+        if len(self.builder) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        import tempfile
+        arrays = self.builder.arrays()
+        for name, array in arrays.items():
+            if name not in self.columns:
+                self.columns[name] = tempfile.TemporaryFile(
+                    dir=os.path.dirname(os.path.abspath(self.filename)))
+                self.rows[name] = 0
+                if name in _OFFSETS:
+                    array[:1].tofile(self.columns[name])
+            if name in _OFFSETS:
+                # The offsets of each batch start at 0, shift them after the previous ones
+                (array[1:] + self.rows[_OFFSETS[name]]).tofile(self.columns[name])
+            else:
+                array.tofile(self.columns[name])
+        for name, array in arrays.items():
+            self.rows[name] += _num_rows(name, array)
+        self.count += len(self.builder)
+        self.builder = _ColumnsBuilder(lossless=True)
+
+    def close(self, source):
+        import shutil
+        if len(self.builder) or not self.columns:
+            self._flush()
+        arrays = _ColumnsBuilder(lossless=True).arrays()
+        if not self.rows['extra']:
+            # No coordinates beyond x and y, no need for these
+            for name in ('extra', 'extra_offsets'):
+                self.columns.pop(name).close()
+        header = {'version': _FILE_VERSION, 'count': self.count, 'source': source,
+                  'columns': {}}
+        offset = 0
+        for name, f in self.columns.items():
+            array = arrays[name]
+            shape = [self.rows[name] + (name in _OFFSETS)] + list(array.shape[1:])
+            header['columns'][name] = {
+                'dtype': array.dtype.str, 'shape': shape, 'offset': offset}
+            offset += f.tell()
+            offset += _padding(offset)
+        header = json.dumps(header).encode('utf-8')
+        start = len(_MAGIC) + 8 + len(header)
+        start += _padding(start)
+        with open(self.filename, 'wb') as out:
+            out.write(_MAGIC)
+            out.write(np.uint64(len(header)).astype('<u8').tobytes())
+            out.write(header)
+            out.write(b'\0' * (start - out.tell()))
+            for f in self.columns.values():
+                f.seek(0)
+                shutil.copyfileobj(f, out)
+                f.close()
+                out.write(b'\0' * _padding(out.tell() - start))
+        return self.count
+
+
+def convert_result(result_filename, output_filename, batch_size=_BATCH_SIZE):
+    """
+    Converts a result to the binary result format, streaming through it so that only
+    batch_size features are held in memory at once. The binary file opens instantly
+    with `ResultFile`, and converts back to the original GeoJSON with
+    `ResultFile.to_geojson`.
+
+    Args:
+        - result_filename (str): The path to a GeoJSON result, as obtained by
+            `APIClient.download_result_to_file`
+        - output_filename (str): The path of the binary file to write
+        - batch_size (int): Number of features converted at once
+    Returns:
+        - The number of features written
+    """
+    if np is None:
+        raise ImportError('convert_result requires numpy')
+    writer = _ResultWriter(output_filename, batch_size)
+    members = {}
+    for feature in iter_features(result_filename, members=members):
+        writer.append(feature)
+    # The members of the top-level object, so that it can be written back; a single
+    # feature or geometry is stored as such, only its type is needed
+    if members.get('type') in ('FeatureCollection', 'MultiPolygon'):
+        source = {k: v for k, v in members.items() if k != 'coordinates'}
+    else:
+        source = {'type': members.get('type')}
+    return writer.close(source)
+
+
+def is_result_file(filename):
+    """Whether filename is a binary result file written by `convert_result`"""
+    with open(filename, 'rb') as f:
+        return f.read(len(_MAGIC)) == _MAGIC
+
+
+class _Properties():
+    """Lazy sequence of the properties of the features of a `ResultFile`"""
+    def __init__(self, result):
+        self.result = result
+
+    def __len__(self):
+        return len(self.result)
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError('feature index out of range')
+        return self.result._members(i).get('properties')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class ResultFile(_Columns):
+    """
+    Reader of binary result files written by `convert_result`. The file is memory
+    mapped: opening it costs nothing whatever its size, its columns are exposed as
+    read-only NumPy views on the file and features are only decoded when accessed.
+
+    Attributes:
+        - coords, ring_offsets, part_offsets, feature_offsets: the vertices of the
+            features, feature i being made of the parts (polygons, linestrings or
+            points) feature_offsets[i] to feature_offsets[i + 1] (excluded), each part
+            being made of rings delimited by part_offsets, each ring of vertices
+            delimited by ring_offsets
+        - geometry_types: int8 array, index of the type of each geometry in
+            ('Point', 'MultiPoint', 'LineString', 'MultiLineString', 'Polygon',
+            'MultiPolygon'), -1 for features without geometry
+        - bboxes: float64 array of shape (N, 4) with the (minx, miny, maxx, maxy)
+            bounding box of each feature (NaN for features without geometry)
+        - extra, extra_offsets: optional, the coordinates of vertex j beyond x and y
+            are extra[extra_offsets[j]:extra_offsets[j + 1]]
+        - source (dict): The type and members of the top-level GeoJSON object
+    """
+    def __init__(self, filename):
+        if np is None:
+            raise ImportError('ResultFile requires numpy')
+        with open(filename, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('%s is not a binary result file' % filename)
+            size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(size).decode('utf-8'))
+            start = f.tell() + _padding(f.tell())
+        if header['version'] != _FILE_VERSION:
+            raise ValueError('Unsupported result file version %s' % header['version'])
+        self.filename = filename
+        self.source = header['source']
+        data = np.memmap(filename, dtype=np.uint8, mode='r')
+        for name, column in header['columns'].items():
+            dtype = np.dtype(column['dtype'])
+            offset = start + column['offset']
+            size = int(np.prod(column['shape'])) * dtype.itemsize
+            setattr(self, name, data[offset:offset + size].view(dtype).reshape(column['shape']))
+        self.properties = _Properties(self)
+
+    def __repr__(self):
+        return '<ResultFile %s: %d features>' % (self.filename, len(self))
+
+    def __iter__(self):
+        for i, coordinates in enumerate(self._iter_all_coordinates()):
+            yield self._feature(i, coordinates)
+
+    def _members(self, i):
+        start, end = self.member_offsets[i:i + 2]
+        return json.loads(self.members[start:end].tobytes().decode('utf-8'))
+
+    def _feature(self, i, coordinates):
+        feature = self._members(i)
+        if feature.get('geometry') is not None:
+            feature['geometry']['coordinates'] = coordinates
+        return feature
+
+    def feature(self, i):
+        """Feature i, as a GeoJSON dictionary identical to the one of the original file"""
+        return self._feature(i, self._coordinates(i))
+
+    def geometry(self, i):
+        """The GeoJSON geometry of feature i"""
+        return self.feature(i).get('geometry')
+
+    def index(self, pixel=False, node_capacity=_NODE_CAPACITY):
+        """
+        Builds a `ResultIndex` directly from the columns, without going through
+        GeoJSON; its features are read lazily from this file
+
+        Args:
+            - pixel (bool): Whether to convert the coordinates to pixels first, for a
+                result on a non-georeferenced raster (see `picterra.nongeo`)
+            - node_capacity (int): Number of children of the nodes of the tree
+        """
+        coords, bboxes = self.coords, self.bboxes
+        if pixel:
+            from .nongeo import _nongeo_lnglat2xy_array
+            coords = _nongeo_lnglat2xy_array(coords)
+            bboxes = _bboxes(coords, self.ring_offsets[self.part_offsets[self.feature_offsets]])
+        return ResultIndex(
+            coords, self.ring_offsets, self.part_offsets, self.feature_offsets,
+            self.geometry_types, bboxes, self.properties, node_capacity)
+
+    def to_geojson(self, output_filename):
+        """
+        Writes the features back to a GeoJSON file, as they were in the original
+        result (a FeatureCollection, a MultiPolygon, or a single feature or geometry)
+
+        Returns:
+            - The number of features written
+        """
+        source_type = self.source.get('type')
+        if source_type == 'MultiPolygon':
+            # Stream the polygons of the features, which all come from the MultiPolygon
+            head = json.dumps(dict(self.source, coordinates=None))[:-len('null}')]
+            with open(output_filename, 'w', encoding='utf-8') as f:
+                f.write(head + '[')
+                for i, coordinates in enumerate(self._iter_all_coordinates()):
+                    if i:
+                        f.write(',\n')
+                    f.write(json.dumps(coordinates))
+                f.write(']}')
+        elif source_type in ('FeatureCollection', None):
+            members = {k: v for k, v in self.source.items() if k != 'type'}
+            write_features(iter(self), output_filename, members=members)
+        else:
+            feature = self.feature(0)
+            with open(output_filename, 'w', encoding='utf-8') as f:
+                json.dump(feature if source_type == 'Feature' else feature['geometry'], f)
+        return len(self)
+
+
+# Same as the one of the EPSG 3857 projection, see picterra.nongeo
+_EARTH_RADIUS = 6378137
+
+
+def _ring_measures(coords, ring_offsets, geographic):
+    """
+    The area and length of each ring: on the sphere in square meters and meters for
+    longitudes/latitudes, with the shoelace formula otherwise
+    """
+    counts = np.diff(ring_offsets)
+    rings = np.repeat(np.arange(len(counts)), counts)
+    # The segments between consecutive vertices of the same ring
+    same_ring = rings[:-1] == rings[1:]
+    a, b = coords[:-1][same_ring], coords[1:][same_ring]
+    rings = rings[:-1][same_ring]
+    if geographic:
+        lng0, lat0 = np.radians(a[:, 0]), np.radians(a[:, 1])
+        lng1, lat1 = np.radians(b[:, 0]), np.radians(b[:, 1])
+        # Spherical excess of the ring, as in "Some algorithms for polygons on a sphere"
+        # (Chamberlain and Duquette, JPL 2007)
+        area_terms = (lng1 - lng0) * (2 + np.sin(lat0) + np.sin(lat1))
+        area_scale = _EARTH_RADIUS ** 2 / 2
+        # Haversine
+        h = (np.sin((lat1 - lat0) / 2) ** 2 +
+             np.cos(lat0) * np.cos(lat1) * np.sin((lng1 - lng0) / 2) ** 2)
+        lengths = 2 * _EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1)))
+    else:
+        area_terms = a[:, 0] * b[:, 1] - b[:, 0] * a[:, 1]
+        area_scale = 0.5
+        lengths = np.hypot(b[:, 0] - a[:, 0], b[:, 1] - a[:, 1])
+    areas = np.abs(np.bincount(rings, area_terms, minlength=len(counts))) * area_scale
+    return areas, np.bincount(rings, lengths, minlength=len(counts))
+
+
+def _feature_measures(arrays, geographic):
+    """
+    The area and perimeter of each feature: holes are subtracted from the areas of
+    polygons, other geometries have no area and the perimeter of lines is their length
+    """
+    ring_offsets, part_offsets = arrays['ring_offsets'], arrays['part_offsets']
+    feature_offsets = arrays['feature_offsets']
+    ring_areas, ring_lengths = _ring_measures(arrays['coords'], ring_offsets, geographic)
+    ring_parts = np.repeat(np.arange(len(part_offsets) - 1), np.diff(part_offsets))
+    ring_features = np.repeat(
+        np.arange(len(feature_offsets) - 1), np.diff(feature_offsets))[ring_parts]
+    # The first ring of each polygon is its exterior, the others are holes
+    exterior = np.zeros(len(ring_areas), dtype=bool)
+    exterior[part_offsets[:-1][np.diff(part_offsets) > 0]] = True
+    polygonal = np.isin(arrays['geometry_types'], _POLYGONAL)[ring_features]
+    ring_areas = np.where(polygonal, np.where(exterior, ring_areas, -ring_areas), 0)
+    num_features = len(feature_offsets) - 1
+    return (np.bincount(ring_features, ring_areas, minlength=num_features),
+            np.bincount(ring_features, ring_lengths, minlength=num_features))
+
+
+def _iter_batches(result, client, batch_size):
+    """The arrays of the features of a result, batch_size features at a time"""
+    if os.path.exists(result) and is_result_file(result):
+        result_file = ResultFile(result)
+        for start in range(0, len(result_file), batch_size):
+            yield result_file._slice(start, min(start + batch_size, len(result_file)))
+        return
+    if os.path.exists(result):
+        features = iter_features(result)
+    else:
+        if client is None:
+            from .client import APIClient
+            client = APIClient()
+        features = client.iter_result_features(result)
+    builder = _ColumnsBuilder()
+    for feature in features:
+        builder.append(feature)
+        if len(builder) >= batch_size:
+            yield builder.arrays()
+            builder = _ColumnsBuilder()
+    if len(builder):
+        yield builder.arrays()
+
+
+def result_stats(result, client=None, pixel=False, bins=None, batch_size=_BATCH_SIZE):
+    """
+    Computes aggregate statistics of a result in a single streaming pass, batch_size
+    features at a time, so that memory use does not depend on the size of the result
+
+    Areas and perimeters are computed on the sphere, in square meters and meters, or in
+    pixels with pixel=True for a result on a non-georeferenced raster. Holes are
+    subtracted from the areas of polygons, points and lines have no area.
+
+    Args:
+        - result (str): The path to a result file (GeoJSON, or binary as written by
+            `convert_result`), or the id of a detection operation whose result is then
+            streamed from the API without being saved
+        - client (APIClient): The client used to stream results, a default one if None
+        - pixel (bool): Whether to compute in pixel space, see `picterra.nongeo`
+        - bins (list): Edges of the bins of the area histogram; by default there is
+            one bin per power of 10 (e.g. [10, 100) square meters) and one for null areas
+        - batch_size (int): Number of features processed at once
+    Returns:
+        - A dictionary with the count of features, the total, mean, min and max of
+            their areas, the total and mean of their perimeters, their (minx, miny,
+            maxx, maxy) bounding box, the area histogram as a list of
+            {"min": ..., "max": ..., "count": ...} bins and the units ("m" or "px")
+    """
+    if np is None:
+        raise ImportError('result_stats requires numpy')
+    if pixel:
+        from .nongeo import _nongeo_lnglat2xy_array
+    count = 0
+    total_area = total_perimeter = 0.0
+    min_area, max_area = math.inf, -math.inf
+    bbox = np.array([np.nan] * 4)
+    if bins is None:
+        decades = {}
+    else:
+        bins = np.asarray(bins, dtype=np.float64)
+        histogram = np.zeros(len(bins) - 1, dtype=np.int64)
+    for arrays in _iter_batches(result, client, batch_size):
+        if pixel:
+            arrays['coords'] = _nongeo_lnglat2xy_array(arrays['coords'])
+            ring_offsets = arrays['ring_offsets']
+            arrays['bboxes'] = _bboxes(arrays['coords'], ring_offsets[
+                arrays['part_offsets'][arrays['feature_offsets']]])
+        areas, perimeters = _feature_measures(arrays, geographic=not pixel)
+        count += len(areas)
+        total_area += float(areas.sum())
+        total_perimeter += float(perimeters.sum())
+        if len(areas):
+            min_area = min(min_area, float(areas.min()))
+            max_area = max(max_area, float(areas.max()))
+        bboxes = arrays['bboxes']
+        bbox = np.concatenate([
+            np.fmin(bbox[:2], np.fmin.reduce(bboxes[:, :2], initial=np.nan)),
+            np.fmax(bbox[2:], np.fmax.reduce(bboxes[:, 2:], initial=np.nan)),
+        ])
+        if bins is None:
+            # The zero areas go to the -inf decade
+            with np.errstate(divide='ignore'):
+                keys, counts = np.unique(
+                    np.floor(np.log10(np.maximum(areas, 0))), return_counts=True)
+            for key, n in zip(keys.tolist(), counts.tolist()):
+                decades[key] = decades.get(key, 0) + n
+        else:
+            histogram += np.histogram(areas, bins)[0]
+    if bins is None:
+        area_histogram = [
+            {'min': 0.0 if k == -math.inf else 10.0 ** k,
+             'max': 0.0 if k == -math.inf else 10.0 ** (k + 1), 'count': n}
+            for k, n in sorted(decades.items())
+        ]
+    else:
+        area_histogram = [
+            {'min': low, 'max': high, 'count': n}
+            for low, high, n in zip(bins[:-1].tolist(), bins[1:].tolist(), histogram.tolist())
+        ]
+    return {
+        'count': count,
+        'total_area': total_area,
+        'mean_area': total_area / count if count else None,
+        'min_area': min_area if count else None,
+        'max_area': max_area if count else None,
+        'total_perimeter': total_perimeter,
+        'mean_perimeter': total_perimeter / count if count else None,
+        'bbox': None if np.isnan(bbox).any() else bbox.tolist(),
+        'area_histogram': area_histogram,
+        'units': 'px' if pixel else 'm',
+    }
+
+
+# Default number of records loaded at once when merging results
+_MERGE_CHUNK_SIZE = 1 << 20
+
+_TILE_RECORD = [('tile', '<i8'), ('id', '<i8'), ('bbox', '<f8', (4,))]
+
+
+def _tile_records(bboxes, ids, origin, tile_size, num_x_tiles):
+    """
+    One (tile, id, bbox) record for every tile overlapped by each box, tiles being
+    numbered row by row from origin
+    """
+    x0, y0 = origin
+    tx0 = np.floor((bboxes[:, 0] - x0) / tile_size).astype(np.int64)
+    ty0 = np.floor((bboxes[:, 1] - y0) / tile_size).astype(np.int64)
+    tx1 = np.floor((bboxes[:, 2] - x0) / tile_size).astype(np.int64)
+    ty1 = np.floor((bboxes[:, 3] - y0) / tile_size).astype(np.int64)
+    widths = tx1 - tx0 + 1
+    counts = widths * (ty1 - ty0 + 1)
+    index = np.repeat(np.arange(len(bboxes)), counts)
+    # Position of each record among the tiles of its box
+    k = np.arange(len(index)) - np.repeat(np.cumsum(counts) - counts, counts)
+    records = np.empty(len(index), dtype=_TILE_RECORD)
+    records['tile'] = ((ty0[index] + k // widths[index]) * num_x_tiles +
+                       tx0[index] + k % widths[index])
+    records['id'] = ids[index]
+    records['bbox'] = bboxes[index]
+    return records
+
+
+def _duplicates(records, tile_origins, tile_size, iou_threshold, distance):
+    """
+    The ids of the records that duplicate an earlier record (smaller id) of the same
+    tile, found with a sweep along x within each tile
+    """
+    order = np.lexsort((records['bbox'][:, 0], records['tile']))
+    records = records[order]
+    bboxes = records['bbox']
+    # Dense tile numbers plus the normalized x of the boxes within their tile make a
+    # single sorted key, so that a vectorized searchsorted finds, for each box, the
+    # following boxes of its tile that start before it ends
+    tiles, rank = np.unique(records['tile'], return_inverse=True)
+    x0 = tile_origins(tiles)[rank]
+    key = rank * 4 + 1 + np.clip((bboxes[:, 0] - x0) / tile_size, -1, 2)
+    end = np.searchsorted(
+        key, rank * 4 + 1 + np.clip((bboxes[:, 2] - x0) / tile_size, -1, 2), side='right')
+    duplicates = []
+    start = 0
+    while start < len(records):
+        # Bound the number of candidate pairs held at once
+        counts = np.maximum(end[start:] - np.arange(start, len(records)) - 1, 0)
+        stop = start + max(1, int(np.searchsorted(np.cumsum(counts), _MERGE_CHUNK_SIZE)))
+        counts = counts[:stop - start]
+        i = np.repeat(np.arange(start, stop), counts)
+        j = i + 1 + np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+        a, b = bboxes[i], bboxes[j]
+        if distance is None:
+            w = np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0])
+            h = np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1])
+            intersection = np.where((w >= 0) & (h >= 0), w * h, 0)
+            union = ((a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]) +
+                     (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]) - intersection)
+            # Degenerate boxes (e.g. points) only duplicate identical boxes
+            with np.errstate(divide='ignore', invalid='ignore'):
+                iou = np.where(union > 0, intersection / union,
+                               np.all(a == b, axis=1).astype(np.float64))
+            duplicate = iou >= iou_threshold
+        else:
+            # The boxes are the centers padded by half the distance
+            duplicate = np.hypot(
+                (a[:, 0] + a[:, 2] - b[:, 0] - b[:, 2]) / 2,
+                (a[:, 1] + a[:, 3] - b[:, 1] - b[:, 3]) / 2) <= distance
+        ids = records['id']
+        duplicates.append(np.maximum(ids[i[duplicate]], ids[j[duplicate]]))
+        start = stop
+    return np.concatenate(duplicates) if duplicates else np.empty(0, dtype=np.int64)
+
+
+def _iter_bboxes(result_filenames, batch_size=_BATCH_SIZE):
+    """The bounding boxes of the features of the results, batch by batch"""
+    builder = _ColumnsBuilder()
+    for result_filename in result_filenames:
+        for feature in iter_features(result_filename):
+            builder.append({'geometry': feature.get('geometry')})
+            if len(builder) >= batch_size:
+                yield builder.arrays()['bboxes']
+                builder = _ColumnsBuilder()
+    if len(builder):
+        yield builder.arrays()['bboxes']
+
+
+def merge_results(result_filenames, output_filename, iou_threshold=0.5, distance=None,
+                  output_format='geojson', tile_size=None, chunk_size=_MERGE_CHUNK_SIZE):
+    """
+    Merges several results into one, removing the duplicated objects, e.g. those
+    detected twice on the overlap of neighbouring rasters. A feature is dropped when an
+    earlier feature (in the order of result_filenames, then of the files) duplicates it:
+    their bounding boxes overlap with an IoU of at least iou_threshold or, if distance
+    is set, the centers of their bounding boxes are at most that far apart.
+
+    Memory use is bounded whatever the number of features: the results are streamed
+    three times, first to save the bounding boxes to a temporary file, then to look for
+    duplicates tile by tile, the (tile, feature) pairs being partitioned in temporary
+    files of about chunk_size records, and finally to write the features that are kept.
+    Only one byte per feature is held in memory, to flag the duplicates.
+
+    Args:
+        - result_filenames (list): The paths of the GeoJSON results to merge
+        - output_filename (str): The path of the merged result
+        - iou_threshold (float): Minimum intersection over union of the bounding
+            boxes of duplicates
+        - distance (float): If set, use the distance between the centers of the
+            bounding boxes instead of their IoU; in the units of the coordinates
+            (degrees for geographic results)
+        - output_format (str): 'geojson' for a FeatureCollection, 'ndjson' for one
+            feature per line
+        - tile_size (float): Size of the tiles, in the units of the coordinates; by
+            default large compared to the objects, so that few of them straddle tiles
+        - chunk_size (int): Number of records processed at once
+    Returns:
+        - The number of features written
+    """
+    import tempfile
+    if np is None:
+        raise ImportError('merge_results requires numpy')
+    result_filenames = list(result_filenames)
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(output_filename))) as tmpdir:
+        # Pass 1: save the bounding boxes, and the statistics to choose the tiles
+        bboxes_filename = os.path.join(tmpdir, 'bboxes')
+        count = 0
+        bounds = np.array([np.inf, np.inf, -np.inf, -np.inf])
+        sizes = []
+        with open(bboxes_filename, 'wb') as f:
+            for bboxes in _iter_bboxes(result_filenames):
+                if distance is not None:
+                    centers = np.tile((bboxes[:, :2] + bboxes[:, 2:]) / 2, 2)
+                    bboxes = centers + np.array([-1, -1, 1, 1]) * distance / 2
+                bboxes.tofile(f)
+                count += len(bboxes)
+                valid = bboxes[~np.isnan(bboxes[:, 0])]
+                if len(valid):
+                    bounds = np.concatenate([
+                        np.minimum(bounds[:2], valid[:, :2].min(axis=0)),
+                        np.maximum(bounds[2:], valid[:, 2:].max(axis=0))])
+                    if sum(len(s) for s in sizes) < chunk_size:
+                        sizes.append(np.max(valid[:, 2:] - valid[:, :2], axis=1))
+        duplicated = np.zeros(count, dtype=bool)
+        if sizes:
+            if tile_size is None:
+                sizes = np.concatenate(sizes)
+                tile_size = max(32 * float(np.median(sizes)), float(np.percentile(sizes, 99.9)))
+                if tile_size <= 0:
+                    tile_size = max(float(np.max(bounds[2:] - bounds[:2])), 1.0)
+            num_x_tiles = int((bounds[2] - bounds[0]) // tile_size) + 1
+            num_y_tiles = int((bounds[3] - bounds[1]) // tile_size) + 1
+            if num_x_tiles * num_y_tiles >= 2 ** 62:
+                raise ValueError('tile_size %g is too small for the extent of the results' % (
+                    tile_size))
+            logger.debug('Merging %d features on %d x %d tiles of size %g' % (
+                count, num_x_tiles, num_y_tiles, tile_size))
+
+            def tile_origins(tiles):
+                return bounds[0] + (tiles % num_x_tiles) * tile_size
+
+            # Pass 2: partition the (tile, feature) records by tile and deduplicate
+            # each partition
+            bboxes = np.memmap(bboxes_filename, dtype=np.float64, mode='r').reshape(-1, 4)
+            num_partitions = -(-2 * count // chunk_size)
+            partitions = [
+                open(os.path.join(tmpdir, 'partition%d' % i), 'wb')
+                for i in range(num_partitions)
+            ]
+            try:
+                for start in range(0, count, chunk_size):
+                    chunk = np.asarray(bboxes[start:start + chunk_size])
+                    ids = np.arange(start, start + len(chunk))
+                    valid = ~np.isnan(chunk[:, 0])
+                    records = _tile_records(
+                        chunk[valid], ids[valid], bounds[:2], tile_size, num_x_tiles)
+                    partition = records['tile'] % num_partitions
+                    order = np.argsort(partition, kind='stable')
+                    offsets = np.searchsorted(partition[order], np.arange(num_partitions + 1))
+                    for f, first, last in zip(partitions, offsets, offsets[1:]):
+                        records[order[first:last]].tofile(f)
+            finally:
+                for f in partitions:
+                    f.close()
+            del bboxes
+            for f in partitions:
+                records = np.fromfile(f.name, dtype=_TILE_RECORD)
+                duplicated[_duplicates(
+                    records, tile_origins, tile_size, iou_threshold, distance)] = True
+                os.remove(f.name)
+
+        # Pass 3: write the features that are not duplicates
+        def kept_features():
+            i = 0
+            for result_filename in result_filenames:
+                for feature in iter_features(result_filename):
+                    if not duplicated[i]:
+                        yield feature
+                    i += 1
+        written = write_features(kept_features(), output_filename, output_format)
+    logger.info('Merged %d features from %d results into %d, dropping %d duplicates' % (
+        count, len(result_filenames), written, count - written))
+    return written
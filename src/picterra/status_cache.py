@@ -0,0 +1,109 @@
+"""
+SQLite store of operations statuses shared by the processes of a host, so that when
+several of them wait for the same operation only one polls the API while the others
+read the status it cached.
+
+A process polls an operation only while it holds its lease: leases are taken and
+renewed at each poll, and expire so that another process takes over if the poller
+dies. The completed operations statuses are kept, and pruned after a week.
+"""
+import logging
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+_COMPLETED_STATUSES = ('success', 'failed')
+
+_PRUNE_AFTER = 7 * 24 * 3600
+
+
+class OperationStatusCache():
+    """
+    Args:
+        path (str): Path of the SQLite database, created if missing
+        lease (float): Number of seconds a process polls an operation for the others,
+            since its last poll; should be longer than the operations poll interval
+    """
+    def __init__(self, path, lease=60):
+        self.path = path
+        self.lease = lease
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS operations ('
+                'operation_id TEXT PRIMARY KEY, status TEXT, updated REAL, '
+                'owner TEXT, lease_expires REAL)')
+            db.execute(
+                'DELETE FROM operations WHERE updated < ?', (time.time() - _PRUNE_AFTER,))
+
+    @contextmanager
+    def _transaction(self):
+        # A connection per transaction, so that the cache can be used from any thread;
+        # BEGIN IMMEDIATE takes the write lock right away, making the lease checks atomic
+        with closing(sqlite3.connect(self.path, timeout=30, isolation_level=None)) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def status(self, operation_id):
+        """The last status cached for the operation, None if it was never polled"""
+        with closing(sqlite3.connect(self.path, timeout=30)) as db:
+            row = db.execute(
+                'SELECT status FROM operations WHERE operation_id = ?',
+                (str(operation_id),)).fetchone()
+        return row[0] if row else None
+
+    def acquire(self, operation_id, owner):
+        """
+        Takes or renews the lease to poll the operation
+
+        Returns:
+            A (leased, status) pair: whether owner holds the lease and must poll the
+            operation, and the last status cached
+        """
+        operation_id = str(operation_id)
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                'SELECT status, owner, lease_expires FROM operations WHERE operation_id = ?',
+                (operation_id,)).fetchone()
+            if row is None:
+                db.execute(
+                    'INSERT INTO operations VALUES (?, NULL, ?, ?, ?)',
+                    (operation_id, now, owner, now + self.lease))
+                return True, None
+            status, lease_owner, lease_expires = row
+            if status in _COMPLETED_STATUSES:
+                return False, status
+            if lease_owner != owner and lease_expires > now:
+                return False, status
+            if lease_owner != owner:
+                logger.debug('Taking over the polling of operation %s' % operation_id)
+            db.execute(
+                'UPDATE operations SET owner = ?, lease_expires = ? WHERE operation_id = ?',
+                (owner, now + self.lease, operation_id))
+            return True, status
+
+    def update(self, operation_id, status, owner):
+        """Caches the status polled by owner, releasing its lease once the operation completed"""
+        now = time.time()
+        lease_expires = 0 if status in _COMPLETED_STATUSES else now + self.lease
+        with self._transaction() as db:
+            db.execute(
+                'UPDATE operations SET status = ?, updated = ?, lease_expires = ? '
+                'WHERE operation_id = ? AND owner = ?',
+                (status, now, lease_expires, str(operation_id), owner))
+
+    def release(self, operation_id, owner):
+        """Lets another process poll the operation right away"""
+        with self._transaction() as db:
+            db.execute(
+                'UPDATE operations SET lease_expires = 0 WHERE operation_id = ? AND owner = ?',
+                (str(operation_id), owner))
@@ -0,0 +1,161 @@
+"""
+Training sweeps: creates a detector per configuration (detection type, output type and
+training steps) with the same training data, then trains and evaluates them all
+concurrently.
+
+The progress of every configuration is recorded in a JSON state file after each step,
+so that a sweep whose driver restarted resumes where it stopped instead of creating
+and training its detectors again.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ._state import load_state, save_state
+from .client import APIError, validate_annotation_type, validate_detector_args
+
+
+logger = logging.getLogger(__name__)
+
+# The steps of a configuration, in order
+_STEPS = ('created', 'populated', 'trained', 'evaluated')
+
+
+def _configuration(configuration):
+    """Normalizes and validates a configuration, returning it with its state key"""
+    configuration = {
+        'detection_type': configuration.get('detection_type', 'count').lower(),
+        'output_type': configuration.get('output_type', 'polygon').lower(),
+        'training_steps': int(configuration.get('training_steps', 500)),
+    }
+    validate_detector_args(**configuration)
+    key = '%(detection_type)s/%(output_type)s/%(training_steps)d' % configuration
+    return key, configuration
+
+
+def run_sweep(
+    client, configurations, training_data, state_file, eval_raster_ids=(),
+    output_dir='sweep', name_prefix='sweep', max_workers: int = 4
+):
+    """
+    Creates, populates, trains and evaluates a detector per configuration
+
+    The API gives no access to the annotations of an existing detector, so the training
+    data is given explicitly, in the format of `APIClient.set_annotations_many`, and
+    set on each detector. Each detector is then run on the evaluation rasters, its
+    results being saved to `<output_dir>/<detector_id>/<raster_id>.geojson`.
+
+    A failing configuration does not interrupt the others: its error is reported in
+    its row, and its remaining steps are run again when the sweep is resumed.
+
+    Args:
+        client (APIClient): The client used to call the API
+        configurations (list of dict): The detectors configurations, with the
+            'detection_type', 'output_type' and 'training_steps' keys (see
+            `APIClient.create_detector` for their defaults); duplicates are run once
+        training_data (list of dict): The annotations to set on each detector, as
+            dictionaries with the 'raster_id' and 'annotation_type' keys, and either an
+            'annotations' or a 'filename' one; their rasters are added to each detector
+        state_file (str): Path of the JSON file recording the progress of the sweep,
+            resumed if it exists
+        eval_raster_ids (list of str): The rasters each trained detector is run on
+        output_dir (str): Directory where the evaluation results are saved
+        name_prefix (str): Prefix of the names of the detectors created
+        max_workers (int): Maximum number of configurations processed at once
+
+    Returns:
+        A list with a row dictionary per configuration, in the same order, for example:
+
+        ::
+
+            {
+                'detection_type': 'count',
+                'output_type': 'polygon',
+                'training_steps': 1000,
+                'detector_id': '42',
+                'step': 'evaluated',  # the last step completed, None if none was
+                'rasters': ['44'],  # the training rasters added to the detector
+                'seconds': {'created': 0.4, 'populated': 12.1, 'trained': 1804.2,
+                            'evaluated': 95.3},
+                'results': [  # as returned by APIClient.run_detector_matrix
+                    {'raster_id': '43', 'feature_count': 120, 'seconds': 95.3, ...}
+                ],
+                'error': None
+            }
+    """
+    configurations = OrderedDict(_configuration(c) for c in configurations)
+    for item in training_data:
+        validate_annotation_type(item['annotation_type'])
+    raster_ids = list(OrderedDict.fromkeys(item['raster_id'] for item in training_data))
+    state = load_state(state_file)
+    lock = threading.Lock()
+
+    def save(key, **values):
+        with lock:
+            state[key].update(values)
+            save_state(state_file, state)
+
+    def run(key):
+        configuration = configurations[key]
+        with lock:
+            row = state.setdefault(key, dict(
+                configuration, detector_id=None, step=None, seconds={}, rasters=[],
+                results=None))
+            row['error'] = None
+
+        def done(step):
+            return row['step'] is not None and _STEPS.index(row['step']) >= _STEPS.index(step)
+
+        def complete(step, start, **values):
+            seconds = dict(row['seconds'], **{step: time.time() - start})
+            save(key, step=step, seconds=seconds, **values)
+            logger.info('Sweep configuration %s %s' % (key, step))
+
+        try:
+            if not done('created'):
+                start = time.time()
+                detector_id = client.create_detector(
+                    '%s %s' % (name_prefix, key.replace('/', ' ')), **configuration)
+                complete('created', start, detector_id=detector_id)
+            detector_id = row['detector_id']
+            if not done('populated'):
+                start = time.time()
+                for raster_id in raster_ids:
+                    # A raster cannot be added twice, so resuming skips the ones added
+                    if raster_id not in row['rasters']:
+                        client.add_raster_to_detector(raster_id, detector_id)
+                        save(key, rasters=row['rasters'] + [raster_id])
+                summaries = client.set_annotations_many(
+                    [dict(item, detector_id=detector_id) for item in training_data],
+                    max_workers=1)
+                failures = [s['error'] for s in summaries if s['status'] == 'failed']
+                if failures:
+                    raise APIError('%d annotations could not be set: %s' % (
+                        len(failures), failures[0]))
+                complete('populated', start)
+            if not done('trained'):
+                start = time.time()
+                client.train_detector(detector_id)
+                complete('trained', start)
+            if not done('evaluated'):
+                start = time.time()
+                results = client.run_detector_matrix(
+                    [detector_id], eval_raster_ids, output_dir, max_workers=1)
+                failures = [r['error'] for r in results if r['error'] is not None]
+                save(key, results=results)
+                if failures:
+                    raise APIError('%d evaluations failed: %s' % (len(failures), failures[0]))
+                complete('evaluated', start)
+        except (APIError, OSError, ValueError, requests.RequestException) as e:
+            logger.error('Sweep configuration %s failed: %s' % (key, e))
+            save(key, error=str(e))
+        return dict(row)
+
+    os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run, configurations))
@@ -0,0 +1,95 @@
+"""
+Local HTTP receiver for operation completion callbacks, so that callers waiting for an
+operation are resolved as soon as the server notifies its completion instead of
+polling its status.
+
+The client registers the URL of the receiver with the requests submitting operations,
+and the server POSTs a {"operation_id": "...", "status": "success"|"failed"} JSON body
+to it once each operation completes. The URL path holds a random token so that only
+whoever got it from the client can notify it.
+"""
+import json
+import logging
+import secrets
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+# Notifications are kept until waited for, up to this many (the oldest are dropped first)
+_MAX_NOTIFICATIONS = 10000
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        receiver = self.server.receiver
+        if self.path.rstrip('/') != '/%s' % receiver.token:
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            notification = json.loads(self.rfile.read(length).decode('utf-8'))
+            operation_id, status = str(notification['operation_id']), notification['status']
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, str(e))
+            return
+        receiver.notify(operation_id, status)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.address_string(), format % args))
+
+
+class WebhookReceiver():
+    """
+    Receives the operation completion callbacks in a background thread
+
+    Args:
+        host (str): Address to listen on
+        port (int): Port to listen on, 0 for any free port
+        public_url (str): URL under which the server reaches the receiver (e.g. through
+            a tunnel or a reverse proxy), without the token; defaults to the local address
+    """
+    def __init__(self, host='127.0.0.1', port=0, public_url=None):
+        self.token = secrets.token_urlsafe(16)
+        self._notifications = OrderedDict()
+        self._condition = threading.Condition()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.receiver = self
+        if public_url is None:
+            public_url = 'http://%s:%d' % self._server.server_address[:2]
+        self.url = '%s/%s/' % (public_url.rstrip('/'), self.token)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info('Listening for operation callbacks on %s:%d' % (
+            self._server.server_address[:2]))
+
+    def notify(self, operation_id, status):
+        logger.debug('Operation %s notified with status=%s' % (operation_id, status))
+        with self._condition:
+            self._notifications[operation_id] = status
+            self._notifications.move_to_end(operation_id)
+            while len(self._notifications) > _MAX_NOTIFICATIONS:
+                self._notifications.popitem(last=False)
+            self._condition.notify_all()
+
+    def wait(self, operation_id, timeout):
+        """
+        Waits for the completion of an operation, which may have been notified already
+
+        Returns:
+            The status of the operation, or None if it was not notified within timeout seconds
+        """
+        operation_id = str(operation_id)
+        with self._condition:
+            self._condition.wait_for(lambda: operation_id in self._notifications, timeout)
+            return self._notifications.pop(operation_id, None)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -4,10 +4,18 @@ import httpretty
 import pytest
 import time
 import json
+import os
+import gzip
+import base64
+import hashlib
+import io
+import mmap
+import threading
+from unittest.mock import MagicMock
 from urllib.parse import urljoin
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, MissingSchema
 from picterra import APIClient
-from picterra.client import APIError
+from picterra.client import APIError, CircuitOpenError, _ConcurrencyLimiter
 
 
 TEST_API_URL = 'http://example.com/public/api/v2/'
@@ -307,6 +315,95 @@ def test_upload_raster():
     assert len(responses.calls) == 4
 
 
+@responses.activate
+def test_upload_raster_from_bytes():
+    content = b'II*\x00' + bytes(range(256))
+    uploads = []
+
+    def upload(request):
+        uploads.append(bytes(request.body))
+        return (200, {}, '')
+    add_mock_raster_upload_responses()
+    responses.remove(responses.PUT, 'http://storage.example.com')
+    responses.add_callback(responses.PUT, 'http://storage.example.com', callback=upload)
+    add_mock_operations_responses('success')
+    # bytes are the content of the raster, not a filename
+    _client().upload_raster(content, name='test')
+    assert uploads == [content]
+
+
+def _raster_sources(content, tmp_path):
+    """The content of a raster as the various objects upload_raster accepts"""
+    np = pytest.importorskip('numpy')
+    prefixed = io.BytesIO(b'xx' + content)
+    prefixed.seek(2)
+    with open(str(tmp_path / 'raster.tif'), 'wb') as f:
+        f.write(content)
+    with open(str(tmp_path / 'raster.tif'), 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return [
+        content, bytearray(content), memoryview(content), prefixed, mapped,
+        np.frombuffer(content, dtype=np.uint16).reshape((4, -1)),
+    ]
+
+
+@responses.activate
+def test_upload_raster_from_buffers(tmp_path):
+    content = bytes(range(256)) * 64
+    md5 = base64.b64encode(hashlib.md5(content).digest()).decode('ascii')
+    uploads = []
+
+    def upload(request):
+        body = request.body
+        # Bytes-like objects are handed to the socket as they are, without copies
+        assert isinstance(body, memoryview) or hasattr(body, 'read')
+        uploads.append((
+            bytes(body) if isinstance(body, memoryview) else body.read(),
+            request.headers.get('Content-MD5'), 'Transfer-Encoding' in request.headers))
+        return (200, {}, '')
+    sources = _raster_sources(content, tmp_path)
+    for _ in sources:
+        add_mock_raster_upload_responses()
+        responses.remove(responses.PUT, 'http://storage.example.com')
+        add_mock_operations_responses('success')
+    responses.add_callback(responses.PUT, 'http://storage.example.com', callback=upload)
+    client = _client()
+    for source in sources:
+        client.upload_raster(source, name='test', checksum=True)
+    assert uploads == [(content, md5, False)] * len(sources)
+    with pytest.raises(ValueError):
+        np = pytest.importorskip('numpy')
+        client.upload_raster(np.zeros((4, 4))[:, ::2], name='test')
+
+
+@responses.activate
+def test_upload_raster_from_stream():
+    content = b'spam' * 1000
+    uploads = []
+
+    def upload(request):
+        uploads.append((request.body.read(), request.headers))
+        return (200, {}, '')
+    for _ in range(2):
+        add_mock_raster_upload_responses()
+        responses.remove(responses.PUT, 'http://storage.example.com')
+        add_mock_operations_responses('success')
+    responses.add_callback(responses.PUT, 'http://storage.example.com', callback=upload)
+    client = _client()
+    for length in (len(content), None):
+        r, w = os.pipe()
+        os.write(w, content)
+        os.close(w)
+        with os.fdopen(r, 'rb') as f:
+            client.upload_raster(f, name='test', length=length, checksum=True)
+    # A stream which is not seekable cannot be checksummed, nor measured
+    (body, headers), (chunked_body, chunked_headers) = uploads
+    assert body == chunked_body == content
+    assert headers['Content-Length'] == str(len(content))
+    assert 'Content-MD5' not in headers and 'Transfer-Encoding' not in headers
+    assert chunked_headers['Transfer-Encoding'] == 'chunked'
+
+
 @responses.activate
 def test_delete_raster():
     RASTER_ID = 'foobar'
@@ -316,6 +413,29 @@ def test_delete_raster():
     assert len(responses.calls) == 1
 
 
+@responses.activate
+def test_delete_rasters():
+    add_mock_delete_raster_response(1)
+    add_mock_delete_raster_response(2)
+    responses.add(responses.DELETE, api_url('rasters/3/'), json={'error': 'spam'}, status=404)
+    client = _client()
+    summaries = client.delete_rasters([1, 2, 1, 3], max_workers=2, dry_run=True)
+    assert [s['status'] for s in summaries] == ['dry_run'] * 3
+    assert len(responses.calls) == 0
+    summaries = client.delete_rasters([1, 2, 1, 3], max_workers=2)
+    assert [(s['id'], s['status']) for s in summaries] == [
+        (1, 'deleted'), (2, 'deleted'), (3, 'failed')]
+    assert 'spam' in summaries[2]['error']
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_delete_detectors():
+    add_mock_delete_detector_response(1)
+    summaries = _client().delete_detectors(['1'])
+    assert summaries == [{'id': '1', 'status': 'deleted', 'error': None}]
+
+
 @responses.activate
 def test_delete_detectionarea():
     RASTER_ID = 'foobar'
@@ -342,6 +462,18 @@ def test_list_rasters():
 
 
 
+@responses.activate
+def test_iter_rasters():
+    client = _client()
+    add_mock_rasters_list_response()
+    rasters = client.iter_rasters()
+    assert next(rasters)['name'] == 'raster1'
+    # Only the first page has been fetched so far
+    assert len(responses.calls) == 1
+    assert [r['name'] for r in rasters] == ['raster2', 'raster3', 'raster4']
+    assert len(responses.calls) == 2
+
+
 @responses.activate
 def test_detector_creation():
     client = _client()
@@ -434,6 +566,27 @@ def test_run_detector():
     assert len(responses.calls) == 2
 
 
+def test_run_detector_matrix(tmp_path):
+    client = _client()
+    client.run_detector = MagicMock(side_effect=lambda d, r: '%s_%s' % (d, r))
+
+    def download(operation_id, filename):
+        if operation_id == 'd2_r2':
+            raise APIError('spam')
+        with open(filename, 'w') as f:
+            json.dump({'type': 'MultiPolygon', 'coordinates': [[], []]}, f)
+    client.download_result_to_file = MagicMock(side_effect=download)
+    summaries = client.run_detector_matrix(
+        ['d1', 'd2', 'd1'], ['r1', 'r2', 'r2'], str(tmp_path), max_workers=3)
+    assert client.run_detector.call_count == 4
+    assert [(s['detector_id'], s['raster_id']) for s in summaries] == [
+        ('d1', 'r1'), ('d1', 'r2'), ('d2', 'r1'), ('d2', 'r2')]
+    assert summaries[0]['filename'] == os.path.join(str(tmp_path), 'd1', 'r1.geojson')
+    assert [s['feature_count'] for s in summaries] == [2, 2, 2, None]
+    assert [s['error'] for s in summaries] == [None, None, None, 'spam']
+    assert all(s['seconds'] >= 0 for s in summaries)
+
+
 @responses.activate
 def test_download_result_to_file():
     expected_content = add_mock_download_result_response(101)
@@ -445,6 +598,23 @@ def test_download_result_to_file():
     assert len(responses.calls) == 2
 
 
+@responses.activate
+def test_iter_result_features():
+    data = {'results': {'url': 'http://storage.example.com/43.geojson'}}
+    responses.add(responses.GET, api_url('operations/102/'), json=data, status=201)
+    features = [
+        {'type': 'Feature', 'properties': {'é': i},
+         'geometry': {'type': 'Point', 'coordinates': [i, 0]}}
+        for i in range(3)
+    ]
+    responses.add(
+        responses.GET, 'http://storage.example.com/43.geojson',
+        body=json.dumps({'type': 'FeatureCollection', 'features': features}, ensure_ascii=False))
+    client = _client()
+    assert list(client.iter_result_features(102)) == features
+    assert len(responses.calls) == 2
+
+
 @responses.activate
 @pytest.mark.parametrize("annotation_type", ['outline', 'training_area', 'testing_area', 'validation_area'])
 def test_upload_annotations(annotation_type):
@@ -459,6 +629,237 @@ def test_upload_annotations(annotation_type):
     assert len(responses.calls) == 6
 
 
+@responses.activate
+def test_upload_annotations_streaming(tmp_path, monkeypatch):
+    add_mock_annotations_responses(1, 2, 'outline')
+    responses.remove(responses.PUT, 'http://storage.example.com')
+    # The temporary file is kept in memory: requests must not ask for its fileno to
+    # get its length, even before Python 3.11 where it has no seekable method
+    monkeypatch.setattr(
+        tempfile.SpooledTemporaryFile, 'fileno', MagicMock(side_effect=AssertionError))
+    monkeypatch.delattr(tempfile.SpooledTemporaryFile, 'seekable', raising=False)
+    uploads = []
+
+    def upload(request):
+        # The body is a file streamed by requests, not a string built beforehand
+        assert hasattr(request.body, 'read')
+        assert 'Content-Length' in request.headers
+        uploads.append(json.loads(request.body.read().decode('utf-8')))
+        return (200, {}, '')
+    responses.add_callback(responses.PUT, 'http://storage.example.com', callback=upload)
+    for _ in range(3):
+        add_mock_operations_responses('success')
+    features = [
+        {'type': 'Feature', 'properties': {'name': 'é'},
+         'geometry': {'type': 'Polygon', 'coordinates': [[[0, 0], [i, 0], [i, i], [0, 0]]]}}
+        for i in range(1, 1000)
+    ]
+    collection = {'type': 'FeatureCollection', 'bbox': [0, 0, 999, 999], 'features': features}
+    client = _client()
+    client.set_annotations(1, 2, 'outline', collection)
+    client.set_annotations(1, 2, 'outline', (f for f in features))
+    filename = str(tmp_path / 'annotations.geojson')
+    with open(filename, 'w') as f:
+        json.dump(collection, f)
+    client.set_annotations_from_file(1, 2, 'Outline', filename)
+    assert uploads == [collection, {'type': 'FeatureCollection', 'features': features}, collection]
+    with pytest.raises(ValueError):
+        client.set_annotations_from_file(1, 2, 'foobar', filename)
+
+
+@responses.activate
+@pytest.mark.parametrize('has_seekable', [True, False])
+def test_upload_annotations_compressed(has_seekable, monkeypatch):
+    add_mock_annotations_responses(1, 2, 'outline')
+    responses.remove(responses.PUT, 'http://storage.example.com')
+    uploads = []
+
+    def upload(request):
+        encoding = request.headers.get('Content-Encoding')
+        uploads.append(encoding)
+        body = request.body.read()
+        if encoding == 'gzip':
+            # The storage does not support compressed uploads the second time
+            if len(uploads) > 1:
+                return (415, {}, 'Unsupported Content-Encoding')
+            body = gzip.decompress(body)
+        assert json.loads(body.decode('utf-8')) == collection
+        return (200, {}, '')
+    responses.add_callback(responses.PUT, 'http://storage.example.com', callback=upload)
+    for _ in range(3):
+        add_mock_operations_responses('success')
+    if not has_seekable:
+        # As before Python 3.11
+        monkeypatch.delattr(tempfile.SpooledTemporaryFile, 'seekable', raising=False)
+    collection = {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {},
+         'geometry': {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}}
+    ] * 100}
+    client = APIClient(api_key='1234', base_url=TEST_API_URL, max_retries=0, compression='gzip')
+    client.set_annotations(1, 2, 'outline', collection)
+    client.set_annotations(1, 2, 'outline', collection)
+    client.set_annotations(1, 2, 'outline', collection)
+    # Compressed, rejected then retried uncompressed, then uncompressed from then on
+    assert uploads == ['gzip', 'gzip', None, None]
+    with pytest.raises(ValueError):
+        APIClient(api_key='1234', base_url=TEST_API_URL, compression='lzma')
+
+
+@responses.activate
+def test_upload_annotations_compressed_concurrently(caplog):
+    add_mock_annotations_responses(1, 2, 'outline')
+    responses.remove(responses.PUT, 'http://storage.example.com')
+    barrier = threading.Barrier(4)
+    uploads = []
+
+    def upload(request):
+        encoding = request.headers.get('Content-Encoding')
+        uploads.append(encoding)
+        if encoding == 'gzip':
+            # All the compressed uploads are in flight when the first is rejected
+            barrier.wait(timeout=5)
+            return (400, {}, 'Unsupported Content-Encoding')
+        return (200, {}, '')
+    responses.add_callback(responses.PUT, 'http://storage.example.com', callback=upload)
+    for _ in range(4):
+        add_mock_operations_responses('success')
+    client = APIClient(api_key='1234', base_url=TEST_API_URL, max_retries=0, compression='gzip')
+    threads = [
+        threading.Thread(target=client.set_annotations, args=(1, 2, 'outline', {}))
+        for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Each rejected upload is retried uncompressed, and compression is disabled once
+    assert uploads.count('gzip') == 4 and uploads.count(None) == 4
+    assert client.compression is None
+    assert len([r for r in caplog.records if 'disabling compression' in r.message]) == 1
+
+
+@responses.activate
+def test_set_raster_detection_areas_from_file_zstd():
+    zstandard = pytest.importorskip('zstandard')
+    add_mock_detection_areas_upload_responses(1)
+    responses.remove(responses.PUT, 'http://storage.example.com')
+    uploads = []
+
+    def upload(request):
+        assert request.headers['Content-Encoding'] == 'zstd'
+        reader = zstandard.ZstdDecompressor().stream_reader(request.body)
+        uploads.append(json.loads(reader.read().decode('utf-8')))
+        return (200, {}, '')
+    responses.add_callback(responses.PUT, 'http://storage.example.com', callback=upload)
+    add_mock_operations_responses('success')
+    areas = {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}
+    client = APIClient(api_key='1234', base_url=TEST_API_URL, max_retries=0, compression='zstd')
+    with tempfile.NamedTemporaryFile('w', suffix='.geojson') as f:
+        json.dump(areas, f)
+        f.flush()
+        client.set_raster_detection_areas_from_file(1, f.name)
+    client.set_raster_detection_areas_from_file(1, json.dumps(areas).encode('utf-8'))
+    assert uploads == [areas, areas]
+
+
+@responses.activate
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+def test_download_result_to_file_compressed(encoding, tmp_path):
+    data = {'results': {'url': 'http://storage.example.com/44.geojson'}}
+    responses.add(responses.GET, api_url('operations/103/'), json=data, status=201)
+    features = [
+        {'type': 'Feature', 'properties': {'i': i},
+         'geometry': {'type': 'Point', 'coordinates': [i, 0]}}
+        for i in range(1000)
+    ]
+    content = json.dumps({'type': 'FeatureCollection', 'features': features}).encode('utf-8')
+    if encoding == 'gzip':
+        body = gzip.compress(content)
+    else:
+        zstandard = pytest.importorskip('zstandard')
+        body = zstandard.ZstdCompressor().compress(content)
+    responses.add(
+        responses.GET, 'http://storage.example.com/44.geojson', body=body,
+        headers={'Content-Encoding': encoding})
+    filename = str(tmp_path / 'result.geojson')
+    _client().download_result_to_file(103, filename)
+    with open(filename, 'rb') as f:
+        assert f.read() == content
+    assert encoding in responses.calls[1].request.headers['Accept-Encoding']
+    # Streamed results are decoded the same way
+    assert list(_client().iter_result_features(103)) == features
+    assert encoding in responses.calls[3].request.headers['Accept-Encoding']
+
+
+def add_mock_annotations_commit_responses(detector_id, raster_id, annotation_type, operation_id):
+    """Like add_mock_annotations_responses, but with an operation per commit"""
+    responses.add(
+        responses.POST,
+        api_url('detectors/%s/training_rasters/%s/%s/upload/bulk/' % (
+            detector_id, raster_id, annotation_type)),
+        json={'upload_url': 'http://storage.example.com', 'upload_id': 32}, status=201)
+    responses.add(
+        responses.POST,
+        api_url('detectors/%s/training_rasters/%s/%s/upload/bulk/32/commit/' % (
+            detector_id, raster_id, annotation_type)),
+        json={'operation_id': operation_id, 'poll_interval': TEST_POLL_INTERVAL}, status=201)
+
+
+@responses.activate
+def test_set_annotations_many(tmp_path):
+    uploads = []
+
+    def upload(request):
+        uploads.append(json.loads(request.body.read().decode('utf-8')))
+        return (200, {}, '')
+    responses.add_callback(responses.PUT, 'http://storage.example.com', callback=upload)
+    for i, (raster_id, annotation_type) in enumerate([
+        (1, 'outline'), (1, 'training_area'), (2, 'outline'), (3, 'outline')
+    ]):
+        add_mock_annotations_commit_responses(9, raster_id, annotation_type, 100 + i)
+        responses.add(
+            responses.GET, api_url('operations/%d/' % (100 + i)),
+            json={'status': 'failed' if raster_id == 3 else 'success'})
+
+    def annotations(i):
+        return {'type': 'FeatureCollection', 'features': [{
+            'type': 'Feature', 'properties': {},
+            'geometry': {'type': 'Polygon', 'coordinates': [[[0, 0], [i, 0], [i, i], [0, 0]]]}
+        }]}
+    filename = str(tmp_path / 'outline.geojson')
+    with open(filename, 'w') as f:
+        json.dump(annotations(1), f)
+    items = [
+        {'detector_id': 9, 'raster_id': 1, 'annotation_type': 'outline', 'filename': filename},
+        {'detector_id': 9, 'raster_id': 1, 'annotation_type': 'Training_Area',
+         'annotations': annotations(2)},
+        {'detector_id': 9, 'raster_id': 2, 'annotation_type': 'outline',
+         'annotations': annotations(3)},
+        {'detector_id': 9, 'raster_id': 3, 'annotation_type': 'outline',
+         'annotations': annotations(4)},
+    ]
+    state_file = str(tmp_path / 'state.json')
+    client = _client()
+    summaries = client.set_annotations_many(items, state_file, max_workers=2)
+    assert [s['status'] for s in summaries] == ['uploaded', 'uploaded', 'uploaded', 'failed']
+    assert summaries[1]['annotation_type'] == 'training_area'
+    assert summaries[3]['error'] == 'Operation 103 failed'
+    assert sorted(u['features'][0]['geometry']['coordinates'][0][1][0] for u in uploads) == [
+        1, 2, 3, 4]
+    with open(state_file) as f:
+        assert sorted(json.load(f)) == ['9/1/outline', '9/1/training_area', '9/2/outline']
+
+    # Only the changed and failed annotations are uploaded again
+    uploads.clear()
+    items[2]['annotations'] = annotations(5)
+    summaries = client.set_annotations_many(items, state_file)
+    assert [s['status'] for s in summaries] == ['unchanged', 'unchanged', 'uploaded', 'failed']
+    assert sorted(u['features'][0]['geometry']['coordinates'][0][1][0] for u in uploads) == [
+        4, 5]
+    with pytest.raises(ValueError):
+        client.set_annotations_many(items[:1] * 2)
+
+
 @responses.activate
 def test_train_detector():
     add_mock_detector_train_responses(1)
@@ -503,6 +904,124 @@ def test_backoff_failure():
         client.list_rasters()
     assert len(httpretty.latest_requests()) == 2
 
+@httpretty.activate
+def test_retry_with_idempotency_key():
+    # A server honouring the Idempotency-Key header: it answers the retries of a request
+    # with the outcome of the first one, here lost by a failing gateway
+    runs, keys = [], []
+    outcomes = {}
+
+    def run_callback(request, uri, response_headers):
+        key = request.headers['Idempotency-Key']
+        keys.append(key)
+        if key not in outcomes:
+            runs.append(key)
+            outcomes[key] = json.dumps({'operation_id': OPERATION_ID, 'poll_interval': 0.01})
+            return [502, response_headers, '']
+        return [201, response_headers, outcomes[key]]
+    httpretty.register_uri(httpretty.POST, api_url('detectors/1/run/'), body=run_callback)
+    httpretty.register_uri(
+        httpretty.GET, api_url('operations/%s/' % OPERATION_ID),
+        body=json.dumps({'status': 'success'}))
+    client = APIClient(api_key='1234', base_url=TEST_API_URL, max_retries=2, backoff_factor=0)
+    assert client.run_detector(1, 2) == OPERATION_ID
+    assert client.run_detector(1, 2) == OPERATION_ID
+    # Each call ran once, the retry reusing the key of the first attempt
+    assert len(runs) == 2 and runs[0] != runs[1]
+    assert keys == [runs[0], runs[0], runs[1], runs[1]]
+    assert all(
+        'Idempotency-Key' not in r.headers for r in httpretty.latest_requests()
+        if r.method == 'GET'
+    )
+
+
+@responses.activate
+def test_train_detector_error():
+    responses.add(
+        responses.POST, api_url('detectors/1/train/'), json={'error': 'spam'}, status=400)
+    with pytest.raises(APIError):
+        _client().train_detector(1)
+
+
+def test_concurrency_limiter():
+    limiter = _ConcurrencyLimiter(max_limit=8)
+    numbers = [limiter.acquire() for _ in range(4)]
+    assert limiter.in_flight == 4
+    # Concurrent requests failing together only halve the limit once
+    for n in numbers:
+        limiter.release(n, 0.1, True)
+    assert limiter.limit == 4 and limiter.in_flight == 0
+    limiter.release(limiter.acquire(), 0.1, True)
+    assert limiter.limit == 2
+    # A much slower request than usual is a congestion signal too
+    limiter.release(limiter.acquire(), 0.1, False)
+    limiter.release(limiter.acquire(), 10, False)
+    assert limiter.limit == 1
+    limiter.release(limiter.acquire(), 10, True)
+    assert limiter.limit == 1
+    # Then it grows by one per limit's worth of successes
+    for _ in range(1 + 2 + 3):
+        limiter.release(limiter.acquire(), 0.1, False)
+    assert limiter.limit == 4
+
+
+@responses.activate
+def test_circuit_breaker():
+    responses.add(responses.GET, api_url('operations/1/'), status=503)
+    client = _client()
+    for _ in range(5):
+        with pytest.raises(APIError):
+            client._operation_completed(1)
+    assert len(responses.calls) == 5
+    with pytest.raises(CircuitOpenError):
+        client._operation_completed(1)
+    assert len(responses.calls) == 5
+    stats = client.session_stats()
+    assert stats['circuit'] == 'open'
+    assert stats['requests'] == stats['failed'] == 5 and stats['rejected'] == 1
+    assert stats['concurrency_limit'] < stats['max_concurrency']
+    # After the cool-down a request probes the API, closing the circuit on success
+    client.sess.breaker.reset_timeout = 0
+    responses.replace(
+        responses.GET, api_url('operations/1/'), json={'status': 'success'}, status=200)
+    assert client._operation_completed(1)
+    assert client.session_stats()['circuit'] == 'closed'
+
+
+@responses.activate
+def test_circuit_breaker_client_errors():
+    client = _client()
+    limit = client.session_stats()['concurrency_limit']
+    # Client side errors say nothing of the API health
+    for _ in range(10):
+        with pytest.raises(MissingSchema):
+            client.sess.get('example.com/no/schema/')
+    stats = client.session_stats()
+    assert stats['circuit'] == 'closed' and stats['failed'] == 0
+    assert stats['concurrency_limit'] == limit and stats['in_flight'] == 0
+    # Connection problems and throttling do
+    responses.add(responses.GET, api_url('operations/1/'), status=429)
+    for i in range(5):
+        if i % 2:
+            client.sess.get(api_url('operations/1/'))
+        else:
+            with pytest.raises(ConnectionError):
+                client.sess.get(api_url('operations/2/'))
+    assert client.session_stats()['circuit'] == 'open'
+    with pytest.raises(CircuitOpenError) as e:
+        client.sess.get(api_url('operations/1/'))
+    assert 'for 30 seconds' in str(e.value)
+    # A probe failing on the client side lets the next request probe again
+    client.sess.breaker.reset_timeout = 0
+    with pytest.raises(MissingSchema):
+        client.sess.get('example.com/no/schema/')
+    assert client.session_stats()['circuit'] == 'open'
+    client.sess.breaker.state = 'half-open'
+    with pytest.raises(CircuitOpenError) as e:
+        client.sess.get(api_url('operations/1/'))
+    assert 'seconds' not in str(e.value)
+
+
 @httpretty.activate
 def test_timeout():
 
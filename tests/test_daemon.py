@@ -0,0 +1,122 @@
+import argparse
+import io
+import os
+import socket
+import threading
+import pytest
+from unittest.mock import MagicMock
+
+from picterra import daemon
+from picterra.__main__ import parse_args, _run_command, APIClient
+
+
+@pytest.fixture
+def socket_path(tmp_path, monkeypatch):
+    monkeypatch.setenv('PICTERRA_API_KEY', '1234')
+    return str(tmp_path / 'd.sock')
+
+
+@pytest.fixture
+def start_daemon(socket_path):
+    servers = []
+
+    def start(run_command):
+        server = daemon._Server(socket_path, run_command, daemon.fingerprint())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_not_running(socket_path):
+    assert daemon.is_running(socket_path) is False
+    assert daemon.forward(socket_path, argparse.Namespace(), io.StringIO()) is None
+    # Stale socket file
+    open(socket_path, 'w').close()
+    assert daemon.is_running(socket_path) is False
+
+
+def test_forward(socket_path, start_daemon):
+    def run_command(options, out):
+        if options.command == 'fail':
+            raise ValueError('spam')
+        print(options.command, file=out)
+        print(options.arg, file=out)
+    start_daemon(run_command)
+    assert daemon.is_running(socket_path)
+    out = io.StringIO()
+    status = daemon.forward(socket_path, argparse.Namespace(command='foo', arg=[1, 2]), out)
+    assert status == (0, None)
+    assert out.getvalue() == 'foo\n[1, 2]\n'
+    status = daemon.forward(socket_path, argparse.Namespace(command='fail'), out)
+    assert status == (1, 'spam')
+
+
+def test_forward_checks_daemon(monkeypatch, socket_path, start_daemon):
+    run_command = MagicMock()
+    start_daemon(run_command)
+    # A CLI configured with another API key is refused
+    monkeypatch.setenv('PICTERRA_API_KEY', '5678')
+    status = daemon.forward(socket_path, argparse.Namespace(command='foo'), io.StringIO())
+    assert status[0] == 1 and 'another API key' in status[1]
+    run_command.assert_not_called()
+    monkeypatch.setenv('PICTERRA_API_KEY', '1234')
+    # Sockets other users may access are ignored
+    os.chmod(socket_path, 0o666)
+    assert daemon.is_running(socket_path) is False
+    assert daemon.forward(socket_path, argparse.Namespace(), io.StringIO()) is None
+    os.chmod(socket_path, 0o600)
+    assert daemon.is_running(socket_path)
+
+
+def test_private_socket_dir(monkeypatch, tmp_path):
+    monkeypatch.delenv('PICTERRA_DAEMON_SOCKET', raising=False)
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    monkeypatch.setattr(daemon, '_private_tmp_dir', lambda: str(tmp_path / 'private'))
+    socket_path = daemon.default_socket_path()
+    assert os.path.dirname(socket_path) == str(tmp_path / 'private')
+    daemon._make_private_dir(str(tmp_path / 'private'))
+    assert os.stat(str(tmp_path / 'private')).st_mode & 0o777 == 0o700
+    # An existing directory other users may access is refused
+    os.chmod(str(tmp_path / 'private'), 0o755)
+    with pytest.raises(PermissionError):
+        daemon._make_private_dir(str(tmp_path / 'private'))
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    assert os.path.dirname(daemon.default_socket_path()) == str(tmp_path)
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_PEERCRED'), reason='requires SO_PEERCRED')
+def test_peer_uid(socket_path, start_daemon):
+    start_daemon(MagicMock())
+    sock = daemon._connect(socket_path)
+    with sock:
+        assert daemon._peer_uid(sock) == os.getuid()
+
+
+def test_cli_forwards_to_daemon(monkeypatch, capsys, socket_path, start_daemon):
+    client = MagicMock()
+    client.list_rasters.return_value = [{'id': 'a'}, {'id': 'b'}]
+    start_daemon(lambda options, out: _run_command(client, options, out))
+    monkeypatch.setenv('PICTERRA_DAEMON_SOCKET', socket_path)
+    # The local client is never built when forwarding
+    monkeypatch.setattr(APIClient, '__init__', MagicMock(side_effect=AssertionError))
+    parse_args(['list', 'rasters', '--output', 'ids_only'])
+    assert capsys.readouterr().out == 'a\nb\n'
+    client.list_rasters.assert_called_with(None)
+    # Paths are made absolute for the daemon
+    parse_args(['create', 'detection_area', 'relative.geojson', 'my_raster'])
+    path = client.set_raster_detection_areas_from_file.call_args[0][1]
+    assert path.startswith('/') and path.endswith('relative.geojson')
+    # Errors are reported
+    client.train_detector.side_effect = ValueError('boom')
+    with pytest.raises(SystemExit) as e:
+        parse_args(['train', 'my_detector'])
+    assert 'boom' in str(e.value)
+    # --no-daemon runs locally
+    monkeypatch.setattr(APIClient, '__init__', lambda s: None)
+    monkeypatch.setattr(APIClient, 'train_detector', MagicMock())
+    parse_args(['--no-daemon', 'train', 'my_detector'])
+    APIClient.train_detector.assert_called_with('my_detector')
@@ -0,0 +1,80 @@
+import io
+import json
+import pytest
+
+from picterra.geojson import iter_features, write_features
+
+
+POLYGON1 = [[[0, 0], [1.5, 0], [1.5, 123456.789], [0, 0]]]
+POLYGON2 = [[[2, 2], [3, 2], [3, 3], [2, 2]], [[2.1, 2.1], [2.2, 2.1], [2.2, 2.2], [2.1, 2.1]]]
+
+FEATURE_COLLECTION = {
+    "type": "FeatureCollection",
+    "bbox": [0, 0, 3, 123456.789],
+    "features": [
+        {"type": "Feature", "properties": {"score": 0.9, "name": 'a "quoted" [name] {x}'},
+         "geometry": {"type": "Polygon", "coordinates": POLYGON1}},
+        {"type": "Feature", "properties": {},
+         "geometry": {"type": "MultiPolygon", "coordinates": [POLYGON1, POLYGON2]}},
+    ]
+}
+
+
+def _features(data, chunk_size, indent=None):
+    return list(iter_features(io.StringIO(json.dumps(data, indent=indent)), chunk_size))
+
+
+# Small chunk sizes make values (numbers in particular) straddle reads
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1 << 16])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_iter_feature_collection(chunk_size, indent):
+    features = _features(FEATURE_COLLECTION, chunk_size, indent)
+    assert features == FEATURE_COLLECTION['features']
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1 << 16])
+def test_iter_geometries(chunk_size):
+    def polygon_feature(coordinates):
+        return {'type': 'Feature', 'properties': {},
+                'geometry': {'type': 'Polygon', 'coordinates': coordinates}}
+    multipolygon = {'type': 'MultiPolygon', 'coordinates': [POLYGON1, POLYGON2]}
+    expected = [polygon_feature(POLYGON1), polygon_feature(POLYGON2)]
+    assert _features(multipolygon, chunk_size) == expected
+    # "type" after "coordinates"
+    multipolygon = {'coordinates': [POLYGON1, POLYGON2], 'type': 'MultiPolygon'}
+    assert _features(multipolygon, chunk_size) == expected
+    for polygon in (
+        {'type': 'Polygon', 'coordinates': POLYGON2},
+        {'coordinates': POLYGON2, 'type': 'Polygon'}
+    ):
+        assert _features(polygon, chunk_size) == [polygon_feature(POLYGON2)]
+    feature = FEATURE_COLLECTION['features'][1]
+    assert _features(feature, chunk_size) == [feature]
+    assert _features({'type': 'FeatureCollection', 'features': []}, chunk_size) == []
+
+
+def test_iter_features_invalid(tmp_path):
+    for content in ('[]', '{"type": "FeatureCollection", "features": [{"a": 1}', '{"a" 1}'):
+        with pytest.raises(ValueError):
+            list(iter_features(io.StringIO(content), 4))
+    filename = str(tmp_path / 'result.geojson')
+    with open(filename, 'w') as f:
+        json.dump(FEATURE_COLLECTION, f)
+    assert list(iter_features(filename)) == FEATURE_COLLECTION['features']
+
+
+@pytest.mark.parametrize("output_format", ['geojson', 'ndjson'])
+def test_write_features(tmp_path, output_format):
+    filename = str(tmp_path / 'out')
+    features = FEATURE_COLLECTION['features']
+    assert write_features(iter(features), filename, output_format) == 2
+    with open(filename) as f:
+        if output_format == 'geojson':
+            assert json.load(f) == {'type': 'FeatureCollection', 'features': features}
+        else:
+            assert [json.loads(line) for line in f] == features
+    assert write_features([], filename) == 0
+    with open(filename) as f:
+        assert json.load(f)['features'] == []
+    with pytest.raises(ValueError):
+        write_features([], filename, 'csv')
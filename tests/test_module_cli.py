@@ -1,12 +1,14 @@
 import pytest
 import subprocess
+import sys
 import os
 import argparse
+import io
 import json
 from urllib.parse import urljoin
 from unittest.mock import MagicMock, patch, mock_open
 
-from picterra.__main__ import parse_args, APIClient
+from picterra.__main__ import parse_args, APIClient, APIError
 
 def _fake__init__(s):
     s.base_url = 'www.example.com'
@@ -53,6 +55,21 @@ def test_rasters_list_output_format(monkeypatch, capsys):
     assert capsys.readouterr().out.replace("\n", "", 2) == '45'
 
 
+def test_list_ndjson_output(monkeypatch, capsys):
+    monkeypatch.setattr(APIClient, '__init__', _fake__init__)
+    rasters = [{'id': 4, 'name': 'foo'}, {'id': 5, 'name': 'bar'}]
+    mock_iter_rasters = MagicMock(return_value=iter(rasters))
+    monkeypatch.setattr(APIClient, 'iter_rasters', mock_iter_rasters)
+    parse_args(['list', 'rasters', '--output', 'ndjson', '--folder', 'spam'])
+    mock_iter_rasters.assert_called_with('spam')
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line) for line in lines] == rasters
+    monkeypatch.setattr(APIClient, 'iter_detectors', MagicMock(return_value=iter(rasters)))
+    parse_args(['list', 'detectors', '--output', 'ndjson'])
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line) for line in lines] == rasters
+
+
 def test_detectors_list(monkeypatch):
     monkeypatch.setattr(APIClient, '__init__', _fake__init__)
     mock_detectorslist = MagicMock(return_value=['foo', 'bar'])
@@ -81,6 +98,41 @@ def test_prediction(monkeypatch, capsys):
     parse_args(['detect', 'my_raster_id', 'my_detector_id', 'a_path'])
     assert (mock_run.called and mock_download.called) is True
 
+def test_prediction_from_stdin(monkeypatch, capsys, tmp_path):
+    monkeypatch.setattr(APIClient, '__init__', _fake__init__)
+    mock_run = MagicMock(side_effect=lambda detector, raster: 'result_%s' % raster)
+    mock_download = MagicMock()
+    monkeypatch.setattr(APIClient, 'run_detector', mock_run)
+    monkeypatch.setattr(APIClient, 'download_result_to_file', mock_download)
+    monkeypatch.setattr('sys.stdin', io.StringIO('r1\nr2\n\nr3\n'))
+    outdir = str(tmp_path / 'out')
+    parse_args(['detect', '-', 'my_detector_id', outdir, '--jobs', '2'])
+    assert os.path.isdir(outdir)
+    assert sorted(c[0] for c in mock_download.call_args_list) == [
+        ('result_%s' % r, os.path.join(outdir, '%s.geojson' % r)) for r in ('r1', 'r2', 'r3')]
+    assert sorted(capsys.readouterr().out.split()) == [
+        os.path.join(outdir, '%s.geojson' % r) for r in ('r1', 'r2', 'r3')]
+
+
+def test_detect_matrix(monkeypatch, capsys):
+    monkeypatch.setattr(APIClient, '__init__', _fake__init__)
+    summaries = [
+        {'detector_id': 'd1', 'raster_id': 'r1', 'seconds': 1.25, 'feature_count': 3,
+         'error': None, 'filename': 'out/d1/r1.geojson'},
+        {'detector_id': 'd1', 'raster_id': 'r2', 'seconds': 2, 'feature_count': None,
+         'error': 'spam', 'filename': 'out/d1/r2.geojson'},
+    ]
+    mock_matrix = MagicMock(return_value=summaries)
+    monkeypatch.setattr(APIClient, 'run_detector_matrix', mock_matrix)
+    with pytest.raises(BaseException):
+        parse_args(['detect-matrix', 'out', '-r', 'r1', 'r2', '-d', 'd1'])
+    mock_matrix.assert_called_with(['d1'], ['r1', 'r2'], 'out', 4)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ['DETECTOR', 'RASTER', 'SECONDS', 'FEATURES', 'STATUS']
+    assert lines[1].split() == ['d1', 'r1', '1.2', '3', 'ok']
+    assert lines[2].split() == ['d1', 'r2', '2.0', '-', 'failed:', 'spam']
+
+
 def test_train(monkeypatch, capsys):
     monkeypatch.setattr(APIClient, '__init__', _fake__init__)
     mock_train = MagicMock()
@@ -143,12 +195,50 @@ def test_create_raster(monkeypatch, capsys):
     mock_create_raster.assert_called_with('my_path_to_tiff', 'beacon', 'eggs')
     assert mock_add_raster.call_count == 3
     mock_add_raster.assert_called_with('spam', 'c')
+    # The name of a single raster is not a template
+    parse_args(['create', 'raster', 'my_path_to_tiff', '--name', 'field {A}'])
+    mock_create_raster.assert_called_with('my_path_to_tiff', 'field {A}', None)
+
+
+def test_create_raster_bulk(monkeypatch, capsys, tmp_path):
+    monkeypatch.setattr(APIClient, '__init__', _fake__init__)
+    for name in ('a.tif', 'b.tif', 'c.jpg'):
+        (tmp_path / name).write_bytes(b'')
+    uploaded = {}
+
+    def fake_upload(self, path, name, folder):
+        uploaded[path] = (name, folder)
+        return 'id_%s' % os.path.basename(path)
+    mock_add_raster = MagicMock()
+    monkeypatch.setattr(APIClient, 'upload_raster', fake_upload)
+    monkeypatch.setattr(APIClient, 'add_raster_to_detector', mock_add_raster)
+    # Glob, with concurrency and NDJSON report
+    parse_args([
+        'create', 'raster', str(tmp_path / '*.tif'), '--name', '{stem}-{index}',
+        '--folder', 'eggs', '-d', 'det', '--jobs', '2', '--output', 'ndjson'
+    ])
+    reports = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert sorted(r['raster_id'] for r in reports) == ['id_a.tif', 'id_b.tif']
+    assert uploaded == {
+        str(tmp_path / 'a.tif'): ('a-0', 'eggs'), str(tmp_path / 'b.tif'): ('b-1', 'eggs')}
+    assert mock_add_raster.call_count == 2
+    # Directory
+    uploaded.clear()
+    parse_args(['create', 'raster', str(tmp_path)])
+    assert sorted(capsys.readouterr().out.split()) == ['id_a.tif', 'id_b.tif', 'id_c.jpg']
+    assert all(name is None for name, _ in uploaded.values())
+    # Invalid templates are reported before uploading anything
+    uploaded.clear()
+    with pytest.raises(SystemExit):
+        parse_args(['create', 'raster', str(tmp_path), '--name', 'field {A}'])
+    assert 'invalid --name template' in capsys.readouterr().err
+    assert uploaded == {}
 
 
 def test_create_annotation(monkeypatch, capsys):
     monkeypatch.setattr(APIClient, '__init__', _fake__init__)
     mock_set_annotations = MagicMock()
-    monkeypatch.setattr(APIClient, 'set_annotations', mock_set_annotations)
+    monkeypatch.setattr(APIClient, 'set_annotations_from_file', mock_set_annotations)
     assert mock_set_annotations.called is False
     with pytest.raises(BaseException):
         parse_args(['create', 'annotation'])
@@ -156,13 +246,41 @@ def test_create_annotation(monkeypatch, capsys):
     assert 'following arguments are required' in captured.err
     assert 'type' in captured.err
     assert mock_set_annotations.called is False
-    with patch("builtins.open", mock_open(read_data='{"a":3}')):
-        parse_args([
-            'create', 'annotation', 'path/to/open', 'my_raster', 'my_detector',
-            'training_area'
-        ])
-        mock_set_annotations.assert_called_with(
-            'my_detector', 'my_raster', 'training_area', {"a":3})
+    parse_args([
+        'create', 'annotation', 'path/to/open', 'my_raster', 'my_detector',
+        'training_area'
+    ])
+    mock_set_annotations.assert_called_with(
+        'my_detector', 'my_raster', 'training_area', 'path/to/open')
+
+
+def test_create_annotations(monkeypatch, capsys, tmp_path):
+    monkeypatch.setattr(APIClient, '__init__', _fake__init__)
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text(json.dumps([
+        {'path': 'a.geojson', 'raster': 'r1', 'detector': 'd1', 'type': 'outline'},
+        {'path': 'b.geojson', 'raster': 'r2', 'detector': 'd1', 'type': 'training_area'},
+    ]))
+    summaries = [
+        {'detector_id': 'd1', 'raster_id': 'r1', 'annotation_type': 'outline',
+         'status': 'unchanged', 'error': None},
+        {'detector_id': 'd1', 'raster_id': 'r2', 'annotation_type': 'training_area',
+         'status': 'failed', 'error': 'spam'},
+    ]
+    mock_many = MagicMock(return_value=summaries)
+    monkeypatch.setattr(APIClient, 'set_annotations_many', mock_many)
+    with pytest.raises(BaseException):
+        parse_args(['create', 'annotations', str(manifest), '-j', '2'])
+    mock_many.assert_called_with([
+        {'filename': str(tmp_path / 'a.geojson'), 'raster_id': 'r1', 'detector_id': 'd1',
+         'annotation_type': 'outline'},
+        {'filename': str(tmp_path / 'b.geojson'), 'raster_id': 'r2', 'detector_id': 'd1',
+         'annotation_type': 'training_area'},
+    ], '%s.state' % manifest, 2)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ['DETECTOR', 'RASTER', 'TYPE', 'STATUS']
+    assert lines[1].split() == ['d1', 'r1', 'outline', 'unchanged']
+    assert lines[2].split() == ['d1', 'r2', 'training_area', 'failed:', 'spam']
 
 
 def test_create_detectionarea(monkeypatch, capsys):
@@ -196,6 +314,10 @@ def test_delete_raster(monkeypatch, capsys):
     assert mock_delete.called is False
     parse_args(['delete', 'raster', 'my_raster'])
     mock_delete.assert_called_with('my_raster')
+    mock_delete.reset_mock()
+    monkeypatch.setattr('sys.stdin', io.StringIO('r1\nr2\n'))
+    parse_args(['delete', 'raster', '-', '--jobs', '4'])
+    assert sorted(c[0][0] for c in mock_delete.call_args_list) == ['r1', 'r2']
 
 
 def test_delete_detector(monkeypatch, capsys):
@@ -213,6 +335,35 @@ def test_delete_detector(monkeypatch, capsys):
     mock_delete.assert_called_with('my_detector')
 
 
+def test_delete_many(monkeypatch, capsys):
+    monkeypatch.setattr(APIClient, '__init__', _fake__init__)
+    rasters = [
+        {'id': 'r1', 'name': 'test-1', 'status': 'ready'},
+        {'id': 'r2', 'name': 'prod-1', 'status': 'ready'},
+        {'id': 'r3', 'name': 'test-2', 'status': 'failed'},
+    ]
+    mock_iter = MagicMock(return_value=iter(rasters))
+    monkeypatch.setattr(APIClient, 'iter_rasters', mock_iter)
+    mock_delete = MagicMock()
+    monkeypatch.setattr(APIClient, 'delete_raster', mock_delete)
+    parse_args(['delete', 'raster', '--folder', 'f1', '--name-prefix', 'test-', '--dry-run'])
+    mock_iter.assert_called_with('f1')
+    assert mock_delete.called is False
+    assert capsys.readouterr().out.split() == ['r1', 'r3']
+    mock_iter.return_value = iter(rasters)
+    parse_args(['delete', 'raster', '--status', 'ready'])
+    assert sorted(c[0][0] for c in mock_delete.call_args_list) == ['r1', 'r2']
+    assert capsys.readouterr().out.split() == ['r1', 'r2']
+    with pytest.raises(BaseException):
+        parse_args(['delete', 'raster', 'r1', '--status', 'ready'])
+    assert 'cannot be combined with --status' in capsys.readouterr().err
+    # Per-ID errors are reported after the other deletions
+    monkeypatch.setattr(APIClient, 'delete_detector', MagicMock(side_effect=[None, APIError('x')]))
+    with pytest.raises(BaseException):
+        parse_args(['delete', 'detector', 'd1', 'd2', '-j', '1'])
+    assert capsys.readouterr().out.split() == ['d1']
+
+
 def test_delete_detectionarea(monkeypatch, capsys):
     monkeypatch.setattr(APIClient, '__init__', _fake__init__)
     mock_delete = MagicMock()
@@ -226,3 +377,54 @@ def test_delete_detectionarea(monkeypatch, capsys):
     assert mock_delete.called is False
     parse_args(['delete', 'detection_area', 'my_raster'])
     mock_delete.assert_called_with('my_raster')
+
+
+def test_stats(monkeypatch, capsys, tmp_path):
+    pytest.importorskip('numpy')
+    monkeypatch.setattr(APIClient, '__init__', _fake__init__)
+    square = [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]
+    result = {'type': 'MultiPolygon', 'coordinates': [square, square]}
+    result_file = tmp_path / 'result.geojson'
+    result_file.write_text(json.dumps(result))
+    parse_args(['stats', str(result_file), '--bins', '0', '1e10', '1e11'])
+    stats = json.loads(capsys.readouterr().out)
+    assert stats['count'] == 2 and stats['bbox'] == [0, 0, 1, 1]
+    assert [b['count'] for b in stats['area_histogram']] == [0, 2]
+    # Operation IDs are streamed through the client
+    features = [{'type': 'Feature', 'properties': {},
+                 'geometry': {'type': 'Polygon', 'coordinates': square}}]
+    mock_iter = MagicMock(return_value=iter(features))
+    monkeypatch.setattr(APIClient, 'iter_result_features', mock_iter)
+    parse_args(['stats', 'my_operation_id', '--pixel'])
+    mock_iter.assert_called_with('my_operation_id')
+    stats = json.loads(capsys.readouterr().out)
+    assert stats['count'] == 1 and stats['units'] == 'px'
+
+
+@pytest.mark.parametrize("flag", ['--help', '--version'])
+def test_startup_does_not_import_client(flag):
+    # -X importtime lists every imported module on stderr
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'picterra', flag],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    imported = [line.rsplit('|', 1)[-1].strip() for line in proc.stderr.splitlines()]
+    assert 'picterra' in imported
+    assert not {'requests', 'urllib3', 'picterra.client'} & set(imported)
+
+
+def test_help_keeps_client_unimported():
+    # The lazy imports are checked directly, rather than timed, in a fresh interpreter
+    code = (
+        "import sys\n"
+        "from picterra.__main__ import parse_args\n"
+        "try:\n"
+        "    parse_args(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print(sorted(m for m in ('requests', 'urllib3', 'picterra.client') "
+        "if m in sys.modules), file=sys.stderr)\n"
+    )
+    proc = subprocess.run(
+        [sys.executable, '-c', code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    assert proc.stderr.strip() == '[]'
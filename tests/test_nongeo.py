@@ -1,5 +1,10 @@
 import pytest
+import json
+import multiprocessing
+import random
+import sys
 import tempfile
+from picterra import nongeo
 from picterra.nongeo import _nongeo_latlng2xy
 from picterra import nongeo_result_to_pixel
 
@@ -25,7 +30,19 @@ def test_nongeo_latlng2xy(latlng, xy):
     assert int(round(x)) == xy[0] and int(round(y)) == xy[1]
 
 
-def test_nongeo_result_to_pixel():
+def test_nongeo_lnglat2xy_array():
+    np = pytest.importorskip('numpy')
+    lnglat = [(random.uniform(0, 0.01), random.uniform(-0.01, 0)) for _ in range(1000)]
+    expected = [_nongeo_latlng2xy(lat, lng) for lng, lat in lnglat]
+    assert np.allclose(nongeo._nongeo_lnglat2xy_array(lnglat), expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_nongeo_result_to_pixel(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(nongeo, 'np', None)
     with tempfile.NamedTemporaryFile(mode='wt') as f:
         # This is the Multipolygon corresponding to the corners of a
         # 1520x1086 non-georeferenced image
@@ -41,6 +58,10 @@ def test_nongeo_result_to_pixel():
                     [0.000000034, -0.000000034],
                     [0.000000096, -0.000975470]
                   ]
+                ],
+                [
+                  [[0.0, 0.0], [0.0, 0.0], [0.0, 0.0], [0.0, 0.0]],
+                  [[0.0, 0.0], [0.0, 0.0], [0.0, 0.0], [0.0, 0.0]]
                 ]
               ]
             }
@@ -52,3 +73,328 @@ def test_nongeo_result_to_pixel():
         assert tuple(map(round, polygons[0][0][2])) == (1520, 0)
         assert tuple(map(round, polygons[0][0][3])) == (0, 0)
         assert tuple(map(round, polygons[0][0][4])) == (0, 1086)
+        assert [len(p) for p in polygons] == [1, 2]
+        assert all(isinstance(xy, tuple) for ring in polygons[1] for xy in ring)
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_nongeo_result_to_pixel_altitude(monkeypatch, tmp_path, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(nongeo, 'np', None)
+    ring = [[0.000000096, -0.000975470], [0.00136530, -0.00097539],
+            [0.001365320, 0.000000129], [0.000000096, -0.000975470]]
+    filename = str(tmp_path / 'result.geojson')
+    with open(filename, 'w') as f:
+        json.dump({'type': 'MultiPolygon', 'coordinates': [[ring], [ring]]}, f)
+    expected = nongeo_result_to_pixel(filename)
+    # The altitude of the positions is ignored, whether all or some of them have one
+    with open(filename, 'w') as f:
+        json.dump({'type': 'MultiPolygon', 'coordinates': [
+            [[xy + [i] for i, xy in enumerate(ring)]], [ring]]}, f)
+    assert nongeo_result_to_pixel(filename) == expected
+    assert [list(map(round, xy)) for xy in expected[0][0]] == [
+        [0, 1086], [1520, 1086], [1520, 0], [0, 1086]]
+    if use_numpy:
+        assert nongeo_result_to_pixel(filename, processes=2) == expected
+    with open(filename, 'w') as f:
+        json.dump({'type': 'MultiPolygon', 'coordinates': [[[xy[:1] for xy in ring]]]}, f)
+    with pytest.raises(ValueError):
+        nongeo_result_to_pixel(filename)
+
+
+def test_nongeo_result_to_pixel_compact(tmp_path):
+    np = pytest.importorskip('numpy')
+    coordinates = [
+        [[[0.0, 0.0], [0.001, 0.0], [0.001, -0.001], [0.0, 0.0]],
+         [[0.0002, -0.0002], [0.0003, -0.0002], [0.0003, -0.0003], [0.0002, -0.0002]]],
+        [[[0.0, 0.0], [0.002, 0.0], [0.002, -0.002], [0.0, -0.002], [0.0, 0.0]]],
+    ]
+    filename = str(tmp_path / 'result.geojson')
+    with open(filename, 'w') as f:
+        json.dump({'type': 'MultiPolygon', 'coordinates': coordinates}, f)
+    polygons = nongeo_result_to_pixel(filename, compact=True)
+    assert len(polygons) == 2 and polygons.num_rings == 3 and polygons.num_vertices == 13
+    assert polygons.ring_offsets.tolist() == [0, 4, 8, 13]
+    assert polygons.polygon_offsets.tolist() == [0, 2, 3]
+    # Polygons are views on the coordinates buffer
+    assert len(polygons[0]) == 2 and polygons[-1][0].shape == (5, 2)
+    assert np.shares_memory(polygons[1][0], polygons.coords)
+    with pytest.raises(IndexError):
+        polygons[2]
+    # Same values as the nested lists form, and round trip
+    as_list = nongeo_result_to_pixel(filename)
+    assert polygons.to_list() == as_list
+    assert nongeo.PixelPolygons.from_list(as_list).to_list() == as_list
+    assert [len(p) for p in polygons] == [2, 1]
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_iter_nongeo_result_to_pixel(monkeypatch, tmp_path, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(nongeo, 'np', None)
+    # Bottom-left, bottom-right and top-right corners of the 1520x1086 image
+    ring = [[0.000000096, -0.000975470], [0.00136530, -0.00097539],
+            [0.001365320, 0.000000129], [0.000000096, -0.000975470]]
+    result = {
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature', 'properties': {'score': 0.5},
+             'bbox': [0.000000096, -0.000975470, 0.00136530, 0.000000129],
+             'geometry': {'type': 'Polygon', 'coordinates': [ring]}},
+            {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'Point', 'coordinates': ring[0]}},
+        ]
+    }
+    filename = str(tmp_path / 'result.geojson')
+    with open(filename, 'w') as f:
+        json.dump(result, f)
+    features = list(nongeo.iter_nongeo_result_to_pixel(filename))
+    assert features[0]['properties'] == {'score': 0.5}
+    assert [list(map(round, xy)) for xy in features[0]['geometry']['coordinates'][0]] == [
+        [0, 1086], [1520, 1086], [1520, 0], [0, 1086]]
+    assert list(map(round, features[0]['bbox'])) == [0, 0, 1520, 1086]
+    assert list(map(round, features[1]['geometry']['coordinates'])) == [0, 1086]
+    # Same as the non streaming version on a MultiPolygon
+    with open(filename, 'w') as f:
+        json.dump({'type': 'MultiPolygon', 'coordinates': [[ring], [ring, ring]]}, f)
+    expected = nongeo_result_to_pixel(filename)
+    features = list(nongeo.iter_nongeo_result_to_pixel(filename))
+    assert len(features) == 2
+    for feature, polygon in zip(features, expected):
+        assert feature['geometry']['type'] == 'Polygon'
+        assert feature['geometry']['coordinates'] == [[list(xy) for xy in r] for r in polygon]
+    output_filename = str(tmp_path / 'pixels.ndjson')
+    assert nongeo.nongeo_result_to_pixel_file(filename, output_filename, 'ndjson') == 2
+    with open(output_filename) as f:
+        assert [json.loads(line) for line in f] == features
+
+
+def test_nongeo_xy2latlng():
+    for x, y in ((0, 0), (1520, 1086), (12.5, 99999.25)):
+        lat, lng = nongeo._nongeo_xy2latlng(x, y)
+        assert nongeo._nongeo_latlng2xy(lat, lng) == pytest.approx((x, y), abs=1e-6)
+    np = pytest.importorskip('numpy')
+    xy = np.random.uniform(0, 20000, size=(1000, 2))
+    lnglat = nongeo._nongeo_xy2lnglat_array(xy)
+    expected = [nongeo._nongeo_xy2latlng(x, y)[::-1] for x, y in xy]
+    assert np.allclose(lnglat, expected, rtol=0, atol=1e-12)
+    assert np.allclose(nongeo._nongeo_lnglat2xy_array(lnglat), xy, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_pixel_polygons_to_nongeo_geojson(monkeypatch, tmp_path, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(nongeo, 'np', None)
+    polygons = [
+        [[(0, 0), (10, 0), (10, 10), (0, 0)], [(1, 1), (2, 1), (2, 2), (1, 1)]],
+        [[(100, 50), (200, 50), (200, 80), (100, 50)]],
+    ]
+    annotations = nongeo.pixel_polygons_to_nongeo_geojson(polygons)
+    assert annotations['type'] == 'FeatureCollection'
+    filename = str(tmp_path / 'annotations.geojson')
+    with open(filename, 'w') as f:
+        json.dump(annotations, f)
+    features = list(nongeo.iter_nongeo_result_to_pixel(filename))
+    for feature, polygon in zip(features, polygons):
+        assert feature['geometry']['type'] == 'Polygon'
+        for ring, expected_ring in zip(feature['geometry']['coordinates'], polygon):
+            assert ring == [pytest.approx(list(xy), abs=1e-6) for xy in expected_ring]
+
+
+def _signed_area(ring):
+    return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(ring, ring[1:])) / 2
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_pixel_boxes_to_nongeo_geojson(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(nongeo, 'np', None)
+    boxes = [[10, 20, 30, 40], [0, 0, 1, 1]]
+    features = nongeo.pixel_boxes_to_nongeo_geojson(boxes)['features']
+    assert len(features) == 2
+    ring = features[0]['geometry']['coordinates'][0]
+    assert ring[0] == ring[-1] and len(ring) == 5
+    # Counter-clockwise in lng/lat
+    assert _signed_area(ring) > 0
+    corners = sorted(
+        tuple(round(v, 6) for v in nongeo._nongeo_latlng2xy(lat, lng)) for lng, lat in ring[:4])
+    assert corners == [(10, 20), (10, 60), (40, 20), (40, 60)]
+    xyxy = nongeo.pixel_boxes_to_nongeo_geojson([[10, 20, 40, 60]], box_format='xyxy')
+    assert xyxy['features'][0] == features[0]
+    with pytest.raises(ValueError):
+        nongeo.pixel_boxes_to_nongeo_geojson(boxes, box_format='cxcywh')
+
+
+def test_pixel_boxes_to_nongeo_geojson_vectorized():
+    np = pytest.importorskip('numpy')
+    boxes = np.random.uniform(0, 5000, size=(1000, 4))
+    vectorized = nongeo.pixel_boxes_to_nongeo_geojson(boxes)
+    nongeo_np, nongeo.np = nongeo.np, None
+    try:
+        expected = nongeo.pixel_boxes_to_nongeo_geojson(boxes.tolist())
+    finally:
+        nongeo.np = nongeo_np
+    for feature, expected_feature in zip(vectorized['features'], expected['features']):
+        assert np.allclose(
+            feature['geometry']['coordinates'], expected_feature['geometry']['coordinates'],
+            rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_nongeo_result_to_pixel_parallel(monkeypatch, tmp_path, indent):
+    pytest.importorskip('numpy')
+    # Tiny chunks so that the result is split across many workers
+    monkeypatch.setattr(nongeo, '_PARALLEL_CHUNK_SIZE', 300)
+    polygons = [
+        [[[random.uniform(0, 0.01), random.uniform(-0.01, 0)] for _ in range(i % 7 + 3)]
+         for _ in range(i % 3 + 1)]
+        for i in range(100)
+    ]
+    filename = str(tmp_path / 'result.geojson')
+    with open(filename, 'w') as f:
+        json.dump({'coordinates': polygons, 'type': 'MultiPolygon'}, f, indent=indent)
+    assert len(nongeo._multipolygon_chunks(open(filename, 'rb').read(), 300)) > 10
+    expected = nongeo_result_to_pixel(filename)
+    assert nongeo_result_to_pixel(filename, processes=3) == expected
+    compact = nongeo_result_to_pixel(filename, compact=True, processes=2)
+    assert compact.to_list() == expected
+    # "type" after "coordinates", and members other than them
+    with open(filename, 'w') as f:
+        json.dump({'coordinates': polygons, 'bbox': [0, -0.01, 0.01, 0], 'crs': {'type': 'x'},
+                   'type': 'MultiPolygon'}, f, indent=indent)
+    assert nongeo_result_to_pixel(filename, processes=2) == expected
+    # Without shared memory (before Python 3.8), in a single process
+    monkeypatch.setitem(sys.modules, 'multiprocessing.shared_memory', None)
+    monkeypatch.delattr(multiprocessing, 'shared_memory', raising=False)
+    monkeypatch.setattr(nongeo, '_nongeo_result_to_pixel_parallel', None)
+    assert nongeo_result_to_pixel(filename, processes=2) == expected
+    monkeypatch.undo()
+    # Empty and unsupported results
+    with open(filename, 'w') as f:
+        json.dump({'type': 'MultiPolygon', 'coordinates': []}, f)
+    assert nongeo_result_to_pixel(filename, processes=2) == []
+    with open(filename, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': []}, f)
+    assert nongeo_result_to_pixel(filename, processes=2) == []
+    with open(filename, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'Point', 'coordinates': [0, 0]}}
+        ]}, f)
+    for processes in (1, 2):
+        with pytest.raises(ValueError):
+            nongeo_result_to_pixel(filename, processes=processes)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_nongeo_result_to_pixel_feature_collection(monkeypatch, tmp_path, processes):
+    pytest.importorskip('numpy')
+    monkeypatch.setattr(nongeo, '_PARALLEL_CHUNK_SIZE', 100)
+    polygons = [
+        [[[0.001 * i, -0.001], [0.001 * i + 0.0005, -0.001], [0.001 * i, 0], [0.001 * i, -0.001]]]
+        for i in range(5)
+    ]
+    filename = str(tmp_path / 'result.geojson')
+    # Features with MultiPolygon geometries must not be mistaken for a bare MultiPolygon
+    with open(filename, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'MultiPolygon', 'coordinates': polygons[:2]}},
+            {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'MultiPolygon', 'coordinates': polygons[2:4]}},
+            {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'Polygon', 'coordinates': polygons[4]}},
+        ]}, f)
+    with open(filename, 'rb') as f:
+        assert nongeo._multipolygon_chunks(f.read(), 100) is None
+    multipolygon_filename = str(tmp_path / 'multipolygon.geojson')
+    with open(multipolygon_filename, 'w') as f:
+        json.dump({'type': 'MultiPolygon', 'coordinates': polygons}, f)
+    expected = nongeo_result_to_pixel(multipolygon_filename)
+    assert len(expected) == 5
+    assert nongeo_result_to_pixel(filename, processes=processes) == expected
+
+
+def test_pixel_polygons_simplify():
+    np = pytest.importorskip('numpy')
+    # A staircase outline, as produced by raster segmentation, with a duplicated vertex
+    staircase = [(0, 0), (1, 0), (2, 0), (2, 1), (2, 1), (3, 1), (4, 1), (4, 2),
+                 (4, 3), (2, 3), (0, 3), (0, 2), (0, 1), (0, 0)]
+    # A noisy circle, counter-clockwise in pixel coordinates
+    angles = np.linspace(0, 2 * np.pi, 200)
+    circle = np.stack([100 + 50 * np.cos(angles), 100 - 50 * np.sin(angles)], axis=1)
+    circle += np.random.uniform(-0.2, 0.2, size=(200, 2))
+    circle[-1] = circle[0]
+    triangle = [(0, 0), (0.1, 0), (0.1, 0.1), (0, 0)]
+    polygons = nongeo.PixelPolygons.from_list(
+        [[staircase], [[tuple(xy) for xy in circle.tolist()], triangle]])
+    areas = nongeo._signed_areas(polygons.coords, polygons.ring_offsets)
+
+    # Nothing is removed by default
+    assert polygons.simplify().num_vertices == polygons.num_vertices
+    collinear = polygons.simplify(remove_collinear=True)
+    assert collinear.original_num_vertices == polygons.num_vertices
+    assert collinear.num_vertices < polygons.num_vertices
+    assert collinear[0][0].tolist() == [
+        [0, 0], [2, 0], [2, 1], [4, 1], [4, 3], [0, 3], [0, 0]]
+    assert np.allclose(
+        nongeo._signed_areas(collinear.coords, collinear.ring_offsets), areas)
+
+    simplified = polygons.simplify(tolerance=1, remove_collinear=True)
+    assert simplified.num_vertices < collinear.num_vertices
+    assert len(simplified[1][0]) < 50
+    for ring in (r for polygon in simplified for r in polygon):
+        assert len(ring) >= 4 and ring[0].tolist() == ring[-1].tolist()
+    assert np.array_equal(
+        np.sign(nongeo._signed_areas(simplified.coords, simplified.ring_offsets)),
+        np.sign(areas))
+    ring = simplified[1][0]
+    area = nongeo._signed_areas(ring, np.array([0, len(ring)]))[0]
+    assert abs(area - areas[1]) < 0.05 * abs(areas[1])
+
+    # Tiny rings that would collapse when rounded keep their exact coordinates
+    rounded = polygons.simplify(tolerance=1, remove_collinear=True, precision=0)
+    assert np.array_equal(rounded[0][0], np.round(rounded[0][0]))
+    assert np.array_equal(rounded[1][0], np.round(rounded[1][0]))
+    assert rounded[1][1].tolist() == [list(xy) for xy in triangle]
+    assert len(rounded) == len(polygons) and rounded.polygon_offsets.tolist() == [0, 1, 3]
+
+
+def test_nongeo_result_to_pixel_simplify(monkeypatch, tmp_path):
+    pytest.importorskip('numpy')
+    monkeypatch.setattr(nongeo, '_PARALLEL_CHUNK_SIZE', 300)
+    polygons = [
+        [[[random.uniform(0, 0.01), random.uniform(-0.01, 0)] for _ in range(i % 7 + 3)]
+         for _ in range(i % 3 + 1)]
+        for i in range(100)
+    ]
+    for polygon in polygons:
+        for ring in polygon:
+            ring.append(ring[0])
+    filename = str(tmp_path / 'result.geojson')
+    with open(filename, 'w') as f:
+        json.dump({'coordinates': polygons, 'type': 'MultiPolygon'}, f)
+    original = nongeo.PixelPolygons.from_list(nongeo_result_to_pixel(filename))
+    simplified = original.simplify(tolerance=2, remove_collinear=True, precision=1)
+    expected = simplified.to_list()
+    for processes in (1, 2):
+        assert nongeo_result_to_pixel(
+            filename, processes=processes, tolerance=2, remove_collinear=True,
+            precision=1) == expected
+        # The vertex counts before and after the simplification are returned
+        polygons, counts = nongeo_result_to_pixel(
+            filename, processes=processes, tolerance=2, remove_collinear=True,
+            precision=1, return_vertex_counts=True)
+        assert polygons == expected
+        assert counts == (original.num_vertices, simplified.num_vertices)
+        compact = nongeo_result_to_pixel(
+            filename, compact=True, processes=processes, tolerance=2, remove_collinear=True,
+            precision=1)
+        assert (compact.original_num_vertices, compact.num_vertices) == counts
+    monkeypatch.setattr(nongeo, 'np', None)
+    with pytest.raises(ImportError):
+        nongeo_result_to_pixel(filename, precision=0)
+    polygons, counts = nongeo_result_to_pixel(filename, return_vertex_counts=True)
+    assert counts == (original.num_vertices, original.num_vertices)
@@ -0,0 +1,347 @@
+import json
+import math
+import os
+import random
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from picterra import results  # noqa: E402
+from picterra.results import (  # noqa: E402
+    ResultFile, ResultIndex, convert_result, is_result_file, load_result_index, merge_results,
+    result_stats)
+
+
+def _square(x, y, size):
+    return [[[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]]
+
+
+def _features(n=500, seed=0):
+    rng = random.Random(seed)
+    features = []
+    for i in range(n):
+        x, y = rng.uniform(0, 100), rng.uniform(0, 100)
+        if i % 10 == 0:
+            geometry = {'type': 'Point', 'coordinates': [x, y]}
+        elif i % 10 == 1:
+            geometry = {'type': 'MultiPolygon', 'coordinates': [
+                _square(x, y, 1), _square(x + 2, y, 1)]}
+        elif i % 10 == 2:
+            geometry = {'type': 'LineString', 'coordinates': [[x, y], [x + 1, y + 2]]}
+        else:
+            # A square with a hole
+            square = _square(x, y, 2)
+            square.append([[x + 0.5, y + 0.5], [x + 0.5, y + 1.5], [x + 1.5, y + 1.5],
+                           [x + 1.5, y + 0.5], [x + 0.5, y + 0.5]])
+            geometry = {'type': 'Polygon', 'coordinates': square}
+        features.append({'type': 'Feature', 'geometry': geometry, 'properties': {'i': i}})
+    features.append({'type': 'Feature', 'geometry': None, 'properties': {'i': n}})
+    return features
+
+
+def _write(features, filename):
+    with open(filename, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+
+@pytest.fixture
+def index():
+    return ResultIndex.from_features(_features(), node_capacity=4)
+
+
+def test_result_index_features(index):
+    features = _features()
+    assert len(index) == len(features)
+    assert index.geometry_types[-1] == -1 and np.isnan(index.bboxes[-1]).all()
+    for i in (0, 1, 2, 3, len(features) - 1):
+        assert index.feature(i) == features[i]
+    minx, miny, maxx, maxy = index.bounds
+    assert 0 <= minx and 0 <= miny and maxx <= 103 and maxy <= 102
+
+
+def test_result_index_query_bbox(index):
+    for bbox in [(10, 10, 20, 30), (50, 50, 50, 50), (-10, -10, -1, -1), (0, 0, 200, 200)]:
+        expected = [
+            i for i, b in enumerate(index.bboxes.tolist())
+            if b[0] <= bbox[2] and b[2] >= bbox[0] and b[1] <= bbox[3] and b[3] >= bbox[1]
+        ]
+        assert index.query_bbox(bbox).tolist() == expected
+    assert len(index.query_bbox((0, 0, 200, 200))) == len(index) - 1
+
+
+def test_result_index_query_point(index):
+    # Inside the square of feature 3, in its hole, and in the second polygon of feature 1
+    x, y = index.feature(3)['geometry']['coordinates'][0][0]
+    assert 3 in index.query_point(x + 0.25, y + 0.25).tolist()
+    assert 3 not in index.query_point(x + 1, y + 1).tolist()
+    assert 3 not in index.query_point(x + 2.5, y + 0.25).tolist()
+    x, y = index.feature(1)['geometry']['coordinates'][1][0][0]
+    assert 1 in index.query_point(x + 0.5, y + 0.5).tolist()
+    # Points and lines never contain anything
+    x, y = index.feature(0)['geometry']['coordinates']
+    assert 0 not in index.query_point(x, y).tolist()
+
+
+def test_result_index_nearest(index):
+    rng = random.Random(1)
+    for _ in range(20):
+        x, y = rng.uniform(-20, 120), rng.uniform(-20, 120)
+        distances = [index.distance(i, x, y) for i in range(len(index))]
+        expected = sorted(range(len(index)), key=lambda i: distances[i])[:5]
+        found = index.nearest(x, y, k=5)
+        assert [d for _, d in found] == pytest.approx([distances[i] for i in expected])
+    x, y = index.feature(0)['geometry']['coordinates']
+    assert index.nearest(x, y) == [(0, 0.0)]
+    assert index.distance(len(index) - 1, x, y) == math.inf
+    assert index.nearest(-1000, -1000, max_distance=10) == []
+
+
+def test_result_index_save_load(index, tmp_path):
+    filename = str(tmp_path / 'index.npz')
+    index.save(filename)
+    loaded = ResultIndex.load(filename)
+    assert len(loaded) == len(index) and loaded.node_capacity == 4
+    assert loaded.query_bbox((10, 10, 20, 30)).tolist() == index.query_bbox(
+        (10, 10, 20, 30)).tolist()
+    assert loaded.feature(3) == index.feature(3)
+    assert loaded.nearest(50, 50, k=3) == index.nearest(50, 50, k=3)
+
+
+def test_load_result_index(monkeypatch, tmp_path):
+    result_filename = str(tmp_path / 'result.geojson')
+    _write(_features(50), result_filename)
+    built = []
+    from_file = ResultIndex.from_file.__func__
+
+    def counting_from_file(cls, *args, **kwargs):
+        built.append(args)
+        return from_file(cls, *args, **kwargs)
+    monkeypatch.setattr(ResultIndex, 'from_file', classmethod(counting_from_file))
+    index = load_result_index(result_filename)
+    assert os.path.exists(result_filename + '.index.npz')
+    assert load_result_index(result_filename).feature(7) == index.feature(7)
+    assert len(built) == 1
+    # Changing the result invalidates the index
+    _write(_features(60), result_filename)
+    assert len(load_result_index(result_filename)) == 61
+    assert len(built) == 2
+
+
+def test_result_index_pixel(tmp_path):
+    from picterra.nongeo import pixel_polygons_to_nongeo_geojson
+    result_filename = str(tmp_path / 'result.geojson')
+    _write(pixel_polygons_to_nongeo_geojson(
+        [_square(100, 100, 50), _square(300, 120, 20)])['features'], result_filename)
+    index = load_result_index(result_filename, pixel=True)
+    assert index.query_point(120, 130).tolist() == [0]
+    assert index.query_bbox((250, 0, 1000, 1000)).tolist() == [1]
+    assert os.path.exists(result_filename + '.pixel-index.npz')
+    assert load_result_index(result_filename).query_point(120, 130).tolist() == []
+
+
+def test_result_index_empty():
+    index = ResultIndex.from_features([])
+    assert len(index) == 0 and index.bounds is None
+    assert index.query_bbox((0, 0, 1, 1)).tolist() == []
+    assert index.nearest(0, 0) == []
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 10000])
+def test_convert_result_feature_collection(tmp_path, batch_size):
+    features = _features(100)
+    # Members beyond the geometry and properties, and 3D coordinates, round trip too
+    features[5]['id'] = 'abc'
+    features[5]['bbox'] = [0, 0, 1, 1]
+    features[6]['geometry']['coordinates'] = [
+        [xy + [float(i)] for i, xy in enumerate(ring)]
+        for ring in features[6]['geometry']['coordinates']]
+    features[7]['geometry']['crs'] = {'type': 'name'}
+    collection = {'type': 'FeatureCollection', 'bbox': [0, 0, 103, 102], 'features': features}
+    result_filename = str(tmp_path / 'result.geojson')
+    with open(result_filename, 'w') as f:
+        json.dump(collection, f)
+    binary_filename = str(tmp_path / 'result.bin')
+    assert convert_result(result_filename, binary_filename, batch_size=batch_size) == 101
+    assert is_result_file(binary_filename) and not is_result_file(result_filename)
+    result = ResultFile(binary_filename)
+    assert len(result) == 101 and list(result) == features
+    assert result.feature(6) == features[6] and result.properties[9] == {'i': 9}
+    # Zero-copy, read-only views on the file
+    assert isinstance(result.coords.base, np.memmap) and not result.coords.flags.writeable
+    expected = ResultIndex.from_features(features)
+    for name in ('coords', 'ring_offsets', 'part_offsets', 'feature_offsets',
+                 'geometry_types'):
+        assert np.array_equal(getattr(result, name), getattr(expected, name))
+    assert np.array_equal(result.bboxes, expected.bboxes, equal_nan=True)
+    output_filename = str(tmp_path / 'output.geojson')
+    assert result.to_geojson(output_filename) == 101
+    with open(output_filename) as f:
+        assert json.load(f) == collection
+
+
+def test_convert_result_multipolygon(tmp_path):
+    multipolygon = {'type': 'MultiPolygon', 'coordinates': [
+        _square(0, 0, 1), _square(2, 0, 1) + [[[2.2, 0.2], [2.4, 0.2], [2.4, 0.4], [2.2, 0.2]]]]}
+    result_filename = str(tmp_path / 'result.geojson')
+    with open(result_filename, 'w') as f:
+        json.dump(multipolygon, f)
+    binary_filename = str(tmp_path / 'result.bin')
+    assert convert_result(result_filename, binary_filename) == 2
+    output_filename = str(tmp_path / 'output.geojson')
+    ResultFile(binary_filename).to_geojson(output_filename)
+    with open(output_filename) as f:
+        assert json.load(f) == multipolygon
+    # The nongeo conversion reads the binary file directly
+    from picterra.nongeo import nongeo_result_to_pixel
+    assert nongeo_result_to_pixel(binary_filename) == nongeo_result_to_pixel(result_filename)
+    assert nongeo_result_to_pixel(binary_filename, compact=True, precision=0).to_list() == (
+        nongeo_result_to_pixel(result_filename, compact=True, precision=0).to_list())
+
+
+@pytest.mark.parametrize("geojson", [
+    {'type': 'Feature', 'id': 1, 'properties': None,
+     'geometry': {'type': 'Point', 'coordinates': [1, 2, 3]}},
+    {'type': 'Polygon', 'coordinates': _square(0, 0, 1)},
+    {'type': 'FeatureCollection', 'features': []},
+])
+def test_convert_result_single(tmp_path, geojson):
+    result_filename = str(tmp_path / 'result.geojson')
+    with open(result_filename, 'w') as f:
+        json.dump(geojson, f)
+    binary_filename = str(tmp_path / 'result.bin')
+    convert_result(result_filename, binary_filename)
+    output_filename = str(tmp_path / 'output.geojson')
+    ResultFile(binary_filename).to_geojson(output_filename)
+    with open(output_filename) as f:
+        assert json.load(f) == geojson
+
+
+def test_result_file_index(tmp_path):
+    features = _features(200)
+    result_filename = str(tmp_path / 'result.geojson')
+    _write(features, result_filename)
+    binary_filename = str(tmp_path / 'result.bin')
+    convert_result(result_filename, binary_filename, batch_size=50)
+    expected = ResultIndex.from_features(features)
+    index = ResultIndex.from_file(binary_filename)
+    assert index.query_bbox((10, 10, 50, 50)).tolist() == expected.query_bbox(
+        (10, 10, 50, 50)).tolist()
+    assert index.nearest(30, 30, k=4) == expected.nearest(30, 30, k=4)
+    assert index.feature(3) == features[3]
+    # Saving reads the properties from the file
+    index.save(str(tmp_path / 'index.npz'))
+    assert ResultIndex.load(str(tmp_path / 'index.npz')).feature(3) == features[3]
+
+
+def test_result_stats_pixel(tmp_path):
+    from picterra.nongeo import pixel_polygons_to_nongeo_geojson
+    square_with_hole = _square(0, 0, 100) + _square(10, 10, 10)
+    geojson = pixel_polygons_to_nongeo_geojson(
+        [_square(100, 100, 50), _square(300, 120, 2), square_with_hole])
+    result_filename = str(tmp_path / 'result.geojson')
+    _write(geojson['features'] + [{'type': 'Feature', 'properties': {}, 'geometry': {
+        'type': 'LineString', 'coordinates': geojson['features'][0]['geometry'][
+            'coordinates'][0][:2]}}], result_filename)
+    stats = result_stats(result_filename, pixel=True, batch_size=3)
+    assert stats['units'] == 'px' and stats['count'] == 4
+    assert stats['total_area'] == pytest.approx(2500 + 4 + 9900, abs=1e-3)
+    assert stats['mean_area'] == pytest.approx(stats['total_area'] / 4)
+    assert stats['min_area'] == 0 and stats['max_area'] == pytest.approx(9900, abs=1e-3)
+    assert stats['total_perimeter'] == pytest.approx(200 + 8 + 440 + 50, abs=1e-3)
+    assert stats['bbox'] == pytest.approx([0, 0, 302, 150], abs=1e-6)
+    assert stats['area_histogram'] == [
+        {'min': 0, 'max': 0, 'count': 1}, {'min': 1, 'max': 10, 'count': 1},
+        {'min': 1000, 'max': 10000, 'count': 2}]
+    binned = result_stats(result_filename, pixel=True, bins=[0, 10, 5000, 20000])
+    assert [b['count'] for b in binned['area_histogram']] == [2, 1, 1]
+    # Same from a binary result file
+    binary_filename = str(tmp_path / 'result.bin')
+    convert_result(result_filename, binary_filename)
+    assert result_stats(binary_filename, pixel=True, batch_size=3) == pytest.approx(stats)
+
+
+def test_result_stats_geographic(tmp_path):
+    features = [{'type': 'Feature', 'properties': {}, 'geometry': {
+        'type': 'Polygon', 'coordinates': _square(6, 0, 1)}}]
+    client = type('Client', (), {'iter_result_features': lambda self, op_id: iter(features)})()
+    stats = result_stats('an-operation-id', client)
+    assert stats['units'] == 'm' and stats['count'] == 1
+    # A 1 degree square at the equator, on the sphere
+    radius = results._EARTH_RADIUS
+    assert stats['total_area'] == pytest.approx(
+        radius ** 2 * math.radians(1) * math.sin(math.radians(1)), rel=1e-9)
+    assert stats['total_perimeter'] == pytest.approx(
+        radius * math.radians(1) * (3 + math.cos(math.radians(1))), rel=1e-4)
+    assert stats['bbox'] == [6, 0, 7, 1]
+    assert stats['area_histogram'] == [{'min': 1e10, 'max': 1e11, 'count': 1}]
+    del features[:]
+    assert result_stats('an-operation-id', client) == {
+        'count': 0, 'total_area': 0, 'mean_area': None, 'min_area': None, 'max_area': None,
+        'total_perimeter': 0, 'mean_perimeter': None, 'bbox': None, 'area_histogram': [],
+        'units': 'm'}
+
+
+def _expected_merge(features, duplicate):
+    bboxes = ResultIndex.from_features(features).bboxes
+    return [
+        f for i, f in enumerate(features)
+        if not any(duplicate(bboxes[j], bboxes[i]) for j in range(i))
+    ]
+
+
+def _iou(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    inter = w * h if w >= 0 and h >= 0 else 0
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else float(np.array_equal(a, b))
+
+
+@pytest.mark.parametrize("tile_size,chunk_size", [(None, 1 << 20), (3, 50), (0.5, 7)])
+def test_merge_results(tmp_path, tile_size, chunk_size):
+    rng = random.Random(2)
+    # Two overlapping results: the objects on the overlap are detected in both, with
+    # slightly different outlines
+    objects = [(2 * i + rng.uniform(0, 0.5), 2 * j + rng.uniform(0, 0.5))
+               for i in range(10) for j in range(5)]
+    filenames = []
+    for k, (x0, x1) in enumerate([(0, 12), (8, 20)]):
+        features = [
+            {'type': 'Feature', 'properties': {'result': k, 'i': i}, 'geometry': {
+                'type': 'Polygon', 'coordinates': _square(
+                    x + rng.uniform(-0.05, 0.05), y + rng.uniform(-0.05, 0.05), 1)}}
+            for i, (x, y) in enumerate(objects) if x0 <= x < x1
+        ]
+        if k == 0:
+            features.append({'type': 'Feature', 'properties': {}, 'geometry': None})
+            features.append({'type': 'Feature', 'properties': {},
+                             'geometry': {'type': 'Point', 'coordinates': [30, 30]}})
+        else:
+            features.append({'type': 'Feature', 'properties': {},
+                             'geometry': {'type': 'Point', 'coordinates': [30, 30]}})
+        filenames.append(str(tmp_path / ('result%d.geojson' % k)))
+        _write(features, filenames[-1])
+    all_features = [f for filename in filenames for f in _read_features(filename)]
+    output_filename = str(tmp_path / 'merged.geojson')
+    written = merge_results(
+        filenames, output_filename, tile_size=tile_size, chunk_size=chunk_size)
+    with open(output_filename) as f:
+        merged = json.load(f)['features']
+    expected = _expected_merge(all_features, lambda a, b: _iou(a, b) >= 0.5)
+    assert written == len(merged) == len(expected) and merged == expected
+    # All the objects of the overlap were detected twice
+    assert len(all_features) - len(merged) == sum(1 for x, _ in objects if 8 <= x < 12) + 1
+
+    written = merge_results(
+        filenames, output_filename, distance=0.5, output_format='ndjson',
+        tile_size=tile_size, chunk_size=chunk_size)
+    with open(output_filename) as f:
+        merged = [json.loads(line) for line in f]
+    expected = _expected_merge(all_features, lambda a, b: np.hypot(
+        (a[0] + a[2] - b[0] - b[2]) / 2, (a[1] + a[3] - b[1] - b[3]) / 2) <= 0.5)
+    assert written == len(merged) and merged == expected
+
+
+def _read_features(filename):
+    with open(filename) as f:
+        return json.load(f)['features']
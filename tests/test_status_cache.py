@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+import responses
+
+from picterra import APIClient
+from picterra.client import APIError
+from picterra.status_cache import OperationStatusCache
+
+
+TEST_API_URL = 'http://example.com/public/api/v2/'
+
+
+def test_leases(tmp_path):
+    path = str(tmp_path / 'operations.db')
+    cache = OperationStatusCache(path, lease=60)
+    other = OperationStatusCache(path, lease=60)
+    assert cache.acquire(1, 'a') == (True, None)
+    # Another owner reads the status while the lease is held
+    assert other.acquire(1, 'b') == (False, None)
+    cache.update(1, 'running', 'a')
+    assert other.acquire(1, 'b') == (False, 'running')
+    assert cache.acquire(1, 'a') == (True, 'running')
+    # Once released (e.g. the poller failed or died), another owner takes over
+    cache.release(1, 'a')
+    assert other.acquire(1, 'b') == (True, 'running')
+    # Only the lease holder updates the status
+    cache.update(1, 'success', 'a')
+    assert cache.status(1) == 'running'
+    other.update(1, 'success', 'b')
+    # Completed operations are not polled anymore
+    assert cache.acquire(1, 'a') == (False, 'success')
+    assert other.acquire(1, 'b') == (False, 'success')
+    expired = OperationStatusCache(path, lease=0)
+    assert expired.acquire(2, 'a') == (True, None)
+    assert expired.acquire(2, 'b') == (True, None)
+
+
+@responses.activate
+def test_shared_polling(tmp_path):
+    path = str(tmp_path / 'operations.db')
+    url = TEST_API_URL + 'operations/21/'
+    for status in ('running', 'running', 'running', 'success'):
+        responses.add(responses.GET, url, json={'status': status})
+    clients = [
+        APIClient(api_key='1234', base_url=TEST_API_URL, max_retries=0, status_cache=path)
+        for _ in range(3)
+    ]
+    operation = {'operation_id': 21, 'poll_interval': 0.05}
+    threads = [
+        threading.Thread(target=c._wait_until_operation_completes, args=(operation,))
+        for c in clients
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # A single client polled the operation until it completed
+    assert len(responses.calls) == 4
+
+    responses.add(responses.GET, TEST_API_URL + 'operations/22/', json={'status': 'failed'})
+    for c in clients:
+        with pytest.raises(APIError):
+            c._wait_until_operation_completes({'operation_id': 22, 'poll_interval': 0.05})
+    assert len(responses.calls) == 5
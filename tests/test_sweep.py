@@ -0,0 +1,69 @@
+import json
+from unittest.mock import MagicMock
+
+import pytest
+
+from picterra.client import APIError
+from picterra.sweep import run_sweep
+
+
+def _mock_client():
+    client = MagicMock()
+    client.create_detector.side_effect = lambda name, **kwargs: 'd%d' % (
+        client.create_detector.call_count)
+    client.set_annotations_many.side_effect = lambda uploads, **kwargs: [
+        {'status': 'uploaded', 'error': None} for _ in uploads]
+    client.run_detector_matrix.side_effect = lambda d, r, o, max_workers: [
+        {'detector_id': d[0], 'raster_id': raster_id, 'feature_count': 3, 'error': None}
+        for raster_id in r]
+    return client
+
+
+def test_run_sweep(tmp_path):
+    state_file = str(tmp_path / 'sweep.json')
+    configurations = [
+        {'detection_type': 'count', 'training_steps': 500},
+        {'detection_type': 'Segmentation', 'output_type': 'bbox', 'training_steps': 1000},
+        {'detection_type': 'count', 'training_steps': 500},
+    ]
+    training_data = [
+        {'raster_id': 'r1', 'annotation_type': 'outline', 'filename': 'r1.geojson'},
+        {'raster_id': 'r1', 'annotation_type': 'training_area', 'filename': 'r1-area.geojson'},
+        {'raster_id': 'r2', 'annotation_type': 'outline', 'annotations': {}},
+    ]
+    client = _mock_client()
+    client.train_detector.side_effect = lambda detector_id: (
+        _raise(APIError('spam')) if detector_id == 'd2' else None)
+    rows = run_sweep(
+        client, configurations, training_data, state_file, ['e1'], str(tmp_path / 'out'),
+        max_workers=1)
+    assert [(r['detection_type'], r['output_type'], r['training_steps']) for r in rows] == [
+        ('count', 'polygon', 500), ('segmentation', 'bbox', 1000)]
+    assert [(r['detector_id'], r['step'], r['error']) for r in rows] == [
+        ('d1', 'evaluated', None), ('d2', 'populated', 'spam')]
+    assert rows[0]['results'][0]['feature_count'] == 3
+    assert sorted(rows[0]['seconds']) == ['created', 'evaluated', 'populated', 'trained']
+    assert client.add_raster_to_detector.call_count == 4
+    uploads = client.set_annotations_many.call_args_list[0][0][0]
+    assert [u['detector_id'] for u in uploads] == ['d1'] * 3
+    with open(state_file) as f:
+        assert json.load(f)['segmentation/bbox/1000']['step'] == 'populated'
+
+    # Resuming only runs the remaining steps of the failed configuration
+    client = _mock_client()
+    rows = run_sweep(
+        client, configurations, training_data, state_file, ['e1'], str(tmp_path / 'out'))
+    assert [(r['detector_id'], r['step'], r['error']) for r in rows] == [
+        ('d1', 'evaluated', None), ('d2', 'evaluated', None)]
+    assert not client.create_detector.called
+    assert not client.add_raster_to_detector.called
+    client.train_detector.assert_called_once_with('d2')
+    client.run_detector_matrix.assert_called_once_with(
+        ['d2'], ['e1'], str(tmp_path / 'out'), max_workers=1)
+
+    with pytest.raises(ValueError):
+        run_sweep(client, [{'training_steps': 10}], training_data, state_file)
+
+
+def _raise(e):
+    raise e
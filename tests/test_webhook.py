@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+import responses
+
+from picterra import APIClient
+from picterra.client import APIError
+from picterra.webhook import WebhookReceiver
+
+
+TEST_API_URL = 'http://example.com/public/api/v2/'
+
+
+def _notify(url, operation_id, status):
+    request = urllib.request.Request(
+        url, data=json.dumps({'operation_id': operation_id, 'status': status}).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request) as resp:
+        return resp.status
+
+
+def test_receiver():
+    receiver = WebhookReceiver()
+    try:
+        assert receiver.url.startswith('http://127.0.0.1:')
+        # Notified before being waited for
+        assert _notify(receiver.url, 1, 'success') == 204
+        assert receiver.wait(1, 0) == 'success'
+        assert receiver.wait(1, 0) is None
+        # Notified while being waited for
+        timer = threading.Timer(0.1, _notify, (receiver.url, '2', 'failed'))
+        timer.start()
+        assert receiver.wait(2, 5) == 'failed'
+        timer.join()
+        # Only whoever knows the token can notify
+        with pytest.raises(urllib.error.HTTPError) as e:
+            _notify(receiver.url.replace(receiver.token, 'spam'), 3, 'success')
+        assert e.value.code == 404
+        assert receiver.wait(3, 0.1) is None
+    finally:
+        receiver.close()
+    receiver = WebhookReceiver(public_url='https://example.com/hooks/')
+    try:
+        assert receiver.url.startswith('https://example.com/hooks/')
+    finally:
+        receiver.close()
+
+
+@responses.activate
+def test_run_detector_with_callbacks():
+    # Stand-in for the API, firing the callbacks registered with the operations
+    operations = []
+
+    def run(request):
+        operation_id = 100 + len(operations)
+        callback_url = request.headers['X-Callback-Url']
+        operations.append(operation_id)
+        status = 'failed' if operation_id == 101 else 'success'
+        # The server sends no callback for operations 102 and 103
+        if operation_id not in (102, 103):
+            threading.Timer(0.05, _notify, (callback_url, operation_id, status)).start()
+        return (201, {}, json.dumps({'operation_id': operation_id, 'poll_interval': 1}))
+    responses.add_callback(
+        responses.POST, TEST_API_URL + 'detectors/1/run/', callback=run)
+    responses.add(responses.POST, TEST_API_URL + 'detectors/', json={'id': '1'}, status=201)
+    for operation_id in (102, 103):
+        responses.add(
+            responses.GET, TEST_API_URL + 'operations/%d/' % operation_id,
+            json={'status': 'success'})
+    client = APIClient(api_key='1234', base_url=TEST_API_URL, max_retries=0)
+    client.start_webhook_receiver(deadline=0.5)
+    try:
+        assert client.run_detector(1, 2) == 100
+        with pytest.raises(APIError):
+            client.run_detector(1, 2)
+        # No status was polled
+        assert all(c.request.method == 'POST' for c in responses.calls)
+        # Only the requests submitting operations register the receiver
+        client.create_detector()
+        assert 'X-Callback-Url' not in responses.calls[-1].request.headers
+        # Without a callback within the deadline, the status is polled
+        start = time.time()
+        assert client.run_detector(1, 2) == 102
+        assert time.time() - start >= 0.5
+        assert responses.calls[-1].request.url == TEST_API_URL + 'operations/102/'
+        # Then the next operations are polled right away
+        start = time.time()
+        assert client.run_detector(1, 2) == 103
+        assert time.time() - start < 0.5
+        assert responses.calls[-1].request.url == TEST_API_URL + 'operations/103/'
+        # Until a callback is received again
+        assert client.run_detector(1, 2) == 104
+        assert client._webhook_missed is False
+        assert client.run_detector(1, 2) == 105
+        assert responses.calls[-1].request.method == 'POST'
+    finally:
+        client.stop_webhook_receiver()
+    assert client._webhook is None